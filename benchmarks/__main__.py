@@ -0,0 +1,283 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import re
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+from benchmarks import fakes
+from benchmarks.fakes import FakeActivity
+from benchmarks.workload import Workload
+
+# Offline benchmark of rule evaluation, action execution and storage. Runs
+# a synthetic event stream against fake Discord objects in a temporary
+# directory and reports throughput, latency, regex calls and bytes written
+#
+#   python -m benchmarks --rules 300 --regexes 3 --events 20000
+#   python -m benchmarks --storage sqlite --json results.json
+
+
+class CountingPattern:
+    calls = 0
+
+    def __init__(self, pattern: re.Pattern):
+        self._pattern = pattern
+        self.pattern = pattern.pattern
+        self.groupindex = pattern.groupindex
+        self.flags = pattern.flags
+
+    def search(self, text: str):
+        CountingPattern.calls += 1
+        return self._pattern.search(text)
+
+    def finditer(self, text: str):
+        CountingPattern.calls += 1
+        return self._pattern.finditer(text)
+
+
+def count_regex_calls():
+    import lajter.rule
+    from lajter.rule import RuleType
+
+    for rule_type in lajter.rule.TEXT_RULE_TYPES:
+        matcher = lajter.rule.get_matcher(rule_type)
+        matcher.prefiltered = {
+            literal: [(rule_id, CountingPattern(pattern))
+                      for rule_id, pattern in patterns]
+            for literal, patterns in matcher.prefiltered.items()}
+        matcher.folded = {
+            literal: [(rule_id, CountingPattern(pattern))
+                      for rule_id, pattern in patterns]
+            for literal, patterns in matcher.folded.items()}
+        matcher.merged = [(rule_id, CountingPattern(pattern))
+                          for rule_id, pattern in matcher.merged]
+        matcher.separate = [(rule_id, CountingPattern(pattern))
+                            for rule_id, pattern in matcher.separate]
+        if matcher.combined:
+            matcher.combined = CountingPattern(matcher.combined)
+    for rule in lajter.rule.get_by_type(RuleType.ROLE):
+        rule.patterns = [CountingPattern(p) for p in rule.patterns]
+
+
+class BytesWritten:
+    total = 0
+
+
+def count_bytes_written():
+    from lajter.storage import SQLiteStorage, TinyDBStorage
+
+    row = SQLiteStorage._row
+
+    def counted_row(self, entry):
+        values = row(self, entry)
+        BytesWritten.total += len(values[1])
+        return values
+
+    SQLiteStorage._row = counted_row
+
+    # Every flush of a TinyDB table rewrites the whole file
+    for storage in storages():
+        if isinstance(storage, TinyDBStorage):
+            json_storage = storage.db.storage.storage
+            write = json_storage.write
+
+            def counted_write(data, write=write):
+                BytesWritten.total += len(json.dumps(data))
+                write(data)
+
+            json_storage.write = counted_write
+
+
+def storages():
+    import lajter.action
+    import lajter.poll
+    import lajter.rule
+    import lajter.user
+    return [lajter.rule.Rule.db, lajter.action.Action.db,
+            lajter.user.User.db, lajter.poll.Poll.db]
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+async def run(args) -> dict:
+    import lajter.action
+    import lajter.cogs.rules
+    import lajter.dispatch
+    import lajter.rule
+    import lajter.settings
+    import lajter.user
+    from lajter.rule import RuleType
+
+    workload = Workload(args.seed, args.rules, args.regexes, args.users,
+                        args.words)
+    lajter.action.Action.db.upsert_many(workload.actions())
+    lajter.rule.Rule.db.upsert_many(workload.rules())
+    lajter.user.User.db.upsert_many(workload.users())
+
+    bot = fakes.FakeBot(workload.guild)
+    os.environ["DEFAULT_GUILD"] = str(workload.guild.id)
+    os.environ["DEFAULT_CHANNEL"] = str(workload.channels[0].id)
+    os.environ["REGEX_BUDGET_MS"] = str(args.regex_budget_ms)
+    lajter.settings.reload()
+    # Changes are sent right away, the coalescing delay would only measure
+    # how long the dispatcher sleeps
+    lajter.dispatch.dispatcher.delay = 0
+
+    lajter.user.get_all()
+    # Regexes run by the regex worker are not counted
+    count_regex_calls()
+    count_bytes_written()
+
+    events = workload.events(args.events, args.hit_rate)
+    latencies: Dict[str, List[float]] = {}
+    regex_calls: Dict[str, int] = {}
+
+    start = time.perf_counter()
+    for kind, member, channel, message, reaction, points, text in events:
+        calls = CountingPattern.calls
+        event_start = time.perf_counter()
+        match kind:
+            case "message":
+                await lajter.cogs.rules.handle_rules(
+                    [RuleType.MESSAGE, RuleType.ROLE], bot=bot,
+                    member=member, channel=channel, message=message)
+            case "presence":
+                member.activities = [FakeActivity(text)]
+                await lajter.cogs.rules.handle_rules(
+                    [RuleType.ACTIVITY], bot=bot, member=member)
+            case "name":
+                member.display_name = text
+                await lajter.cogs.rules.handle_rules(
+                    [RuleType.NAME], bot=bot, member=member)
+            case "reaction":
+                await lajter.cogs.rules.handle_rules(
+                    [RuleType.REACTION], bot=bot, member=member,
+                    channel=channel, message=message, reaction=reaction)
+            case "points":
+                async with lajter.user.unit_of_work(member.id) as (db_user,):
+                    db_user.points += points
+                await lajter.cogs.rules.handle_points_changes(
+                    bot, member, channel)
+        latencies.setdefault(kind, []).append(
+            time.perf_counter() - event_start)
+        regex_calls[kind] = (regex_calls.get(kind, 0)
+                             + CountingPattern.calls - calls)
+    # Users are written by the periodic flush, once for the whole stream
+    lajter.user.flush()
+    elapsed = time.perf_counter() - start
+
+    results = {}
+    for kind, values in sorted(latencies.items()):
+        results[kind] = {
+            'count': len(values),
+            'events_per_sec': len(values) / sum(values),
+            'p50_ms': percentile(values, 0.50) * 1000,
+            'p99_ms': percentile(values, 0.99) * 1000,
+            'regex_calls_per_event': regex_calls[kind] / len(values),
+        }
+
+    return {
+        'config': {
+            'rules': args.rules,
+            'regexes': args.regexes,
+            'users': args.users,
+            'events': args.events,
+            'hit_rate': args.hit_rate,
+            'seed': args.seed,
+            'storage': args.storage,
+            'regex_budget_ms': args.regex_budget_ms,
+            'python': platform.python_version(),
+        },
+        'total': {
+            'events_per_sec': len(events) / elapsed,
+            'storage_bytes_per_event': BytesWritten.total / len(events),
+            'rest_calls_per_event': (sum(fakes.rest_calls.values())
+                                     / len(events)),
+        },
+        'events': results,
+        'rest_calls': dict(sorted(fakes.rest_calls.items())),
+    }
+
+
+def print_results(results: dict):
+    config = results['config']
+    print(f'{config["rules"]} rules x {config["regexes"]} regexes, '
+          f'{config["users"]} users, {config["events"]} events, '
+          f'{config["storage"]} storage')
+    print(f'{"event":<10}{"count":>8}{"events/s":>12}{"p50 ms":>10}'
+          f'{"p99 ms":>10}{"regex/ev":>10}')
+    for kind, result in results['events'].items():
+        print(f'{kind:<10}{result["count"]:>8}'
+              f'{result["events_per_sec"]:>12.0f}{result["p50_ms"]:>10.3f}'
+              f'{result["p99_ms"]:>10.3f}'
+              f'{result["regex_calls_per_event"]:>10.2f}')
+    total = results['total']
+    print(f'total: {total["events_per_sec"]:.0f} events/s, '
+          f'{total["storage_bytes_per_event"]:.1f} storage bytes/event, '
+          f'{total["rest_calls_per_event"]:.2f} REST calls/event')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark rule evaluation, action execution and "
+                    "storage without a Discord connection")
+    parser.add_argument("--rules", type=int, default=300,
+                        help="number of MESSAGE, ACTIVITY and NAME rules")
+    parser.add_argument("--regexes", type=int, default=3,
+                        help="regexes per rule")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--words", type=int, default=5000,
+                        help="size of the vocabulary of events and rules")
+    parser.add_argument("--events", type=int, default=10000)
+    parser.add_argument("--hit-rate", type=float, default=0.05,
+                        help="fraction of texts that break a rule")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--storage", choices=("json", "sqlite"),
+                        default="json")
+    parser.add_argument("--regex-budget-ms", type=int, default=0,
+                        help="run regexes in the regex worker with this "
+                             "time budget, 0 runs them in process")
+    parser.add_argument("--json", metavar="PATH",
+                        help="write the results as JSON, - for stdout")
+    args = parser.parse_args()
+
+    # Only errors, e.g. of failing actions, are shown
+    logging.basicConfig()
+    logging.disable(logging.WARNING)
+
+    # The tables are opened when lajter is imported, so the storage is set
+    # up in an empty directory before that
+    output = os.path.abspath(args.json) if args.json not in (None, "-") \
+        else args.json
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        os.environ["STORAGE"] = args.storage
+        os.environ["DATABASE"] = os.path.join(directory, "bench.db")
+        try:
+            results = asyncio.run(run(args))
+        finally:
+            os.chdir(cwd)
+
+    if output == "-":
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    else:
+        print_results(results)
+        if output:
+            with open(output, "w") as f:
+                json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,183 @@
+import datetime
+import itertools
+from typing import Dict, List
+
+# Minimal stand-ins for the discord.py objects used by rules and actions.
+# Every REST call is a coroutine that does nothing and is only counted
+
+_ids = itertools.count(1)
+rest_calls: Dict[str, int] = {}
+
+
+def _rest(name: str):
+    rest_calls[name] = rest_calls.get(name, 0) + 1
+
+
+class FakeRole:
+    def __init__(self, guild: 'FakeGuild', role_id: int = None):
+        self.id = role_id or next(_ids)
+        self.guild = guild
+        self.name = f'role{self.id}'
+        self.mention = f'<@&{self.id}>'
+        self.permissions = FakePermissions()
+
+    def is_default(self) -> bool:
+        return self.id == self.guild.id
+
+
+class FakePermissions:
+    administrator = False
+
+
+class FakeActivity:
+    def __init__(self, name: str):
+        self.name = name
+
+
+class FakeAttachment:
+    def __init__(self, filename: str):
+        self.filename = filename
+
+
+class FakeMember:
+    def __init__(self, guild: 'FakeGuild', name: str, member_id: int = None):
+        self.id = member_id or next(_ids)
+        self.guild = guild
+        self.bot = False
+        self.display_name = name
+        self.name = name
+        self.mention = f'<@{self.id}>'
+        self.activities: List[FakeActivity] = []
+        self._roles: List[int] = []
+
+    @property
+    def roles(self) -> List[FakeRole]:
+        return [self.guild.default_role] + [self.guild.get_role(role_id)
+                                            for role_id in self._roles]
+
+    def get_role(self, role_id: int) -> FakeRole | None:
+        if role_id in self._roles:
+            return self.guild.get_role(role_id)
+        return None
+
+    async def edit(self, **changes):
+        _rest("member.edit")
+
+    async def add_roles(self, *roles):
+        _rest("member.add_roles")
+
+    async def remove_roles(self, *roles):
+        _rest("member.remove_roles")
+
+    async def timeout(self, duration):
+        _rest("member.timeout")
+
+    async def kick(self):
+        _rest("member.kick")
+
+
+class FakeChannel:
+    def __init__(self, guild: 'FakeGuild', channel_id: int = None):
+        self.id = channel_id or next(_ids)
+        self.guild = guild
+        self.mention = f'<#{self.id}>'
+
+    async def send(self, content: str = None, **kwargs) -> 'FakeMessage':
+        _rest("channel.send")
+        return FakeMessage(self, None, content or "")
+
+    async def delete_messages(self, messages):
+        _rest("channel.delete_messages")
+
+    def get_partial_message(self, message_id: int) -> 'FakeMessage':
+        return FakeMessage(self, None, "", message_id)
+
+
+class FakeMessage:
+    def __init__(self, channel: FakeChannel, author: FakeMember | None,
+                 content: str, message_id: int = None,
+                 attachments: List[FakeAttachment] = None):
+        self.id = message_id or next(_ids)
+        self.channel = channel
+        self.guild = channel.guild
+        self.author = author
+        self.content = content
+        self.attachments = attachments or []
+        self.reactions = []
+        self.created_at = datetime.datetime.now(datetime.timezone.utc)
+
+    async def delete(self, delay: float = None):
+        _rest("message.delete")
+
+    async def reply(self, content: str = None, **kwargs):
+        _rest("message.reply")
+
+    async def add_reaction(self, emoji):
+        _rest("message.add_reaction")
+
+
+class FakeReaction:
+    def __init__(self, message: FakeMessage, emoji: str):
+        self.message = message
+        self.emoji = emoji
+        self.count = 1
+
+
+class FakeGuild:
+    def __init__(self):
+        self.id = next(_ids)
+        self.owner_id = 0
+        self.default_role = FakeRole(self, self.id)
+        self._roles: Dict[int, FakeRole] = {self.id: self.default_role}
+        self._members: Dict[int, FakeMember] = {}
+        self._channels: Dict[int, FakeChannel] = {}
+
+    @property
+    def members(self) -> List[FakeMember]:
+        return list(self._members.values())
+
+    @property
+    def roles(self) -> List[FakeRole]:
+        return list(self._roles.values())
+
+    def add_role(self) -> FakeRole:
+        role = FakeRole(self)
+        self._roles[role.id] = role
+        return role
+
+    def add_member(self, name: str) -> FakeMember:
+        member = FakeMember(self, name)
+        self._members[member.id] = member
+        return member
+
+    def add_channel(self) -> FakeChannel:
+        channel = FakeChannel(self)
+        self._channels[channel.id] = channel
+        return channel
+
+    def get_role(self, role_id: int) -> FakeRole | None:
+        return self._roles.get(role_id)
+
+    def get_member(self, member_id: int) -> FakeMember | None:
+        return self._members.get(member_id)
+
+    async def fetch_member(self, member_id: int) -> FakeMember:
+        _rest("guild.fetch_member")
+        return self._members[member_id]
+
+
+class FakeBot:
+    def __init__(self, guild: FakeGuild):
+        self.guild = guild
+        self.user = FakeMember(guild, "bot")
+        self.user.bot = True
+
+    def get_guild(self, guild_id: int) -> FakeGuild | None:
+        return self.guild if guild_id == self.guild.id else None
+
+    def get_channel(self, channel_id: int) -> FakeChannel | None:
+        return self.guild._channels.get(channel_id)
+
+    async def fetch_channel(self, channel_id: int) -> FakeChannel:
+        _rest("bot.fetch_channel")
+        return self.guild._channels[channel_id]
@@ -0,0 +1,158 @@
+import random
+import string
+from typing import List, Tuple
+
+from benchmarks.fakes import (FakeGuild, FakeMember, FakeChannel, FakeMessage,
+                              FakeReaction, FakeAttachment)
+
+EVENT_KINDS = ("message", "presence", "name", "reaction", "points")
+EVENT_WEIGHTS = (60, 15, 5, 10, 10)
+EMOJIS = ("👍", "👎", "😂", "🔥", "💀", "🤡")
+
+
+def vocabulary(rng: random.Random, size: int) -> List[str]:
+    words = set()
+    while len(words) < size:
+        length = rng.randint(3, 10)
+        words.add("".join(rng.choices(string.ascii_lowercase, k=length)))
+    return sorted(words)
+
+
+# Regexes of the shapes rules are written with: plain words, words with
+# optional suffixes, case insensitive words, alternations and word prefixes
+def regex(rng: random.Random, words: List[str]) -> str:
+    word = rng.choice(words)
+    match rng.randrange(5):
+        case 0:
+            return word
+        case 1:
+            return rf'{word}\d*'
+        case 2:
+            return f'(?i){word}'
+        case 3:
+            return f'{word}|{rng.choice(words)}'
+        case _:
+            return rf'\b{word[:3]}\w+'
+
+
+class Workload:
+    def __init__(self, seed: int, rules: int, regexes: int, users: int,
+                 words: int):
+        self.rng = random.Random(seed)
+        self.words = vocabulary(self.rng, words)
+        self.rule_count = rules
+        self.regex_count = regexes
+        self.user_count = users
+
+        self.guild = FakeGuild()
+        self.channels = [self.guild.add_channel() for _ in range(5)]
+        self.roles = [self.guild.add_role() for _ in range(10)]
+        self.members: List[FakeMember] = []
+        for i in range(users):
+            member = self.guild.add_member(self.rng.choice(self.words))
+            roles = self.rng.sample(self.roles, self.rng.randint(0, 3))
+            member._roles = [role.id for role in roles]
+            self.members.append(member)
+
+        # Words used by rules, events include them to break rules
+        self.rule_words: List[str] = []
+
+    # Entries for the actions, rules and users tables
+    def actions(self) -> List[dict]:
+        role = self.roles[0]
+        return [
+            {'id': 1, 'type': "send message", 'value': ["Złamano zasadę"],
+             'target': [], 'public': False},
+            {'id': 2, 'type': "add points", 'value': ["-5"],
+             'target': [], 'public': False},
+            {'id': 3, 'type': "delete message", 'value': [],
+             'target': [], 'public': False},
+            {'id': 4, 'type': "give role", 'value': [role.mention],
+             'target': [], 'public': False},
+            {'id': 5, 'type': "chain", 'value': ["1", "2"],
+             'target': [], 'public': False},
+        ]
+
+    def rules(self) -> List[dict]:
+        entries = []
+        text_types = ("message", "activity", "name")
+        for i in range(self.rule_count):
+            rule_type = text_types[i % len(text_types)]
+            regexes = [regex(self.rng, self.words)
+                       for _ in range(self.regex_count)]
+            self.rule_words.extend(regex_word(r) for r in regexes)
+            entries.append(self._rule(rule_type, regexes))
+
+        # A few rules of the other types, as a real rule set has
+        for role in self.roles[:3]:
+            entries.append(self._rule(
+                "role", [role.mention, regex(self.rng, self.words)]))
+        for emoji in EMOJIS[2:4]:
+            entries.append(self._rule("reaction", [emoji]))
+        for threshold in (-500, 0, 50):
+            entries.append(self._rule("less points", [str(threshold)]))
+        for threshold in (1000, 5000, 20000):
+            entries.append(self._rule("more points",
+                                      [str(threshold)]))
+        for rule_id, entry in enumerate(entries, 1):
+            entry['id'] = rule_id
+        return entries
+
+    def _rule(self, rule_type: str, regexes: List[str]) -> dict:
+        return {'id': None, 'type': rule_type, 'regexes': regexes,
+                'actions': [self.rng.randint(1, 5)], 'public': False}
+
+    def users(self) -> List[dict]:
+        return [{'id': member.id, 'points': self.rng.randint(-100, 2000),
+                 'last_activity': "2024-01-01T00:00:00"}
+                for member in self.members]
+
+    def text(self, hit_rate: float) -> str:
+        words = self.rng.choices(self.words, k=self.rng.randint(3, 20))
+        if self.rule_words and self.rng.random() < hit_rate:
+            words.insert(self.rng.randrange(len(words) + 1),
+                         self.rng.choice(self.rule_words))
+        return " ".join(words)
+
+    # Stream of (kind, member, channel, message, reaction, points, text)
+    # events. The text of presence and name events is set on the member
+    # right before the event is handled
+    def events(self, count: int, hit_rate: float) -> List[Tuple]:
+        events = []
+        for kind in self.rng.choices(EVENT_KINDS, EVENT_WEIGHTS, k=count):
+            member = self.rng.choice(self.members)
+            channel: FakeChannel = self.rng.choice(self.channels)
+            message = reaction = text = None
+            points = 0
+            match kind:
+                case "message":
+                    attachments = []
+                    if self.rng.random() < 0.1:
+                        attachments.append(FakeAttachment(
+                            f'{self.rng.choice(self.words)}.png'))
+                    message = FakeMessage(channel, member,
+                                          self.text(hit_rate),
+                                          attachments=attachments)
+                case "presence" | "name":
+                    text = self.text(hit_rate)
+                case "reaction":
+                    message = FakeMessage(channel, member, self.text(0))
+                    reaction = FakeReaction(message, self.rng.choice(EMOJIS))
+                case "points":
+                    points = self.rng.randint(-300, 300)
+            events.append((kind, member, channel, message, reaction, points,
+                           text))
+        return events
+
+
+# A word the regex matches, so events can be made to break the rule
+def regex_word(pattern: str) -> str:
+    for prefix in ("(?i)", r"\b"):
+        if pattern.startswith(prefix):
+            pattern = pattern[len(prefix):]
+    word = pattern.split("|")[0]
+    if word.endswith(r"\d*"):
+        word = word[:-3]
+    elif word.endswith(r"\w+"):
+        word = word[:-3] + "x"
+    return word
@@ -1,6 +1,7 @@
 import asyncio
 import os
 import logging
+import signal
 
 from discord import Intents
 from discord.ext import commands
@@ -12,13 +13,37 @@ logger.setLevel(logging.DEBUG)
 load_dotenv()
 bot_key = os.getenv("BOT_KEY")
 
+# Imported after .env is loaded, the settings are read on first use
+import lajter.settings
+import lajter.user
+
 intents = Intents.all()
 
-bot = commands.Bot(command_prefix='!', intents=intents)
+
+class Bot(commands.Bot):
+    # Cogs are loaded on the loop the bot runs on, so the tasks and servers
+    # they start keep running
+    async def setup_hook(self):
+        await load_commands(self)
+
+    # Users changed since the last periodic flush are written on shutdown
+    async def close(self):
+        await super().close()
+        lajter.user.flush()
+
+
+bot = Bot(command_prefix='!', intents=intents)
+
+def reload_settings():
+    load_dotenv(override=True)
+    lajter.settings.reload()
 
 @bot.event
 async def on_ready():
     logger.info(f'Logged in as {bot.user}')
+    if hasattr(signal, "SIGHUP"):
+        asyncio.get_running_loop().add_signal_handler(
+            signal.SIGHUP, reload_settings)
 
 async def load_commands(bot):
     await bot.load_extension("lajter.cogs.rules")
@@ -26,8 +51,10 @@ async def load_commands(bot):
     await bot.load_extension("lajter.cogs.points")
     await bot.load_extension("lajter.cogs.fun")
     await bot.load_extension("lajter.cogs.admin")
-
-asyncio.run(load_commands(bot))
+    await bot.load_extension("lajter.cogs.polls")
+    await bot.load_extension("lajter.cogs.backfill")
+    await bot.load_extension("lajter.cogs.cache")
+    await bot.load_extension("lajter.cogs.metrics")
 
 bot.run(bot_key, root_logger=True)
 
@@ -1,29 +1,155 @@
 import asyncio
 import datetime
 import random
+import time
 import traceback
 from datetime import timedelta
 
 from discord import Member, TextChannel, Message
 from discord.ext import commands
-from tinydb import TinyDB, where
 import logging
 from enum import Enum
+from typing import Dict, List, Set
 
+import lajter.metrics as metrics
+import lajter.poll
+import lajter.storage
 import lajter.user
+from lajter.dispatch import dispatcher
 from lajter.utils import role_from_mention, member_from_mention
 
 logger = logging.getLogger('ACTION')
 logger.setLevel(logging.DEBUG)
 
 
+# Process-wide graph of actions, loaded from the database once. Every action
+# keeps its nested actions (CHAIN and RANDOM elements, POLL follow-up)
+# already resolved in Action.children, so executing it touches no storage
+_actions: Dict[int, 'Action'] | None = None
+_parents: Dict[int, Set[int]] = {}
+
+
+def _load() -> Dict[int, 'Action']:
+    global _actions
+    if _actions is None:
+        _actions = {}
+        for entry in Action.db.all():
+            action = from_entry(entry)
+            _actions[action.id] = action
+        for action in _actions.values():
+            _resolve(action)
+        for action in _actions.values():
+            if _find_cycle(action.id, action.child_ids()):
+                logger.error(f'Action {action.id} is part of a cycle, '
+                             f'its nested actions will be skipped')
+                action.children = []
+    return _actions
+
+
+def _resolve(action: 'Action'):
+    action.children = []
+    for child_id in action.child_ids():
+        child = _actions.get(child_id)
+        if child is None:
+            logger.warning(f'Action {action.id} refers to missing '
+                           f'action {child_id}')
+            continue
+        action.children.append(child)
+        _parents.setdefault(child_id, set()).add(action.id)
+
+
+def _find_cycle(action_id: int, child_ids: List[int]) -> bool:
+    visited = set()
+    stack = list(child_ids)
+    while stack:
+        child_id = stack.pop()
+        if child_id == action_id:
+            return True
+        if child_id in visited or child_id not in _actions:
+            continue
+        visited.add(child_id)
+        stack.extend(_actions[child_id].child_ids())
+    return False
+
+
 def get_by_id(id):
-    entries = Action.db.search(where('id') == id)
-    if len(entries) > 0:
-        return from_entry(entries[0])
+    return _load().get(id)
+
+
+# Actions of one event are run in phases, the actions within a phase run
+# concurrently. Points are changed before anything else and the member is
+# kicked or banned only after everything else was done to them
+def _phase(action: 'Action') -> int:
+    match action.action_type:
+        case ActionType.ADD_POINTS:
+            return 0
+        case ActionType.KICK | ActionType.BAN:
+            return 2
+    return 1
+
+
+async def execute_all(
+        actions: List['Action'],
+        bot: commands.Bot = None,
+        member: Member = None,
+        db_user: lajter.user.User = None,
+        channel: TextChannel = None,
+        message: Message = None
+):
+    phases = [[], [], []]
+    for action in actions:
+        phases[_phase(action)].append(action)
+
+    # Action.execute reports its own errors, so one failing action doesn't
+    # cancel the others
+    for phase in phases:
+        if not phase:
+            continue
+        async with asyncio.TaskGroup() as group:
+            for action in phase:
+                group.create_task(
+                    action.execute(bot, member, db_user, channel, message))
+
+
+def get_all() -> List['Action']:
+    return sorted(_load().values(), key=lambda action: action.id)
+
+
+def get_parents(action_id: int) -> List['Action']:
+    _load()
+    return [_actions[parent_id]
+            for parent_id in sorted(_parents.get(action_id, ()))]
+
+
+def validate(action: 'Action') -> str | None:
+    actions = _load()
+    try:
+        child_ids = action.child_ids(strict=True)
+    except ValueError:
+        return "Numery akcji muszą być liczbami"
+
+    for child_id in child_ids:
+        if child_id == action.id:
+            return "Akcja nie może wykonywać samej siebie"
+        if child_id not in actions:
+            return f'Nie ma akcji o id {child_id}'
+
+    if action.id is not None and _find_cycle(action.id, child_ids):
+        return "Akcje nie mogą tworzyć cyklu"
     return None
 
 
+def remove(action_id: int):
+    actions = _load()
+    Action.db.remove(action_id)
+    action = actions.pop(action_id, None)
+    if action:
+        for child in action.children:
+            _parents.get(child.id, set()).discard(action_id)
+        for parent_id in _parents.pop(action_id, set()):
+            _resolve(actions[parent_id])
+
+
 def from_entry(entry):
     try:
         return Action(
@@ -56,7 +182,7 @@ class ActionType(Enum):
     CHAIN = "chain"
 
 class Action:
-    db = TinyDB("actions.json")
+    db = lajter.storage.open_storage("actions")
 
     def __init__(self, action_type: ActionType | str, action_id=None,
                  value=None, target=None, public=False):
@@ -82,25 +208,48 @@ class Action:
         else:
             self.public = bool(public)
 
+        self.children: List[Action] = []
+
+    def child_ids(self, strict=False) -> List[int]:
+        match self.action_type:
+            case ActionType.CHAIN | ActionType.RANDOM:
+                values = self.value
+            case ActionType.POLL:
+                values = self.value[:1]
+            case _:
+                values = []
+
+        child_ids = []
+        for value in values:
+            try:
+                child_ids.append(int(value))
+            except ValueError:
+                if strict:
+                    raise
+        return child_ids
+
     def save(self):
+        _load()
+        entry = {
+            'id': self.id,
+            'type': self.action_type.value,
+            'value': self.value,
+            'target': self.target,
+            'public': self.public
+        }
         if self.id is None:
-            self.id = Action.db.insert({
-                'id': 'null',
-                'type': self.action_type.value,
-                'value': self.value,
-                'target': self.target,
-                'public': self.public
-            })
-
-            Action.db.update({'id': self.id}, doc_ids=[self.id])
+            self.id = Action.db.insert(entry)
         else:
-            Action.db.upsert({
-                'id': self.id,
-                'type': self.action_type.value,
-                'value': self.value,
-                'target': self.target,
-                'public': self.public
-            }, where('id') == self.id)
+            Action.db.upsert(entry)
+
+        old_action = _actions.get(self.id)
+        if old_action:
+            for child in old_action.children:
+                _parents.get(child.id, set()).discard(self.id)
+        _actions[self.id] = self
+        _resolve(self)
+        for parent_id in _parents.get(self.id, ()):
+            _resolve(_actions[parent_id])
 
     def to_string(self) -> str:
         s = ""
@@ -152,9 +301,8 @@ class Action:
                 s += "."
                 if self.value:
                     s += " Jeśli głosowanie przejdzie, wykonaj akcję: "
-                    action_to_execute = get_by_id(int(self.value[0]))
-                    if action_to_execute:
-                        s += action_to_execute.to_string()
+                    if self.children:
+                        s += self.children[0].to_string()
                     else:
                         s += "Błędna akcja"
                     s += "."
@@ -166,13 +314,11 @@ class Action:
                     s += f'{value}, '
             case ActionType.CHAIN:
                 s += "Wykonaj po kolei akcje: "
-                for value in self.value:
-                    action_to_execute = get_by_id(int(value))
-                    if action_to_execute:
-                        s += action_to_execute.to_string()
-                    else:
-                        s += "Błędna akcja"
+                for action_to_execute in self.children:
+                    s += action_to_execute.to_string()
                     s += ", "
+                if len(self.children) < len(self.value):
+                    s += "Błędna akcja, "
 
         return s
     async def execute(
@@ -183,27 +329,30 @@ class Action:
             channel: TextChannel = None,
             message: Message = None,
     ):
-        if channel is None:
-            channel = await lajter.utils.get_default_channel(bot)
+        start = time.perf_counter()
+        try:
+            if channel is None:
+                channel = await lajter.utils.get_default_channel(bot)
 
-        if db_user is None and member:
-            db_user = lajter.user.get_by_id(member.id)
+            if db_user is None and member:
+                db_user = lajter.user.get_by_id(member.id)
 
-        try:
             match self.action_type:
                 case ActionType.SEND_MESSAGE:
                     if self.target:
                         for target in self.target:
-                            target_channel = await bot.fetch_channel(target)
-                            await target_channel.send(self.value[0])
+                            target_channel = await lajter.utils.resolve_channel(
+                                bot, int(target))
+                            await dispatcher.send_message(target_channel,
+                                                          self.value[0])
                     elif channel:
-                        await channel.send(self.value[0])
+                        await dispatcher.send_message(channel, self.value[0])
                 case ActionType.DELETE_MESSAGE:
                     if message:
                         if self.value:
                             await message.delete(delay=float(self.value[0]))
                         else:
-                            await message.delete()
+                            await dispatcher.delete_message(message)
                 case ActionType.GIVE_ROLE:
                     if member and self.value:
                         role = role_from_mention(member.guild, self.value[0])
@@ -211,7 +360,7 @@ class Action:
                         if self.target:
                             target = await member_from_mention(
                                 member.guild, self.target[0])
-                        await target.add_roles(role)
+                        await dispatcher.add_roles(target, role)
                 case ActionType.REMOVE_ROLE:
                     if member and self.value:
                         role = role_from_mention(member.guild, self.value[0])
@@ -219,22 +368,24 @@ class Action:
                         if self.target:
                             target = await member_from_mention(
                                 member.guild, self.target[0])
-                        await target.remove_roles(role)
+                        await dispatcher.remove_roles(target, role)
                 case ActionType.TIMEOUT:
                     if member and self.value:
-                        time = float(self.value[0])
+                        seconds = float(self.value[0])
                         target = member
                         if self.target:
                             target = await member_from_mention(
                                 member.guild, self.target[0])
-                        await target.timeout(timedelta(seconds=time))
+                        with metrics.rest("member.timeout"):
+                            await target.timeout(timedelta(seconds=seconds))
                 case ActionType.KICK:
                     if member:
                         target = member
                         if self.target:
                             target = await member_from_mention(
                                 member.guild, self.target[0])
-                        await target.kick()
+                        with metrics.rest("member.kick"):
+                            await target.kick()
                 case ActionType.BAN:
                     if member:
                         target = member
@@ -242,11 +393,12 @@ class Action:
                         if self.target:
                             target = await member_from_mention(
                                 member.guild, self.target[0])
-                        await target.add_roles(ban_role)
-                        await channel.send(f'{member.mention} Bardzo się '
-                                           f'starałeś, ale z gry wyleciałeś. '
-                                           f'punkty: {db_user.points}')
-                        print(lajter.user.User.db.remove(where('id') == db_user.id))
+                        await dispatcher.add_roles(target, ban_role)
+                        await dispatcher.send_message(
+                            channel, f'{member.mention} Bardzo się '
+                                     f'starałeś, ale z gry wyleciałeś. '
+                                     f'punkty: {db_user.points}')
+                        lajter.user.remove(db_user.id)
                         db_user = None
                 case ActionType.CHANGE_NAME:
                     if member and self.value:
@@ -254,23 +406,28 @@ class Action:
                         if self.target:
                             target = await member_from_mention(
                                 member.guild, self.target[0])
-                        await target.edit(nick=self.value[0])
+                        await dispatcher.change_nick(target, self.value[0])
                 case ActionType.ADD_POINTS:
                     if db_user and self.value:
-                        target = db_user
+                        target_id = db_user.id
                         if self.target:
-                            target = await member_from_mention(
-                                member.guild, self.target[0])
-                            target = lajter.user.get_by_id(target.id)
-                        target.points += int(self.value[0])
+                            target_id = (await member_from_mention(
+                                member.guild, self.target[0])).id
+                        # Actions run outside of the unit of work of the
+                        # event, the points are changed in one of their own
+                        async with lajter.user.unit_of_work(target_id) as (
+                                target,):
+                            if target:
+                                target.points += int(self.value[0])
                 case ActionType.POLL:
                     if member and channel:
                         target = member
                         target_channel = channel
 
                         if self.target:
-                            target_channel = await bot.fetch_channel(
-                                self.target[0][2:-1])
+                            target_channel = await lajter.utils.resolve_channel(
+                                bot, lajter.utils.channel_id_from_mention(
+                                    self.target[0]))
 
                         if len(self.target) > 1:
                             target = await member_from_mention(
@@ -279,8 +436,8 @@ class Action:
                         timeout = timedelta(minutes=5)
                         action_to_execute = None
 
-                        if self.value:
-                            action_to_execute = get_by_id(int(self.value[0]))
+                        if self.children:
+                            action_to_execute = self.children[0]
                         if len(self.value) > 1:
                             timeout = timedelta(seconds=int(self.value[1]))
 
@@ -295,49 +452,40 @@ class Action:
                         s += ".\n"
                         s += f' Głosowanie potrwa do `{vote_until.hour}:{vote_until.minute}`'
 
-                        poll = await target_channel.send(s)
+                        with metrics.rest("channel.send"):
+                            poll = await target_channel.send(s)
+                        # The polls cog finishes the poll once it's decided
+                        # or its deadline passes, the event is not held up
+                        # until then. It's stored before the reactions are
+                        # added, so no vote is missed
+                        lajter.poll.Poll(
+                            lajter.poll.PollKind.ACTION,
+                            target_channel.id,
+                            poll.id,
+                            vote_until,
+                            origin_id=channel.id,
+                            target_id=target.id,
+                            action_id=(action_to_execute.id
+                                       if action_to_execute else None)
+                        ).save()
                         await poll.add_reaction("👍")
                         await poll.add_reaction("👎")
-
-                        await asyncio.sleep(timeout.seconds)
-
-                        poll = await target_channel.fetch_message(poll.id)
-
-                        result = 0
-
-                        for reaction in poll.reactions:
-                            if reaction.emoji == "👍":
-                                result += reaction.count
-                            elif reaction.emoji == "👎":
-                                result -= reaction.count
-
-                        if result > 0:
-                            await poll.reply(f'Głosowanie przeciwko '
-                                             f'{target.mention} przeszło '
-                                             f'większością głosów.')
-                            if action_to_execute:
-                                if target != member:
-                                    db_user = lajter.user.get_by_id(target.id)
-                                await action_to_execute.execute(
-                                    bot, target, db_user, channel)
-                        else:
-                            await poll.reply(f'Głosowanie przeciwko '
-                                             f'{target.mention} nie uzyskało '
-                                             f'większości głosów.')
                 case ActionType.RANDOM:
-                    if self.value:
-                        random_action = random.choice(self.value)
-                        random_action = get_by_id(int(random_action))
+                    if self.children:
+                        random_action = random.choice(self.children)
                         await random_action.execute(bot, member, db_user,
                                                     channel, message)
                 case ActionType.CHAIN:
-                    if self.value:
-                        for action_id in self.value:
-                            action = get_by_id(int(action_id))
-                            await action.execute(bot, member, db_user,
-                                                 channel,message)
+                    for action in self.children:
+                        await action.execute(bot, member, db_user,
+                                             channel, message)
 
         except Exception:
-            logger.error(f'Failed to execute action: {traceback.format_exc()}')
-        if db_user:
-            db_user.save()
+            metrics.inc("lajter_action_failures_total",
+                        type=self.action_type.value)
+            logger.error(f'Failed to execute action {self.id}: '
+                         f'{traceback.format_exc()}')
+        finally:
+            metrics.observe("lajter_action_seconds",
+                            time.perf_counter() - start,
+                            type=self.action_type.value)
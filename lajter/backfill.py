@@ -0,0 +1,154 @@
+import asyncio
+import datetime
+from enum import Enum
+from typing import Dict, List
+
+from discord import Guild
+
+import lajter.storage
+
+# Scans of the message history for rules added after the messages were
+# sent. A scan keeps only its position and counts, and saves them after
+# every page, so it needs the same memory however long the history is and
+# continues where it stopped when the bot is restarted. The backfills cog
+# runs one scan at a time
+_backfills: Dict[int, 'Backfill'] | None = None
+_started = asyncio.Event()
+
+
+def _load() -> Dict[int, 'Backfill']:
+    global _backfills
+    if _backfills is None:
+        _backfills = {}
+        for entry in Backfill.db.all():
+            backfill = from_entry(entry)
+            _backfills[backfill.id] = backfill
+    return _backfills
+
+
+def get_by_id(backfill_id: int) -> 'Backfill | None':
+    return _load().get(backfill_id)
+
+
+# Oldest first, in the order they are run
+def get_all() -> List['Backfill']:
+    return sorted(_load().values(), key=lambda backfill: backfill.id)
+
+
+def remove(backfill_id: int):
+    _load().pop(backfill_id, None)
+    Backfill.db.remove(backfill_id)
+
+
+# Waits until there is a scan to run
+async def wait():
+    while not _load():
+        _started.clear()
+        await _started.wait()
+
+
+def start(
+        rule_id: int,
+        mode: 'BackfillMode',
+        guild: Guild,
+        report_channel_id: int,
+        cap: int,
+        after: datetime.datetime | None = None
+) -> 'Backfill':
+    # Every text channel whose history the bot can read, oldest first
+    channels = [channel.id for channel in
+                sorted(guild.text_channels, key=lambda channel: channel.id)
+                if channel.permissions_for(guild.me).read_message_history]
+    backfill = Backfill(rule_id, mode, report_channel_id, cap, channels,
+                        after=after)
+    backfill.save()
+    return backfill
+
+
+def from_entry(entry) -> 'Backfill':
+    after = entry.get('after')
+    return Backfill(
+        entry['rule'],
+        entry['mode'],
+        entry['report_channel'],
+        entry['cap'],
+        entry['channels'],
+        entry['before'],
+        datetime.datetime.fromisoformat(after) if after else None,
+        entry['scanned'],
+        entry['matched'],
+        entry['executed'],
+        # Keys of JSON objects are strings
+        {int(user_id): count
+         for user_id, count in entry['violators'].items()},
+        entry['id']
+    )
+
+
+class BackfillMode(Enum):
+    # Messages breaking the rule are only counted and reported
+    REPORT = "report"
+    # The rule's actions are also executed, for at most cap messages
+    EXECUTE = "execute"
+
+
+class Backfill:
+    db = lajter.storage.open_storage("backfills")
+
+    def __init__(self, rule_id: int, mode: BackfillMode | str,
+                 report_channel_id: int, cap: int, channels: List[int],
+                 before: int = None, after: datetime.datetime = None,
+                 scanned: int = 0, matched: int = 0, executed: int = 0,
+                 violators: Dict[int, int] = None, backfill_id=None):
+        self.id = backfill_id
+        self.rule_id = rule_id
+
+        if type(mode) is str:
+            self.mode: BackfillMode = BackfillMode(mode)
+        else:
+            self.mode = mode
+
+        self.report_channel_id = report_channel_id
+        self.cap = cap
+        # Channels left to scan, the first one is being scanned from the
+        # newest message down to the message before
+        self.channels = channels
+        self.before = before
+        # Messages older than this are not scanned
+        self.after = after
+        self.scanned = scanned
+        self.matched = matched
+        self.executed = executed
+        # Messages breaking the rule by author, bounded by the number of
+        # members and not by the length of the history
+        self.violators: Dict[int, int] = violators or {}
+
+    # The scan moves on to the next channel, the history of the current one
+    # was scanned
+    def next_channel(self):
+        self.channels.pop(0)
+        self.before = None
+
+    def save(self):
+        backfills = _load()
+        entry = {
+            'id': self.id,
+            'rule': self.rule_id,
+            'mode': self.mode.value,
+            'report_channel': self.report_channel_id,
+            'cap': self.cap,
+            'channels': self.channels,
+            'before': self.before,
+            'after': self.after.isoformat() if self.after else None,
+            'scanned': self.scanned,
+            'matched': self.matched,
+            'executed': self.executed,
+            'violators': self.violators
+        }
+        if self.id is None:
+            self.id = Backfill.db.insert(entry)
+        else:
+            Backfill.db.upsert(entry)
+
+        backfills[self.id] = self
+        _started.set()
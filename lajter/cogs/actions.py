@@ -2,8 +2,6 @@ import logging
 from typing import Tuple
 
 from discord.ext import commands
-from tinydb import where
-
 import lajter.action
 from lajter.action import Action
 import lajter.utils as utils
@@ -57,6 +55,12 @@ class Actions(commands.Cog):
 
         action = Action(flags.action_type, value=list(flags.value),
                         target=list(flags.target), public=flags.public)
+
+        error = lajter.action.validate(action)
+        if error:
+            await ctx.send(error)
+            return
+
         action.save()
         logger.info(f'{ctx.author} utworzył akcję: {action.to_string()}')
         await ctx.send(
@@ -76,11 +80,16 @@ class Actions(commands.Cog):
             await ctx.send("Nie ma akcji o podanym id")
             return
 
+        # Edits are made on a copy, so a rejected edit leaves the action
+        # graph untouched
+        action = Action(action.action_type, action.id, list(action.value),
+                        list(action.target), action.public)
+
         if flags.public:
             action.public = flags.public
 
         if flags.action_type is not None:
-            action.rule_type = lajter.rule.Action(flags.action_type)
+            action.action_type = lajter.action.ActionType(flags.action_type)
 
         if len(flags.value) > 0:
             action.value = list(flags.value)
@@ -88,6 +97,11 @@ class Actions(commands.Cog):
         if len(flags.target) > 0:
             action.target = list(flags.target)
 
+        error = lajter.action.validate(action)
+        if error:
+            await ctx.send(error)
+            return
+
         action.save()
         logger.info(f'{ctx.author} nadpisał akcję: {action.to_string()}')
         await ctx.send(
@@ -96,7 +110,13 @@ class Actions(commands.Cog):
     @commands.command(name="delaction")
     @commands.has_guild_permissions(administrator=True)
     async def remove_action(self, ctx: commands.Context, action_id: int):
-        Action.db.remove(doc_ids=[action_id])
+        parents = lajter.action.get_parents(action_id)
+        if parents:
+            await ctx.send(f'Akcja jest używana przez akcje: '
+                           f'{[parent.id for parent in parents]}')
+            return
+
+        lajter.action.remove(action_id)
         logger.info(f'{ctx.author} usunął akcję: {action_id}')
         await ctx.send(f'Usunięto akcję nr **{action_id}**')
 
@@ -104,8 +124,7 @@ class Actions(commands.Cog):
     @commands.has_guild_permissions(administrator=True)
     async def read_actions(self, ctx: commands.Context):
         actions = ""
-        for action_entry in Action.db.all():
-            action = lajter.action.from_entry(action_entry)
+        for action in lajter.action.get_all():
             actions += f'**{action.id}:** '
             actions += action.to_string()
             actions += "\n"
@@ -115,8 +134,9 @@ class Actions(commands.Cog):
     @commands.cooldown(3, 30)
     async def read_public_actions(self, ctx: commands.Context):
         actions = ""
-        for action_entry in Action.db.search(where('public') == True):
-            action = lajter.action.from_entry(action_entry)
+        for action in lajter.action.get_all():
+            if not action.public:
+                continue
             actions += f'**{action.id}:** '
             actions += action.to_string()
             actions += "\n"
@@ -2,6 +2,7 @@ import logging
 
 import lajter.user
 from lajter.action import Action, ActionType
+from lajter.cogs.rules import handle_points_changes
 from discord.ext import commands
 from discord import Member
 
@@ -23,9 +24,16 @@ class Admin(commands.Cog):
         await action.execute(self.bot, member)
 
 
+    @commands.command(name="flush")
+    @commands.has_guild_permissions(administrator=True)
+    async def flush_users(self, ctx: commands.Context):
+        lajter.user.flush()
+        await ctx.reply("Zapisano użytkowników")
+
     @commands.command(name="addpoints")
     @commands.has_guild_permissions(administrator=True)
     async def admin_add_points(self, ctx: commands.Context, member: Member, amount: int):
-        db_user = lajter.user.get_by_id(member.id)
-        db_user.points += amount
-        db_user.save()
+        async with lajter.user.unit_of_work(member.id) as (db_user,):
+            if db_user:
+                db_user.points += amount
+        await handle_points_changes(self.bot, member, ctx.channel)
@@ -0,0 +1,265 @@
+import asyncio
+import datetime
+import logging
+import traceback
+from typing import List
+
+import discord
+import discord.utils
+from discord.ext import commands
+
+import lajter.backfill
+import lajter.metrics as metrics
+import lajter.rule
+import lajter.settings
+import lajter.user
+import lajter.utils as utils
+from lajter.backfill import Backfill, BackfillMode
+from lajter.rule import Rule, RuleType
+
+logger = logging.getLogger('BACKFILL')
+logger.setLevel(logging.DEBUG)
+
+# Messages fetched in one request, the most Discord returns
+PAGE_SIZE = 100
+# Pause between pages, the scan leaves most of the rate limit to the
+# events of the guild
+PAGE_DELAY = 1.0
+# Pause before a scan that failed is continued
+RETRY_DELAY = 60
+# Number of violators listed in the report
+REPORT_TOP = 10
+
+async def setup(bot: commands.Bot):
+    await bot.add_cog(Backfills(bot))
+
+
+# Starts a scan of the history for the rule, returns the reply for whoever
+# started it
+async def start_backfill(
+        bot: commands.Bot,
+        rule: Rule,
+        mode: str,
+        report_channel_id: int,
+        days: int = 0
+) -> str:
+    if rule.rule_type is not RuleType.MESSAGE:
+        return "Historię można przejrzeć tylko dla zasad typu `message`"
+    try:
+        mode = BackfillMode(mode)
+    except ValueError:
+        return "Tryb musi mieć wartość `report` albo `execute`"
+
+    after = None
+    if days > 0:
+        after = discord.utils.utcnow() - datetime.timedelta(days=days)
+
+    guild = await utils.get_default_guild(bot)
+    backfill = lajter.backfill.start(
+        rule.id, mode, guild, report_channel_id,
+        lajter.settings.get().backfill_cap, after)
+    logger.info(f'Started backfill {backfill.id} of rule {rule.id} '
+                f'in {mode.value} mode')
+    return (f'Rozpoczęto przeglądanie historii dla zasady nr **{rule.id}**, '
+            f'skan nr **{backfill.id}**')
+
+
+class Backfills(commands.Cog):
+
+    def __init__(self, bot):
+        self.bot: commands.Bot = bot
+        self.backfill_task: asyncio.Task | None = None
+
+    @commands.Cog.listener()
+    async def on_ready(self):
+        # Scans stopped by a restart are continued from their saved position
+        if self.backfill_task is None:
+            self.backfill_task = asyncio.create_task(self.run_backfills())
+
+    async def cog_unload(self):
+        if self.backfill_task:
+            self.backfill_task.cancel()
+
+    # Scans are run one at a time, in the order they were started
+    async def run_backfills(self):
+        while True:
+            await lajter.backfill.wait()
+            backfill = lajter.backfill.get_all()[0]
+            try:
+                await self.run_backfill(backfill)
+            except Exception:
+                logger.error(f'Backfill {backfill.id} failed, retrying in '
+                             f'{RETRY_DELAY} seconds: '
+                             f'{traceback.format_exc()}')
+                await asyncio.sleep(RETRY_DELAY)
+
+    # Pages are scanned until the history ends or the scan is stopped by
+    # !stopbackfill
+    def running(self, backfill: Backfill) -> bool:
+        return lajter.backfill.get_by_id(backfill.id) is backfill
+
+    async def run_backfill(self, backfill: Backfill):
+        while backfill.channels and self.running(backfill):
+            # The rule may have been removed or quarantined in the meantime
+            rule = lajter.rule.get_by_id(backfill.rule_id)
+            if rule is None or rule.quarantined:
+                await self.finish_backfill(backfill, interrupted=True)
+                return
+
+            try:
+                channel = await utils.resolve_channel(
+                    self.bot, backfill.channels[0])
+                before = discord.Object(backfill.before) \
+                    if backfill.before else None
+                messages = [message async for message in channel.history(
+                    limit=PAGE_SIZE, before=before, after=backfill.after,
+                    oldest_first=False)]
+            except (discord.NotFound, discord.Forbidden):
+                logger.warning(f'Skipping channel {backfill.channels[0]} '
+                               f'of backfill {backfill.id}')
+                backfill.next_channel()
+                backfill.save()
+                continue
+
+            await self.check_messages(backfill, rule, messages)
+            backfill.scanned += len(messages)
+            metrics.inc("lajter_backfill_messages_total", len(messages))
+
+            if len(messages) < PAGE_SIZE:
+                backfill.next_channel()
+            else:
+                backfill.before = messages[-1].id
+
+            if not self.running(backfill):
+                return
+            backfill.save()
+            await asyncio.sleep(PAGE_DELAY)
+
+        if self.running(backfill):
+            await self.finish_backfill(backfill)
+
+    # The rule's regexes are run over the whole page at once, in a single
+    # question to the regex worker when the guard is on
+    async def check_messages(self, backfill: Backfill, rule: Rule,
+                             messages: List[discord.Message]):
+        messages = [message for message in messages
+                    if not message.author.bot]
+        matched = await rule.search_each(
+            [lajter.rule.event_texts(RuleType.MESSAGE, message=message)
+             for message in messages])
+        for message, broken in zip(messages, matched):
+            if broken:
+                await self.record_match(backfill, rule, message)
+
+    async def record_match(self, backfill: Backfill, rule: Rule,
+                           message: discord.Message):
+        backfill.matched += 1
+        backfill.violators[message.author.id] = \
+            backfill.violators.get(message.author.id, 0) + 1
+        metrics.inc("lajter_backfill_matches_total")
+
+        if (backfill.mode is not BackfillMode.EXECUTE
+                or backfill.executed >= backfill.cap):
+            return
+
+        try:
+            member = await utils.resolve_member(
+                message.guild, message.author.id)
+        except discord.NotFound:
+            return
+        # Like on new messages, admins and banned users are left alone
+        if utils.immune(member) or utils.is_banned(member):
+            return
+
+        # The rules cog imports this module
+        from lajter.cogs.rules import handle_points_changes
+
+        backfill.executed += 1
+        await rule.execute(self.bot, member, lajter.user.get_by_id(member.id),
+                           message.channel, message)
+        await handle_points_changes(self.bot, member, message.channel,
+                                    message)
+
+    async def finish_backfill(self, backfill: Backfill,
+                              interrupted: bool = False):
+        lajter.backfill.remove(backfill.id)
+        logger.info(f'Finished backfill {backfill.id}: scanned '
+                    f'{backfill.scanned} messages, {backfill.matched} '
+                    f'matched')
+
+        if interrupted:
+            s = (f'Przerwano przeglądanie historii dla zasady nr '
+                 f'**{backfill.rule_id}**, zasada została usunięta lub '
+                 f'wstrzymana. ')
+        else:
+            s = (f'Zakończono przeglądanie historii dla zasady nr '
+                 f'**{backfill.rule_id}**. ')
+        s += (f'Przejrzano {backfill.scanned} wiadomości, '
+              f'{backfill.matched} z nich łamie zasadę')
+        if backfill.mode is BackfillMode.EXECUTE:
+            s += (f', akcje wykonano {backfill.executed} razy '
+                  f'(limit {backfill.cap})')
+
+        top = sorted(backfill.violators.items(),
+                     key=lambda item: item[1], reverse=True)[:REPORT_TOP]
+        if top:
+            s += "\nNajczęściej łamali ją: "
+            s += ", ".join(f'<@{user_id}> ({count})'
+                           for user_id, count in top)
+
+        try:
+            channel = await utils.resolve_channel(
+                self.bot, backfill.report_channel_id)
+        except discord.NotFound:
+            channel = await utils.get_default_channel(self.bot)
+        if channel is not None:
+            await channel.send(
+                s, allowed_mentions=discord.AllowedMentions.none())
+
+
+    @commands.command(
+        name="backfill",
+        brief="Przejrzyj historię wiadomości dla zasady",
+        help="<id zasady> [report|execute] [liczba dni, 0 - cała historia]"
+    )
+    @commands.has_guild_permissions(administrator=True)
+    async def backfill(self, ctx: commands.Context, rule_id: int,
+                       mode: str = "report", days: int = 0):
+        rule = lajter.rule.get_by_id(rule_id)
+        if rule is None:
+            await ctx.reply("Nie ma zasady o podanym id")
+            return
+
+        await ctx.reply(await start_backfill(
+            self.bot, rule, mode, ctx.channel.id, days))
+
+
+    @commands.command(name="backfills", brief="Wyświetl trwające skany "
+                                              "historii")
+    @commands.has_guild_permissions(administrator=True)
+    async def read_backfills(self, ctx: commands.Context):
+        backfills = lajter.backfill.get_all()
+        if not backfills:
+            await ctx.reply("Nie trwa żaden skan historii")
+            return
+
+        s = ""
+        for backfill in backfills:
+            s += (f'**{backfill.id}**: zasada nr {backfill.rule_id}, '
+                  f'tryb `{backfill.mode.value}`, przejrzano '
+                  f'{backfill.scanned} wiadomości, {backfill.matched} '
+                  f'łamie zasadę, pozostało kanałów: '
+                  f'{len(backfill.channels)}\n')
+        await ctx.reply(s)
+
+
+    @commands.command(name="stopbackfill", brief="Zatrzymaj skan historii")
+    @commands.has_guild_permissions(administrator=True)
+    async def stop_backfill(self, ctx: commands.Context, backfill_id: int):
+        if lajter.backfill.get_by_id(backfill_id) is None:
+            await ctx.reply("Nie ma skanu o podanym id")
+            return
+
+        lajter.backfill.remove(backfill_id)
+        logger.info(f'{ctx.author} zatrzymał skan historii: {backfill_id}')
+        await ctx.reply(f'Zatrzymano skan nr **{backfill_id}**')
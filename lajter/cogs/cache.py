@@ -0,0 +1,64 @@
+import discord
+from discord.ext import commands
+
+import lajter.utils
+
+async def setup(bot: commands.Bot):
+    await bot.add_cog(Cache(bot))
+
+# Drops channels and members fetched over REST by the resolvers in
+# lajter.utils, and cached immunity of members, as soon as the gateway
+# reports a change to them
+class Cache(commands.Cog):
+
+    def __init__(self, bot):
+        self.bot: commands.Bot = bot
+
+    async def cog_unload(self):
+        lajter.utils.channel_cache.clear()
+        lajter.utils.member_cache.clear()
+        lajter.utils.clear_immunity()
+
+    @commands.Cog.listener()
+    async def on_guild_channel_update(self, before: discord.abc.GuildChannel,
+                                      after: discord.abc.GuildChannel):
+        lajter.utils.channel_cache.invalidate(after.id)
+
+    @commands.Cog.listener()
+    async def on_guild_channel_delete(self, channel: discord.abc.GuildChannel):
+        lajter.utils.channel_cache.invalidate(channel.id)
+
+    @commands.Cog.listener()
+    async def on_member_join(self, member: discord.Member):
+        lajter.utils.member_cache.invalidate((member.guild.id, member.id))
+
+    @commands.Cog.listener()
+    async def on_member_update(self, before: discord.Member,
+                               after: discord.Member):
+        lajter.utils.member_cache.invalidate((after.guild.id, after.id))
+        if before.roles != after.roles:
+            lajter.utils.forget_immunity(after.id)
+
+    @commands.Cog.listener()
+    async def on_raw_member_remove(self, payload: discord.RawMemberRemoveEvent):
+        lajter.utils.member_cache.invalidate((payload.guild_id,
+                                              payload.user.id))
+        lajter.utils.forget_immunity(payload.user.id)
+
+    # Administrator permissions of a role or the owner of the guild may have
+    # changed, which affects the immunity of many members at once
+    @commands.Cog.listener()
+    async def on_guild_role_update(self, before: discord.Role,
+                                   after: discord.Role):
+        if before.permissions != after.permissions:
+            lajter.utils.clear_immunity()
+
+    @commands.Cog.listener()
+    async def on_guild_role_delete(self, role: discord.Role):
+        lajter.utils.clear_immunity()
+
+    @commands.Cog.listener()
+    async def on_guild_update(self, before: discord.Guild,
+                              after: discord.Guild):
+        if before.owner_id != after.owner_id:
+            lajter.utils.clear_immunity()
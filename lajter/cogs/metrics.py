@@ -0,0 +1,115 @@
+import logging
+from typing import Dict, List, Tuple
+
+from aiohttp import web
+from discord.ext import commands
+
+import lajter.metrics as metrics
+import lajter.settings
+
+logger = logging.getLogger('METRICS')
+logger.setLevel(logging.DEBUG)
+
+# Number of entries listed in every section of !stats
+STATS_TOP = 5
+
+async def setup(bot: commands.Bot):
+    await bot.add_cog(Metrics(bot))
+
+class Metrics(commands.Cog):
+
+    def __init__(self, bot):
+        self.bot: commands.Bot = bot
+        self.runner: web.AppRunner | None = None
+
+    async def cog_load(self):
+        port = lajter.settings.get().metrics_port
+        if port:
+            app = web.Application()
+            app.router.add_get("/metrics", self.serve_metrics)
+            self.runner = web.AppRunner(app)
+            await self.runner.setup()
+            await web.TCPSite(self.runner, "127.0.0.1", port).start()
+            logger.info(f'Serving metrics on http://127.0.0.1:{port}/metrics')
+
+    async def cog_unload(self):
+        if self.runner:
+            await self.runner.cleanup()
+
+    async def serve_metrics(self, request: web.Request) -> web.Response:
+        return web.Response(text=metrics.render_prometheus(),
+                            content_type="text/plain", charset="utf-8")
+
+    @commands.Cog.listener()
+    async def on_socket_event_type(self, event_type: str):
+        metrics.inc("lajter_events_total", type=event_type)
+
+    @commands.command(name="stats", brief="Wyświetl statystyki bota")
+    @commands.has_guild_permissions(administrator=True)
+    async def read_stats(self, ctx: commands.Context):
+        s = "**Zdarzenia:** "
+        s += self.top_counters("lajter_events_total", "type")
+
+        s += "\n**Nasłuchiwacze:**\n"
+        s += self.top_histograms("lajter_listener_seconds")
+
+        evaluated = sum(metrics.counters(
+            "lajter_rules_evaluated_total").values())
+        broken = sum(metrics.counters("lajter_rules_broken_total").values())
+        s += (f'**Zasady:** sprawdzone {evaluated:.0f} razy, '
+              f'złamane {broken:.0f} razy. Najczęściej łamane: ')
+        s += self.top_counters("lajter_rule_broken_total", "rule")
+        s += "\n"
+
+        s += "**Akcje:**\n"
+        failures = self.by_label(
+            metrics.counters("lajter_action_failures_total"), "type")
+        s += self.top_histograms("lajter_action_seconds", failures)
+
+        writes = sum(metrics.counters("lajter_storage_writes_total").values())
+        entries = sum(metrics.counters(
+            "lajter_storage_entries_written_total").values())
+        saves = sum(metrics.counters("lajter_user_saves_total").values())
+        s += (f'**Zapis:** {writes:.0f} zapisów, {entries:.0f} wpisów, '
+              f'zmiany użytkowników: {saves:.0f}\n')
+
+        s += "**REST:**\n"
+        s += self.top_histograms("lajter_rest_request_seconds")
+
+        await ctx.reply(s[:2000])
+
+    @staticmethod
+    def by_label(series: Dict, label: str) -> Dict[str, float]:
+        values = {}
+        for labels, value in series.items():
+            key = dict(labels).get(label, "")
+            values[key] = values.get(key, 0) + value
+        return values
+
+    def top_counters(self, name: str, label: str) -> str:
+        values = self.by_label(metrics.counters(name), label)
+        if not values:
+            return "brak"
+        top: List[Tuple[str, float]] = sorted(
+            values.items(), key=lambda item: -item[1])[:STATS_TOP]
+        return ", ".join(f'{key}: {value:.0f}' for key, value in top)
+
+    # Sorted by the total time, which is what takes the event loop's time
+    def top_histograms(self, name: str,
+                       failures: Dict[str, float] = None) -> str:
+        series = metrics.histograms(name)
+        if not series:
+            return "brak\n"
+        top = sorted(series.items(),
+                     key=lambda item: -item[1].sum)[:STATS_TOP]
+        s = ""
+        for labels, histogram in top:
+            key = " ".join(value for _, value in labels)
+            s += (f'`{key}`: {histogram.count} razy, łącznie '
+                  f'{histogram.sum:.2f} s, średnio '
+                  f'{histogram.sum / histogram.count * 1000:.1f} ms, '
+                  f'p99 ≤ {histogram.quantile(0.99) * 1000:g} ms')
+            if failures and failures.get(key):
+                s += f', błędy: {failures[key]:.0f}'
+            s += "\n"
+        return s
@@ -1,50 +1,100 @@
 import logging
-import os.path
+import os
 import random
+import traceback
 from datetime import datetime
 
 import discord
 from discord import Member, Message, User, Reaction
-from discord.ext import commands
-from tinydb import where
+from discord.ext import commands, tasks
 
-import lajter.action
-import lajter.rule
+import lajter.metrics as metrics
+import lajter.settings
+import lajter.spam
 import lajter.user
 import lajter.utils
-from lajter.cogs.rules import handle_rules
+from lajter.cogs.rules import handle_points_changes
+from lajter.leaderboard import NameCache
+from lajter.words import WordList
 
 logger = logging.getLogger('POINTS')
 logger.setLevel(logging.DEBUG)
 
+LEADERBOARD_PAGE_SIZE = 10
+
 async def setup(bot: commands.Bot):
     await bot.add_cog(Points(bot))
 
 class Points(commands.Cog):
     def __init__(self, bot):
         self.bot: commands.Bot = bot
+        self.names = NameCache()
+        self.words = WordList("slowa.txt")
+        if os.path.exists(self.words.path):
+            self.words.refresh()
+        self.flush_users.change_interval(
+            seconds=lajter.settings.get().flush_interval)
+        lajter.settings.on_reload(self.change_flush_interval)
+
+    async def cog_load(self):
+        self.flush_users.start()
+
+    async def cog_unload(self):
+        self.flush_users.cancel()
+        lajter.settings.remove_listener(self.change_flush_interval)
+        lajter.user.flush()
+        self.words.close()
+
+    def change_flush_interval(self, settings: lajter.settings.Settings):
+        self.flush_users.change_interval(seconds=settings.flush_interval)
+
+    @tasks.loop(seconds=30)
+    async def flush_users(self):
+        # An error would stop the loop, the users left dirty are written
+        # by the next flush instead
+        try:
+            lajter.user.flush()
+        except Exception:
+            logger.error(f'Failed to flush users: {traceback.format_exc()}')
 
     @commands.Cog.listener()
     async def on_ready(self):
         guild: discord.Guild = await lajter.utils.get_default_guild(self.bot)
 
+        removed = []
         for member in guild.members:
-            if lajter.user.get_by_id(member.id) is None:
-                if not member.bot or not lajter.utils.is_banned(member):
-                    db_user = lajter.user.User(member.id)
-                    db_user.save()
             if member.bot or lajter.utils.is_banned(member):
-                if lajter.user.get_by_id(member.id) is not None:
-                    lajter.user.User.db.remove(where('id') == member.id)
+                removed.append(member.id)
+            elif lajter.user.get_by_id(member.id) is None:
+                db_user = lajter.user.User(member.id)
+                db_user.save()
+                self.bot.dispatch("user_created", member.id)
+        lajter.user.remove_many(removed)
+        # Users who left are kept in case they come back, but not ranked
+        lajter.user.get_leaderboard().show_only(
+            {member.id for member in guild.members})
 
 
+    @commands.Cog.listener()
+    async def on_member_update(self, before: Member, after: Member):
+        if before.display_name != after.display_name:
+            self.names.invalidate(after.id)
+
+    @commands.Cog.listener()
+    async def on_member_remove(self, member: Member):
+        self.names.invalidate(member.id)
+        lajter.user.get_leaderboard().hide(member.id)
+
     @commands.Cog.listener()
     async def on_member_join(self, member: Member):
+        lajter.user.get_leaderboard().show(member.id)
         if not member.bot and lajter.user.get_by_id(member.id) is None:
             db_user = lajter.user.User(member.id)
             db_user.save()
+            self.bot.dispatch("user_created", member.id)
 
     @commands.Cog.listener()
+    @metrics.timed_listener
     async def on_message(self, message: Message):
         if (
                 message.author.bot
@@ -53,33 +103,40 @@ class Points(commands.Cog):
         ):
             return
 
-        user = lajter.user.get_by_id(message.author.id)
-        if not user:
-            user = lajter.user.User(message.author.id)
-        user.last_activity = datetime.now()
-        user.points += lajter.utils.rate_message(message.content)
-        user.save()
+        # Spam earns nothing and isn't worth a save
+        if lajter.spam.check(message):
+            return
+
+        created = lajter.user.get_by_id(message.author.id) is None
+        async with lajter.user.unit_of_work(message.author.id,
+                                            create=True) as (user,):
+            user.last_activity = datetime.now()
+            user.points += lajter.utils.rate_message(message.content)
+        if created:
+            self.bot.dispatch("user_created", message.author.id)
+
+        await handle_points_changes(
+            bot=self.bot,
+            member=message.author,
+            channel=message.channel,
+            message=message
+        )
 
     @commands.Cog.listener()
+    @metrics.timed_listener
     async def on_reaction_add(self, reaction: Reaction, user: User):
         if reaction.message.author.id == user.id:
             return
 
-        db_user = lajter.user.get_by_id(reaction.message.author.id)
-        if not db_user:
-            return
-
-        db_user.points += 10
-        db_user.save()
+        async with lajter.user.unit_of_work(
+                reaction.message.author.id) as (db_user,):
+            if not db_user:
+                return
+            db_user.points += 10
 
-        await handle_rules(
-            [
-                lajter.rule.RuleType.POINTS_LESS_THAN,
-                lajter.rule.RuleType.POINTS_GREATER_THAN
-            ],
+        await handle_points_changes(
             bot=self.bot,
             member=reaction.message.author,
-            db_user=db_user,
             channel=reaction.message.channel,
             message=reaction.message
         )
@@ -116,113 +173,103 @@ class Points(commands.Cog):
             await ctx.reply(f'Niewłaściwa liczba punktów')
             return
 
-        giver = lajter.user.get_by_id(ctx.author.id)
-        receiver = lajter.user.get_by_id(target.id)
-
-        if giver.id == receiver.id:
+        if ctx.author.id == target.id:
             await ctx.reply(f'Nie możesz dawać pieniędzy sobie samemu')
             return
 
-        if value > giver.points:
-            await ctx.reply(f'Masz za mało punktów na koncie')
-            return
+        # Both balances are locked, so concurrent commands can't spend the
+        # same points twice
+        async with lajter.user.unit_of_work(
+                ctx.author.id, target.id) as (giver, receiver):
+            if not giver or not receiver:
+                return
 
-        if giver and receiver:
-            giver.points -= value
-            giver.save()
+            if value > giver.points:
+                await ctx.reply(f'Masz za mało punktów na koncie')
+                return
 
+            giver.points -= value
             receiver.points += value
-            receiver.save()
 
+        if giver and receiver:
             logger.info(f'{ctx.author} przekazał {target} {value} punktów')
             await ctx.reply(f'Oddajesz {target.mention} **{value}** punktów')
 
-            if not lajter.utils.immune(ctx.author):
-                await handle_rules(
-                    [
-                        lajter.rule.RuleType.POINTS_LESS_THAN,
-                        lajter.rule.RuleType.POINTS_GREATER_THAN
-                    ],
-                    bot=self.bot,
-                    member=ctx.author,
-                    db_user=giver,
-                    channel=ctx.channel,
-                    message=ctx.message
-                )
-
-            if not lajter.utils.immune(target):
-                await handle_rules(
-                    [
-                        lajter.rule.RuleType.POINTS_LESS_THAN,
-                        lajter.rule.RuleType.POINTS_GREATER_THAN
-                    ],
-                    bot=self.bot,
-                    member=target,
-                    db_user=receiver,
-                    channel=ctx.channel,
-                    message=ctx.message
-                )
+            await handle_points_changes(
+                bot=self.bot,
+                member=ctx.author,
+                channel=ctx.channel,
+                message=ctx.message
+            )
 
     @commands.command(name="top", aliases=["leaderboard"], brief="Wyświetl tabelę punktów")
     @commands.guild_only()
     @commands.cooldown(1, 30)
-    async def point_leaderboard(self, ctx: commands.Context):
-        async with ctx.typing():
-            users = lajter.user.User.db.all()
-            users.sort(key=lambda user: user['points'], reverse=True)
-            s = ""
-            for user in users:
-                try:
-                    member: Member = await ctx.guild.fetch_member(user["id"])
-                    s += f'**{member.name}:** {user["points"]} punktów\n'
-                except Exception:
-                    pass
-            await ctx.reply(s)
+    async def point_leaderboard(
+            self,
+            ctx: commands.Context,
+            page: int = commands.parameter(default=1, description="Numer strony")):
+        leaderboard = lajter.user.get_leaderboard()
+        pages = max(1, -(-len(leaderboard) // LEADERBOARD_PAGE_SIZE))
+
+        if page < 1 or page > pages:
+            await ctx.reply(f'Niewłaściwy numer strony, dostępne strony: 1-{pages}')
+            return
+
+        s = ""
+        for rank, user_id, points in leaderboard.page(page - 1, LEADERBOARD_PAGE_SIZE):
+            name = self.names.get(ctx.guild, user_id)
+            if name:
+                s += f'{rank}. **{name}:** {points} punktów\n'
+
+        s += f'\nStrona {page}/{pages}'
+        rank = leaderboard.rank(ctx.author.id)
+        if rank:
+            s += f', twoje miejsce: **{rank}**'
+        await ctx.reply(s)
 
     @commands.command(name="coinflip", brief="Rzuć monetą, żeby wygrać punkty")
     @commands.guild_only()
     @lajter.utils.not_banned()
     async def coin_flip(self, ctx: commands.Context, amount):
-        user = lajter.user.get_by_id(ctx.author.id)
+        # Replies wait for Discord, so they are sent after the lock of the
+        # user is released
+        replies = []
+        async with lajter.user.unit_of_work(ctx.author.id) as (user,):
+            try:
+                amount = int(amount)
+            except ValueError:
+                amount = user.points
+
+            if (amount == 0 or (amount > 0 and amount > user.points)
+                    or (amount < 0 and amount < user.points)):
+                replies.append("Niewłaściwa liczba punktów")
+            else:
+                if amount < 0:
+                    tax = -1 * int(amount * 0.25)
+                    user.points -= tax
+                    replies.append(
+                        f'Pobrano podatek w wysokości {tax} punktów')
 
-        try:
-            amount = int(amount)
-        except ValueError:
-            amount = user.points
-
-        if (amount == 0 or (amount > 0 and amount > user.points)
-                or (amount < 0 and amount < user.points)):
-            await ctx.reply("Niewłaściwa liczba punktów")
-            return
-
-        if amount < 0:
-            tax = -1 * int(amount * 0.25)
-            user.points -= tax
-            await ctx.reply(f'Pobrano podatek w wysokości {tax} punktów')
+                if bool(random.getrandbits(1)):
+                    amount *= -1
 
-        if bool(random.getrandbits(1)):
-            amount *= -1
+                if amount > 0:
+                    replies.append(f'Wygrywasz **{amount}** punktów')
+                else:
+                    replies.append(f'Tracisz **{amount}** punktów')
 
-        if amount > 0:
-            await ctx.reply(f'Wygrywasz **{amount}** punktów')
-        else:
-            await ctx.reply(f'Tracisz **{amount}** punktów')
+                user.points += amount
 
-        user.points += amount
-        user.save()
+        for reply in replies:
+            await ctx.reply(reply)
 
-        if not lajter.utils.immune(ctx.message.author):
-            await handle_rules(
-                [
-                    lajter.rule.RuleType.POINTS_LESS_THAN,
-                    lajter.rule.RuleType.POINTS_GREATER_THAN
-                ],
-                bot=self.bot,
-                member=ctx.author,
-                db_user=user,
-                channel=ctx.channel,
-                message=ctx.message
-            )
+        await handle_points_changes(
+            bot=self.bot,
+            member=ctx.author,
+            channel=ctx.channel,
+            message=ctx.message
+        )
 
     @commands.command(name="word", brief="Powiedz słowo, żeby wygrać punkty")
     @commands.guild_only()
@@ -234,22 +281,10 @@ class Points(commands.Cog):
             await ctx.reply("Idź na spam kanał!!!")
             return
 
-        word = ""
-        with open("slowa.txt", "rb") as f:
-            seek_range = os.path.getsize("slowa.txt")
-            while seek_range > 100:
-                seek_range = int(seek_range/2)
-                if bool(random.getrandbits(1)):
-                    f.seek(seek_range, 1)
-            bytes = f.read(100).split(b'\n')
-            words = []
-            for byte_word in bytes:
-                try:
-                    words.append(byte_word.decode())
-                except UnicodeDecodeError:
-                    pass
-            word = random.choice(words)
-            word = word.strip()
+        word = self.words.random_word()
+        if not word:
+            await ctx.reply("Brak słów do powiedzenia")
+            return
 
         await ctx.reply(f'Powiedz: *{word}*')
 
@@ -260,21 +295,16 @@ class Points(commands.Cog):
         reply = await self.bot.wait_for("message", check=check)
 
         if word in reply.content.lower():
-            db_user = lajter.user.get_by_id(reply.author.id)
             points = random.randrange(10, 30)
-
-            db_user.points += points
-            db_user.save()
+            async with lajter.user.unit_of_work(reply.author.id) as (db_user,):
+                if not db_user:
+                    return
+                db_user.points += points
             await reply.reply(f'Otrzymujesz **{points}** punktów')
 
-            await handle_rules(
-                [
-                    lajter.rule.RuleType.POINTS_LESS_THAN,
-                    lajter.rule.RuleType.POINTS_GREATER_THAN
-                ],
+            await handle_points_changes(
                 bot=self.bot,
-                member=ctx.author,
-                db_user=db_user,
+                member=reply.author,
                 channel=ctx.channel,
                 message=reply
             )
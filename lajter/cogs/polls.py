@@ -0,0 +1,209 @@
+import asyncio
+import datetime
+import logging
+import traceback
+
+import discord
+from discord.ext import commands
+
+import lajter.action
+import lajter.poll
+import lajter.rule
+import lajter.settings
+import lajter.user
+import lajter.utils
+from lajter.cogs.backfill import start_backfill
+from lajter.cogs.rules import handle_points_changes
+from lajter.poll import Poll, PollKind
+
+logger = logging.getLogger('POLL')
+logger.setLevel(logging.DEBUG)
+
+async def setup(bot: commands.Bot):
+    await bot.add_cog(Polls(bot))
+
+class Polls(commands.Cog):
+
+    def __init__(self, bot):
+        self.bot: commands.Bot = bot
+        self.polls_task: asyncio.Task | None = None
+        # Members who can vote, kept up to date by join and leave events
+        self.voters = 0
+
+    @commands.Cog.listener()
+    async def on_ready(self):
+        if self.polls_task is None:
+            self.polls_task = asyncio.create_task(self.watch_polls())
+            guild = await lajter.utils.get_default_guild(self.bot)
+            self.voters = sum(1 for member in guild.members if not member.bot)
+
+            # Polls that were open when the bot stopped are resumed, the
+            # ones whose deadline passed in the meantime are finished now.
+            # Their votes are read once, later ones arrive as events
+            for poll in lajter.poll.get_all():
+                try:
+                    await self.count_votes(poll)
+                except discord.NotFound:
+                    logger.warning(f'Message of poll {poll.id} was deleted')
+                    lajter.poll.remove(poll.id)
+                    continue
+                except Exception:
+                    logger.error(f'Failed to count votes of poll {poll.id}: '
+                                 f'{traceback.format_exc()}')
+                lajter.poll.scheduler.schedule(poll.id, poll.deadline)
+                self.check_poll(poll)
+
+    async def cog_unload(self):
+        if self.polls_task:
+            self.polls_task.cancel()
+
+    # A single task waits for the nearest deadline of all open polls
+    async def watch_polls(self):
+        while True:
+            await lajter.poll.scheduler.wait()
+
+            now = datetime.datetime.now()
+            for poll_id in lajter.poll.scheduler.pop_due(now):
+                poll = lajter.poll.get_by_id(poll_id)
+                if poll is None:
+                    continue
+
+                # Finished polls are removed even if finishing failed, so a
+                # broken poll isn't retried on every start
+                lajter.poll.remove(poll_id)
+                await self.finish_poll(poll)
+
+    async def count_votes(self, poll: Poll):
+        channel = await lajter.utils.resolve_channel(
+            self.bot, poll.channel_id)
+        message = await channel.fetch_message(poll.message_id)
+
+        poll.votes.clear()
+        for reaction in message.reactions:
+            if str(reaction.emoji) not in lajter.poll.VOTES:
+                continue
+            async for user in reaction.users():
+                if not user.bot:
+                    poll.add_vote(user.id, str(reaction.emoji))
+
+    # Closes the poll right away once the result is known, or once as many
+    # users voted as the quorum requires, if it's set
+    def check_poll(self, poll: Poll):
+        quorum = lajter.settings.get().poll_quorum
+        if ((self.voters and poll.decided(self.voters))
+                or (quorum and len(poll.votes) >= quorum)):
+            lajter.poll.scheduler.schedule(poll.id, datetime.datetime.now())
+
+    @commands.Cog.listener()
+    async def on_raw_reaction_add(
+            self, payload: discord.RawReactionActionEvent):
+        poll = lajter.poll.get_by_message(payload.message_id)
+        if (poll is None or payload.user_id == self.bot.user.id
+                or (payload.member and payload.member.bot)):
+            return
+
+        poll.add_vote(payload.user_id, str(payload.emoji))
+        self.check_poll(poll)
+
+    @commands.Cog.listener()
+    async def on_raw_reaction_remove(
+            self, payload: discord.RawReactionActionEvent):
+        poll = lajter.poll.get_by_message(payload.message_id)
+        if poll is not None:
+            poll.remove_vote(payload.user_id, str(payload.emoji))
+
+    @commands.Cog.listener()
+    async def on_raw_message_delete(
+            self, payload: discord.RawMessageDeleteEvent):
+        poll = lajter.poll.get_by_message(payload.message_id)
+        if poll is not None:
+            logger.warning(f'Message of poll {poll.id} was deleted')
+            lajter.poll.remove(poll.id)
+
+    @commands.Cog.listener()
+    async def on_member_join(self, member: discord.Member):
+        if not member.bot:
+            self.voters += 1
+
+    @commands.Cog.listener()
+    async def on_member_remove(self, member: discord.Member):
+        if not member.bot:
+            self.voters -= 1
+
+    async def finish_poll(self, poll: Poll):
+        try:
+            # The votes are already counted, the message is only replied to
+            channel = await lajter.utils.resolve_channel(
+                self.bot, poll.channel_id)
+            message = channel.get_partial_message(poll.message_id)
+
+            match poll.kind:
+                case PollKind.ACTION:
+                    await self.finish_action_poll(poll, message, poll.passed())
+                case PollKind.RULE:
+                    await self.finish_rule_poll(poll, message, poll.passed())
+        except Exception:
+            logger.error(f'Failed to finish poll {poll.id}: '
+                         f'{traceback.format_exc()}')
+
+    async def finish_action_poll(self, poll: Poll,
+                                 message: discord.PartialMessage,
+                                 passed: bool):
+        guild: discord.Guild = message.guild
+        try:
+            target = await lajter.utils.resolve_member(guild, poll.target_id)
+        except discord.NotFound:
+            await message.reply("Głosowanie zostało przerwane, "
+                                "gracz opuścił serwer.")
+            return
+
+        if not passed:
+            await message.reply(f'Głosowanie przeciwko {target.mention} '
+                                f'nie uzyskało większości głosów.')
+            return
+
+        await message.reply(f'Głosowanie przeciwko {target.mention} '
+                            f'przeszło większością głosów.')
+
+        action = None
+        if poll.action_id is not None:
+            action = lajter.action.get_by_id(poll.action_id)
+        if action is None:
+            return
+
+        channel = message.channel
+        if poll.origin_id is not None:
+            channel = await lajter.utils.resolve_channel(
+                self.bot, poll.origin_id)
+
+        # Like the actions of broken rules, it runs outside of the unit of
+        # work of the user
+        db_user = lajter.user.get_by_id(target.id)
+        await action.execute(self.bot, target, db_user, channel)
+        await handle_points_changes(self.bot, target, channel)
+
+    async def finish_rule_poll(self, poll: Poll,
+                               message: discord.PartialMessage,
+                               passed: bool):
+        if not passed:
+            await message.reply("Głosowanie nie uzyskało większości głosów")
+            return
+
+        rule = lajter.rule.Rule(
+            poll.rule['type'],
+            regexes=poll.rule['regexes'],
+            actions=poll.rule['actions'],
+            public=poll.rule['public']
+        )
+        rule.save()
+        await message.reply(f'Głosowanie w sprawie zasady nr '
+                            f'**{rule.id}** przeszło większością głosów')
+        logger.info(f'{poll.author_id} utworzył zasadę:'
+                    f' {rule.to_string()}')
+
+        # Players' rules only apply to new messages, unless a scan of the
+        # history is configured for them
+        mode = lajter.settings.get().voterule_backfill
+        if mode:
+            await message.reply(await start_backfill(
+                self.bot, rule, mode, poll.channel_id))
@@ -1,24 +1,47 @@
 import asyncio
 import datetime
 import logging
+import time
+import traceback
 from typing import Tuple, List
 
 import discord.utils
 from discord import Member, TextChannel, Message, Reaction
 from discord.ext import commands
-from tinydb import where
 
 import lajter.action
+import lajter.metrics as metrics
+import lajter.poll
 import lajter.rule
+import lajter.spam
 from lajter.rule import RuleType
 from lajter.rule import Rule
 import lajter.user
 import lajter.utils as utils
+from lajter.cogs.backfill import start_backfill
+from lajter.events import (ChangeFilter, RecentMessages, activity_fingerprint,
+                           name_fingerprint, message_fingerprint)
+from lajter.scheduler import DeadlineScheduler
 
 
 logger = logging.getLogger('RULE')
 logger.setLevel(logging.DEBUG)
 
+# Number of members and messages whose last seen state is remembered
+MEMBER_CHANGES_SIZE = 20000
+MESSAGE_CHANGES_SIZE = 2000
+
+# Recent messages kept for !ruletest, per channel and number of channels
+RECENT_MESSAGES_SIZE = 200
+RECENT_CHANNELS = 50
+# Matching messages shown by !ruletest and their length
+RULETEST_SAMPLES = 5
+RULETEST_SAMPLE_LENGTH = 100
+# Times the points of the same event are checked again, when the actions of
+# points rules change points themselves. Rules that keep setting each other
+# off are stopped after that
+POINTS_ROUNDS = 5
+
 async def setup(bot: commands.Bot):
     await bot.add_cog(Rules(bot))
 
@@ -31,22 +54,134 @@ async def handle_rules(
             message: Message = None,
             reaction: Reaction = None
 ):
-    if member:
+    if member and db_user is None:
         db_user = lajter.user.get_by_id(member.id)
     broken_rules = []
 
     for rule_type in rule_types:
-        rules = Rule.db.search(where('type') == rule_type.value)
-        rules = [lajter.rule.from_entry(entry) for entry in rules]
+        # Points rules are broken when a change of the balance crosses
+        # their threshold, not for as long as it stays past it. Changes are
+        # checked by handle_points_changes
+        if rule_type in lajter.rule.POINTS_RULE_TYPES:
+            continue
+        rules = lajter.rule.get_by_type(rule_type)
+        metrics.inc("lajter_rules_evaluated_total", len(rules),
+                    type=rule_type.value)
+        if rule_type in lajter.rule.TEXT_RULE_TYPES:
+            broken_rules.extend(
+                await lajter.rule.match(rule_type, member, message))
+            continue
         broken_rules.extend([rule for rule in rules if await rule.check(bot, member, db_user, channel, message, reaction)])
 
-    for rule in broken_rules:
-        await rule.execute(bot, member, db_user, channel, message)
+    quarantined = lajter.rule.take_quarantined()
+    if quarantined:
+        await report_quarantined(bot, quarantined)
+
+    await execute_rules(broken_rules, bot, member, db_user, channel, message)
+    await handle_points_changes(bot, member, channel, message)
+
+
+async def report_quarantined(bot: commands.Bot, rules: List[Rule]):
+    channel = await utils.get_default_channel(bot)
+    if channel is None:
+        return
+    s = ("Wstrzymano zasady, których regexy zbyt długo sprawdzały "
+         "wiadomości. Zaczną działać ponownie po edycji regexów:\n")
+    for rule in rules:
+        s += rule.to_string()
+    await channel.send(s)
+
+
+# Message refusing regexes that may stall the bot, None if they are fine
+def screen_regexes(rule_type: RuleType, regexes: List[str]) -> str | None:
+    risks = lajter.rule.screen(rule_type, regexes)
+    if not risks:
+        return None
+    s = "Te regexy mogą działać bardzo wolno, popraw je:"
+    for regex, reason in risks:
+        s += f'\n`{regex}` - {reason}'
+    return s
+
+
+# Checks the points rules for every user whose points changed, by a command,
+# an action or anything else, since they were last checked. Every event that
+# can change points ends with it. The message is passed only to the rules of
+# its author
+async def handle_points_changes(
+        bot: commands.Bot,
+        member: Member = None,
+        channel: TextChannel = None,
+        message: Message = None
+):
+    guild = member.guild if member else None
+    for _ in range(POINTS_ROUNDS):
+        changed = lajter.user.take_changed()
+        if not changed:
+            return
+        if guild is None:
+            guild = await utils.get_default_guild(bot)
+
+        for db_user in changed:
+            target = member
+            if member is None or member.id != db_user.id:
+                target = guild.get_member(db_user.id) if guild else None
+            await handle_points_change(
+                bot, target, db_user, channel,
+                message if target is member else None)
+
+    for db_user in lajter.user.take_changed():
+        db_user.take_points_change()
+    logger.warning(f'Points rules were still changing points after '
+                   f'{POINTS_ROUNDS} rounds, stopped checking them')
+
+
+async def handle_points_change(
+        bot: commands.Bot,
+        member: Member | None,
+        db_user: lajter.user.User,
+        channel: TextChannel = None,
+        message: Message = None
+):
+    # Only the points rules whose threshold was crossed since the last check
+    # are broken, a change that crossed nothing costs nothing
+    change = db_user.take_points_change()
+    if (change is None or member is None or utils.immune(member)
+            or lajter.user.get_by_id(db_user.id) is not db_user):
+        return
+
+    broken_rules = lajter.rule.get_points_index().crossed(*change)
+    await execute_rules(broken_rules, bot, member, db_user, channel, message)
+
+
+async def execute_rules(
+        broken_rules: List[Rule],
+        bot: commands.Bot = None,
+        member: Member = None,
+        db_user: lajter.user.User = None,
+        channel: TextChannel = None,
+        message: Message = None
+):
+    # The actions of all broken rules are planned and run together. They
+    # run outside of the user's unit of work: kicks, timeouts and edits
+    # queued in the dispatcher wait for Discord, and holding the user's lock
+    # that long would hold up their own commands. ADD_POINTS takes the lock
+    # only for the change of points. POLL actions don't wait for the vote,
+    # the polls cog finishes it
+    actions = [action for rule in broken_rules
+               for action in rule.get_actions()]
+    await lajter.action.execute_all(
+        actions, bot, member, db_user, channel, message)
 
     if broken_rules:
         logger.info(f'Użytkownik {member} złamał zasady: {[rule.id for rule in broken_rules]}')
-        db_user.last_activity = datetime.datetime.now()
-        db_user.save()
+        for rule in broken_rules:
+            metrics.inc("lajter_rules_broken_total",
+                        type=rule.rule_type.value)
+            metrics.inc("lajter_rule_broken_total", rule=rule.id)
+        # A user removed by a BAN must not be saved back
+        if db_user and lajter.user.get_by_id(db_user.id) is db_user:
+            db_user.last_activity = datetime.datetime.now()
+            db_user.save()
 
 
 
@@ -54,6 +189,13 @@ class Rules(commands.Cog):
 
     def __init__(self, bot):
         self.bot: commands.Bot = bot
+        self.inactivity = DeadlineScheduler()
+        self.inactivity_task: asyncio.Task | None = None
+        self.inactivity_threshold: datetime.timedelta | None = None
+        self.member_changes = ChangeFilter(MEMBER_CHANGES_SIZE)
+        self.message_changes = ChangeFilter(MESSAGE_CHANGES_SIZE)
+        self.recent_messages = RecentMessages(RECENT_MESSAGES_SIZE,
+                                              RECENT_CHANNELS)
 
     class RuleFlags(commands.FlagConverter):
         rule_type: str = commands.flag(
@@ -64,107 +206,234 @@ class Rules(commands.Cog):
             default=(), aliases=["action", "a"])
         public: bool = commands.flag(
             default=(False), aliases=["p"])
+        # report or execute, scans the history for messages breaking a new
+        # MESSAGE rule
+        backfill: str = commands.flag(default=None, aliases=["b"])
 
     @commands.Cog.listener()
     async def on_ready(self):
+        if self.inactivity_task is None:
+            await self.remove_banned_users()
+            self.schedule_inactivity()
+            self.inactivity_task = asyncio.create_task(
+                self.watch_inactivity())
+
+    async def cog_unload(self):
+        if self.inactivity_task:
+            self.inactivity_task.cancel()
+
+    # Bans made while the bot was offline are found with a single listing of
+    # the guild's bans, later ones arrive as events
+    async def remove_banned_users(self):
+        guild: discord.Guild = await lajter.utils.get_default_guild(self.bot)
+
+        # Without the ban_members permission only the ban role is checked
+        banned = set()
+        try:
+            async for ban in guild.bans(limit=None):
+                banned.add(ban.user.id)
+        except discord.HTTPException as e:
+            logger.warning(f'Failed to list the bans of the guild, checking '
+                           f'only the ban role: {e}')
+
+        removed = []
+        for db_user in lajter.user.get_all():
+            member = guild.get_member(db_user.id)
+            if db_user.id in banned or (member
+                                        and lajter.utils.is_banned(member)):
+                removed.append(db_user.id)
+
+        if removed:
+            logger.info(f'Removing {len(removed)} banned users from db')
+            lajter.user.remove_many(removed)
+
+    # Every user has a single deadline, when their first LAST_ACTIVITY rule
+    # would be broken. Only users whose deadline has passed are woken up
+    def schedule_inactivity(self):
+        self.inactivity.clear()
+        threshold = lajter.rule.get_inactivity_threshold()
+        self.inactivity_threshold = threshold
+        if threshold is None:
+            return
+        for db_user in lajter.user.get_all():
+            self.inactivity.schedule(
+                db_user.id, db_user.last_activity + threshold)
+
+    def update_inactivity(self):
+        if lajter.rule.get_inactivity_threshold() != self.inactivity_threshold:
+            self.schedule_inactivity()
+
+    def track_activity(self, user_id: int):
+        # Activity only moves a deadline later, so an already scheduled
+        # deadline is corrected when it comes up instead of being moved now
+        if user_id in self.inactivity:
+            return
+        threshold = lajter.rule.get_inactivity_threshold()
+        db_user = lajter.user.get_by_id(user_id)
+        if threshold and db_user:
+            self.inactivity.schedule(
+                user_id, db_user.last_activity + threshold)
+
+    async def watch_inactivity(self):
         guild: discord.Guild = await lajter.utils.get_default_guild(self.bot)
 
         while True:
+            await self.inactivity.wait()
+
+            threshold = lajter.rule.get_inactivity_threshold()
+            if threshold is None:
+                continue
+
+            now = datetime.datetime.now()
+            for user_id in self.inactivity.pop_due(now):
+                db_user = lajter.user.get_by_id(user_id)
+                if db_user is None:
+                    continue
+
+                if db_user.last_activity + threshold > now:
+                    self.inactivity.schedule(
+                        user_id, db_user.last_activity + threshold)
+                    continue
+
+                try:
+                    await self.check_inactive(guild, db_user)
+                except Exception:
+                    logger.error(f'Failed to check inactive user '
+                                 f'{user_id}: {traceback.format_exc()}')
+
+                if lajter.user.get_by_id(user_id) is None:
+                    continue
+                deadline = db_user.last_activity + threshold
+                if deadline <= now:
+                    deadline = now + threshold
+                self.inactivity.schedule(user_id, deadline)
+
+    async def check_inactive(self, guild: discord.Guild,
+                             db_user: lajter.user.User):
+        member = guild.get_member(db_user.id)
+
+        # Members who left stay in the db in case they come back, bans are
+        # handled by on_member_ban and on_member_update
+        if member and not lajter.utils.immune(member):
+            # Points taken away for inactivity are checked by handle_rules
+            await handle_rules(
+                [RuleType.LAST_ACTIVITY],
+                bot=self.bot,
+                member=member,
+                db_user=db_user
+            )
 
-            for user_entry in lajter.user.User.db.all():
-                db_user = lajter.user.from_entry(user_entry)
-                member = guild.get_member(db_user.id)
-
-                if not member:
-                    user = await self.bot.fetch_user(db_user.id)
-                    if user:
-                        try:
-                            ban = await guild.fetch_ban(user)
-                            if ban:
-                                logger.info(f'User {user.name} was banned, '
-                                            f'removing them from db')
-                                lajter.user.User.db.remove(
-                                    where("id") == db_user.id)
-                        except Exception:
-                            pass
-                elif lajter.utils.is_banned(member):
-                    logger.info(f'User {member.name} was banned, '
-                                f'removing them from db')
-                    lajter.user.User.db.remove(
-                        where("id") == db_user.id)
-                elif not lajter.utils.immune(member):
-                    await handle_rules(
-                        [
-                            RuleType.LAST_ACTIVITY,
-                            RuleType.POINTS_GREATER_THAN,
-                            RuleType.POINTS_LESS_THAN
-                        ],
-                        bot=self.bot,
-                        member=member,
-                        db_user=db_user
-                    )
-
-            await asyncio.sleep(60)
+    # Dispatched by the points cog for every new user, so members who join
+    # and never post get a deadline too, whichever cog was ready first
+    @commands.Cog.listener()
+    async def on_user_created(self, user_id: int):
+        self.track_activity(user_id)
 
     @commands.Cog.listener()
+    @metrics.timed_listener
     async def on_presence_update(self, before: Member, after: Member):
         if lajter.utils.immune(after):
             return
 
-        if before.activities:
-            await handle_rules([RuleType.ACTIVITY],
-                               bot=self.bot, member=before)
-        if after.activities:
-            await handle_rules([RuleType.ACTIVITY],
-                               bot=self.bot, member=after)
+        # Both states are recorded, so an activity that comes back after
+        # it was gone counts as a change
+        for member in (before, after):
+            changed = self.member_changes.changed(
+                ("activity", member.id), activity_fingerprint(member))
+            if changed and member.activities:
+                await handle_rules([RuleType.ACTIVITY],
+                                   bot=self.bot, member=member)
 
     @commands.Cog.listener()
+    @metrics.timed_listener
     async def on_message(self, message: Message):
-        if not utils.immune(message.author):
-            await handle_rules(
-                [
-                    RuleType.MESSAGE,
-                    RuleType.ROLE,
-                    RuleType.POINTS_LESS_THAN,
-                    RuleType.POINTS_GREATER_THAN
-                ],
-                bot=self.bot,
-                member=message.author,
-                message=message,
-                channel=message.channel
-            )
+        # Only messages of the guild the rules are made for are kept for
+        # !ruletest, not those of other guilds or DMs
+        if not message.author.bot and utils.in_default_guild(message):
+            self.recent_messages.add(message)
+        if utils.immune(message.author):
+            return
+
+        # Spam breaks the SPAM rules on top of the rules any message can break
+        rule_types = [RuleType.MESSAGE, RuleType.ROLE]
+        if lajter.spam.check(message):
+            rule_types.append(RuleType.SPAM)
+
+        self.message_changes.changed(
+            message.id, message_fingerprint(message))
+        self.track_activity(message.author.id)
+        await handle_rules(
+            rule_types,
+            bot=self.bot,
+            member=message.author,
+            message=message,
+            channel=message.channel
+        )
 
 
     @commands.Cog.listener()
+    @metrics.timed_listener
     async def on_message_edit(self, before: Message, after: Message):
-        if not utils.immune(after.author):
+        if utils.immune(after.author):
+            return
+
+        # Edits that only add an embed don't change anything rules look at
+        fingerprint = message_fingerprint(after)
+        changed = self.message_changes.changed(after.id, fingerprint)
+        if changed and fingerprint != message_fingerprint(before):
             await handle_rules([RuleType.MESSAGE],
-                               bot=self.bot, message=after)
+                               bot=self.bot, member=after.author,
+                               message=after, channel=after.channel)
 
     @commands.Cog.listener()
+    @metrics.timed_listener
     async def on_reaction_add(self, reaction: Reaction, member: Member):
         if not utils.immune(member):
             await handle_rules([RuleType.REACTION],
                                bot=self.bot, member=member, reaction=reaction)
 
     @commands.Cog.listener()
+    @metrics.timed_listener
     async def on_member_join(self, member: Member):
         if not utils.immune(member):
+            self.member_changes.changed(
+                ("name", member.id), name_fingerprint(member))
             await handle_rules([RuleType.NAME],
                                bot=self.bot, member=member)
 
     @commands.Cog.listener()
+    @metrics.timed_listener
     async def on_member_update(self, before: Member, after: Member):
+        if utils.is_banned(after) and not utils.is_banned(before):
+            logger.info(f'User {after.name} was banned, '
+                        f'removing them from db')
+            lajter.user.remove(after.id)
+            return
+
         if not utils.immune(after):
-            await handle_rules([RuleType.NAME],
-                               bot=self.bot, member=before)
-            await handle_rules([RuleType.NAME],
-                               bot=self.bot, member=after)
+            for member in (before, after):
+                if self.member_changes.changed(
+                        ("name", member.id), name_fingerprint(member)):
+                    await handle_rules([RuleType.NAME],
+                                       bot=self.bot, member=member)
+
+    @commands.Cog.listener()
+    async def on_member_ban(self, guild: discord.Guild, user: discord.User):
+        if lajter.user.get_by_id(user.id):
+            logger.info(f'User {user.name} was banned, '
+                        f'removing them from db')
+            lajter.user.remove(user.id)
 
     @commands.Cog.listener()
     async def on_member_remove(self, member: Member):
+        self.member_changes.forget(("activity", member.id))
+        self.member_changes.forget(("name", member.id))
+        lajter.spam.detector.forget(member.id)
+
         channel = await utils.get_default_channel(self.bot)
         db_user = lajter.user.get_by_id(member.id)
+        if db_user is None:
+            return
 
         await channel.send(f'{member.mention} opuszcza nas z '
                            f'wynikiem {db_user.points} punktów')
@@ -185,16 +454,27 @@ class Rules(commands.Cog):
     @commands.command(
         name="addrule",
         brief="Dodaj zasadę",
-        help="type: <typ zasady> regex: <wartość> action: <id akcji>"
+        help="type: <typ zasady> regex: <wartość> action: <id akcji> "
+             "[backfill: report|execute]"
     )
     @commands.has_guild_permissions(administrator=True)
     async def add_rule(self, ctx: commands.Context, *, flags: RuleFlags):
         rule = Rule(flags.rule_type, regexes=list(flags.regexes),
                     actions=list(flags.actions), public=flags.public)
+        error = screen_regexes(rule.rule_type, rule.regexes)
+        if error:
+            await ctx.reply(error)
+            return
+
         rule.save()
+        self.update_inactivity()
         logger.info(f'{ctx.author} utworzył zasadę: {rule.to_string()}')
         await ctx.send(f'Utworzono zasadę: {rule.to_string()}')
 
+        if flags.backfill:
+            await ctx.send(await start_backfill(
+                self.bot, rule, flags.backfill, ctx.channel.id))
+
 
     @commands.command(name="editrule")
     @commands.has_guild_permissions(administrator=True)
@@ -215,19 +495,30 @@ class Rules(commands.Cog):
             await ctx.send("Nie ma zasady o podanym id")
             return
 
+        # Checked before the rule is changed, it's the registry's instance
+        rule_type = rule.rule_type
         if flags.rule_type is not None:
-            rule.rule_type = lajter.rule.RuleType(flags.rule_type)
+            rule_type = lajter.rule.RuleType(flags.rule_type)
+        regexes = list(flags.regexes) or rule.regexes
+        error = screen_regexes(rule_type, regexes)
+        if error:
+            await ctx.reply(error)
+            return
+
+        rule.rule_type = rule_type
 
         if flags.public:
             rule.public = flags.public
 
         if len(flags.regexes) > 0:
             rule.regexes = list(flags.regexes)
+            rule.quarantined = False
 
         if len(flags.actions) > 0:
             rule.actions = list(flags.actions)
 
         rule.save()
+        self.update_inactivity()
         logger.info(f'{ctx.author} nadpisał zasadę: {rule.to_string()}')
         await ctx.send(f'Nadpisano zasadę: {rule.to_string()}')
 
@@ -235,7 +526,8 @@ class Rules(commands.Cog):
     @commands.command(name="delrule")
     @commands.has_guild_permissions(administrator=True)
     async def remove_rule(self, ctx: commands.Context, rule_id: int):
-        Rule.db.remove(doc_ids=[rule_id])
+        lajter.rule.remove(rule_id)
+        self.update_inactivity()
         logger.info(f'{ctx.author} usunął zasadę: {rule_id}')
         await ctx.send(f'Usunięto zasadę nr **{rule_id}**')
 
@@ -244,8 +536,7 @@ class Rules(commands.Cog):
     @commands.has_guild_permissions(administrator=True)
     async def read_rules(self, ctx: commands.Context):
         rules = ""
-        for rule_entry in Rule.db.all():
-            rule = lajter.rule.from_entry(rule_entry)
+        for rule in lajter.rule.get_all():
             rules += rule.to_string()
             if len(rules) > 1500:
                 await ctx.reply(rules)
@@ -266,8 +557,9 @@ class Rules(commands.Cog):
     @commands.has_guild_permissions(administrator=True)
     async def read_public_rules(self, ctx: commands.Context):
         rules = ""
-        for rule_entry in Rule.db.search(where('public') == True):
-            rule = lajter.rule.from_entry(rule_entry)
+        for rule in lajter.rule.get_all():
+            if not rule.public:
+                continue
             rules += rule.to_string()
             if len(rules) > 1500:
                 await ctx.reply(rules)
@@ -277,6 +569,74 @@ class Rules(commands.Cog):
             await ctx.reply(rules)
 
 
+    @commands.command(
+        name="ruletest",
+        brief="Sprawdź zasadę na ostatnich wiadomościach",
+        help="<typ zasady> <regexy...>"
+    )
+    @commands.guild_only()
+    @commands.has_guild_permissions(administrator=True)
+    async def test_rule(self, ctx: commands.Context, rule_type: str,
+                        *regexes: str):
+        try:
+            rule_type = RuleType(rule_type)
+        except ValueError:
+            await ctx.reply("Niepoprawny typ zasady")
+            return
+
+        if rule_type not in (RuleType.MESSAGE, RuleType.ROLE):
+            await ctx.reply("Na ostatnich wiadomościach można sprawdzić "
+                            "tylko zasady typu `message` i `role`")
+            return
+        if len(lajter.rule.text_regexes(rule_type, list(regexes))) == 0:
+            await ctx.reply("Musisz podać regex, dla zasad typu `role` "
+                            "po roli")
+            return
+
+        error = screen_regexes(rule_type, list(regexes))
+        if error:
+            await ctx.reply(error)
+            return
+
+        # The candidate is checked like a saved rule, but never saved
+        rule = Rule(rule_type, regexes=list(regexes))
+        if len(rule.patterns) < len(lajter.rule.text_regexes(
+                rule_type, rule.regexes)):
+            await ctx.reply("Niepoprawny regex")
+            return
+
+        messages = self.recent_messages.all()
+        if rule_type is RuleType.ROLE:
+            try:
+                role = utils.role_from_mention(ctx.guild, regexes[0])
+            except ValueError:
+                role = None
+            if role is None:
+                await ctx.reply("Niepoprawna rola")
+                return
+            messages = [message for message in messages
+                        if (member := ctx.guild.get_member(message.author_id))
+                        and member.get_role(role.id)]
+
+        start = time.perf_counter()
+        results = await rule.search_each(
+            [message.texts(rule_type) for message in messages])
+        elapsed = time.perf_counter() - start
+
+        hits = [message for message, hit in zip(messages, results) if hit]
+        channels = {message.channel_id for message in hits}
+        s = (f'Zasada pasuje do **{len(hits)}** z {len(messages)} ostatnich '
+             f'wiadomości w {len(channels)} kanałach, sprawdzenie trwało '
+             f'{elapsed * 1000:.1f} ms')
+        for message in hits[-RULETEST_SAMPLES:]:
+            text = message.content or ", ".join(message.filenames)
+            if len(text) > RULETEST_SAMPLE_LENGTH:
+                text = text[:RULETEST_SAMPLE_LENGTH] + "…"
+            s += (f'\n<#{message.channel_id}> <@{message.author_id}>: '
+                  f'{discord.utils.escape_markdown(text)}')
+        await ctx.reply(s, allowed_mentions=discord.AllowedMentions.none())
+
+
     @commands.command(name="ruletypes", brief="Wyświetl typy zasad")
     @commands.has_guild_permissions(administrator=True)
     async def read_rule_types(self, ctx: commands.Context):
@@ -299,20 +659,23 @@ class Rules(commands.Cog):
                             "numer publicznej akcji.")
             return
 
+        error = screen_regexes(RuleType.MESSAGE, [word])
+        if error:
+            await ctx.reply(error)
+            return
+
         action = lajter.action.get_by_id(action_id)
         if not action or not action.public:
             await ctx.reply("Musisz podać numer publicznej akcji.")
             return
 
-        db_user = lajter.user.get_by_id(ctx.author.id)
+        async with lajter.user.unit_of_work(ctx.author.id) as (db_user,):
+            if db_user.points < 1500:
+                await ctx.reply("Potrzebujesz **1500 punktów**, "
+                                "żeby rozpocząć głosowanie.")
+                return
 
-        if db_user.points < 1500:
-            await ctx.reply("Potrzebujesz **1500 punktów**, "
-                            "żeby rozpocząć głosowanie.")
-            return
-
-        db_user.points -= 1500
-        db_user.save()
+            db_user.points -= 1500
 
         default_channel = await lajter.utils.get_default_channel(self.bot)
         rule = Rule(RuleType.MESSAGE, regexes=[word],
@@ -327,26 +690,19 @@ class Rules(commands.Cog):
         s += f' Głosowanie potrwa do `{vote_until.hour}:{vote_until.minute}`'
 
         poll = await default_channel.send(s)
+        # The rule is added by the polls cog if the vote passes
+        lajter.poll.Poll(
+            lajter.poll.PollKind.RULE,
+            default_channel.id,
+            poll.id,
+            vote_until,
+            author_id=ctx.author.id,
+            rule={
+                'type': rule.rule_type.value,
+                'regexes': rule.regexes,
+                'actions': rule.actions,
+                'public': rule.public
+            }
+        ).save()
         await poll.add_reaction("👍")
         await poll.add_reaction("👎")
-
-        await asyncio.sleep(timeout.seconds)
-
-        poll = await default_channel.fetch_message(poll.id)
-
-        result = 0
-
-        for reaction in poll.reactions:
-            if reaction.emoji == "👍":
-                result += reaction.count
-            elif reaction.emoji == "👎":
-                result -= reaction.count
-
-        if result > 0:
-            rule.save()
-            await poll.reply(f'Głosowanie w sprawie zasady nr '
-                             f'**{rule.id}** przeszło większością głosów')
-            logger.info(f'{ctx.author} utworzył zasadę:'
-                        f' {rule.to_string()}')
-        else:
-            await poll.reply("Głosowanie nie uzyskało większości głosów")
@@ -0,0 +1,225 @@
+import asyncio
+import datetime
+from abc import ABC, abstractmethod
+from typing import Dict, Hashable, List, Set
+
+import discord
+from discord import Member, Message, Role
+
+import lajter.metrics as metrics
+
+# How long changes are collected before they are sent, changes queued for
+# the same member or channel in the meantime are sent in a single request
+COALESCE_DELAY = 0.2
+MESSAGE_LIMIT = 2000
+BULK_DELETE_LIMIT = 100
+BULK_DELETE_MAX_AGE = datetime.timedelta(days=14)
+
+_MISSING = object()
+
+
+# Changes waiting to be sent in one request. Everyone who queued a change
+# waits for the request and gets its error if it fails
+class _Batch(ABC):
+    def __init__(self):
+        self.futures: List[asyncio.Future] = []
+
+    @abstractmethod
+    async def send(self):
+        ...
+
+
+class _MemberEdit(_Batch):
+    def __init__(self, member: Member):
+        super().__init__()
+        self.member = member
+        self.added: Dict[int, Role] = {}
+        self.removed: Set[int] = set()
+        self.nick = _MISSING
+
+    def add_roles(self, roles: List[Role]):
+        for role in roles:
+            self.added[role.id] = role
+            self.removed.discard(role.id)
+
+    def remove_roles(self, roles: List[Role]):
+        for role in roles:
+            self.added.pop(role.id, None)
+            self.removed.add(role.id)
+
+    async def send(self):
+        # A single role change is sent as its own request, which adds or
+        # removes just that role whatever else changed in the meantime
+        if self.nick is _MISSING and len(self.added) + len(self.removed) == 1:
+            if self.added:
+                with metrics.rest("member.add_roles"):
+                    await self.member.add_roles(*self.added.values())
+            else:
+                with metrics.rest("member.remove_roles"):
+                    await self.member.remove_roles(
+                        *(discord.Object(id=role_id)
+                          for role_id in self.removed))
+            return
+
+        # Merged changes replace the whole list of roles, so it's built from
+        # the gateway's state of the member, never from a fetched copy that
+        # may be out of date
+        member = self.member.guild.get_member(self.member.id)
+        if member is None:
+            await self.send_separately()
+            return
+
+        current = {role.id: role for role in member.roles
+                   if not role.is_default()}
+        roles = dict(current)
+        roles.update(self.added)
+        for role_id in self.removed:
+            roles.pop(role_id, None)
+
+        changes = {}
+        if roles.keys() != current.keys():
+            changes['roles'] = list(roles.values())
+        if self.nick is not _MISSING:
+            changes['nick'] = self.nick
+        if changes:
+            with metrics.rest("member.edit"):
+                await member.edit(**changes)
+
+    async def send_separately(self):
+        if self.added:
+            with metrics.rest("member.add_roles"):
+                await self.member.add_roles(*self.added.values())
+        if self.removed:
+            with metrics.rest("member.remove_roles"):
+                await self.member.remove_roles(
+                    *(discord.Object(id=role_id) for role_id in self.removed))
+        if self.nick is not _MISSING:
+            with metrics.rest("member.edit"):
+                await self.member.edit(nick=self.nick)
+
+
+class _Messages(_Batch):
+    def __init__(self, channel: discord.abc.Messageable):
+        super().__init__()
+        self.channel = channel
+        self.contents: List[str] = []
+
+    # Messages are joined with new lines as long as they fit in one message
+    async def send(self):
+        content = ""
+        for part in self.contents:
+            if content and len(content) + len(part) + 1 > MESSAGE_LIMIT:
+                with metrics.rest("channel.send"):
+                    await self.channel.send(content)
+                content = ""
+            content = f'{content}\n{part}' if content else part
+        if content:
+            with metrics.rest("channel.send"):
+                await self.channel.send(content)
+
+
+class _Deletes(_Batch):
+    def __init__(self, channel: discord.abc.Messageable):
+        super().__init__()
+        self.channel = channel
+        self.messages: Dict[int, Message] = {}
+
+    # Only messages younger than two weeks can be deleted in bulk
+    async def send(self):
+        oldest = discord.utils.utcnow() - BULK_DELETE_MAX_AGE
+        bulk = []
+        for message in self.messages.values():
+            if message.created_at > oldest:
+                bulk.append(message)
+            else:
+                with metrics.rest("message.delete"):
+                    await message.delete()
+
+        for start in range(0, len(bulk), BULK_DELETE_LIMIT):
+            chunk = bulk[start:start + BULK_DELETE_LIMIT]
+            if len(chunk) == 1:
+                with metrics.rest("message.delete"):
+                    await chunk[0].delete()
+            else:
+                with metrics.rest("channel.delete_messages"):
+                    await self.channel.delete_messages(chunk)
+
+
+# Requests to one route, a member or a channel, are sent one at a time.
+# While a request waits, e.g. for a rate limit, the following changes to the
+# same route keep being merged into the next batch
+class Dispatcher:
+    def __init__(self, delay: float = COALESCE_DELAY):
+        self.delay = delay
+        self._batches: Dict[Hashable, _Batch] = {}
+        self._routes: Dict[Hashable, asyncio.Lock] = {}
+        self._tasks: Set[asyncio.Task] = set()
+
+    def _batch(self, key: Hashable, factory) -> _Batch:
+        batch = self._batches.get(key)
+        if batch is None:
+            batch = factory()
+            self._batches[key] = batch
+            task = asyncio.create_task(self._flush(key))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        return batch
+
+    async def _wait(self, batch: _Batch):
+        future = asyncio.get_running_loop().create_future()
+        batch.futures.append(future)
+        await future
+
+    async def _flush(self, key: Hashable):
+        await asyncio.sleep(self.delay)
+        route = self._routes.setdefault(key, asyncio.Lock())
+        async with route:
+            batch = self._batches.pop(key)
+            try:
+                await batch.send()
+            except Exception as e:
+                for future in batch.futures:
+                    if not future.done():
+                        future.set_exception(e)
+            else:
+                for future in batch.futures:
+                    if not future.done():
+                        future.set_result(None)
+        if not route.locked() and key not in self._batches:
+            self._routes.pop(key, None)
+
+    async def add_roles(self, member: Member, *roles: Role):
+        batch = self._batch(('member', member.guild.id, member.id),
+                            lambda: _MemberEdit(member))
+        batch.member = member
+        batch.add_roles(list(roles))
+        await self._wait(batch)
+
+    async def remove_roles(self, member: Member, *roles: Role):
+        batch = self._batch(('member', member.guild.id, member.id),
+                            lambda: _MemberEdit(member))
+        batch.member = member
+        batch.remove_roles(list(roles))
+        await self._wait(batch)
+
+    async def change_nick(self, member: Member, nick: str | None):
+        batch = self._batch(('member', member.guild.id, member.id),
+                            lambda: _MemberEdit(member))
+        batch.member = member
+        batch.nick = nick
+        await self._wait(batch)
+
+    async def send_message(self, channel: discord.abc.Messageable,
+                           content: str):
+        batch = self._batch(('send', channel.id), lambda: _Messages(channel))
+        batch.contents.append(content)
+        await self._wait(batch)
+
+    async def delete_message(self, message: Message):
+        batch = self._batch(('delete', message.channel.id),
+                            lambda: _Deletes(message.channel))
+        batch.messages[message.id] = message
+        await self._wait(batch)
+
+
+dispatcher = Dispatcher()
@@ -0,0 +1,94 @@
+from collections import OrderedDict, deque
+from typing import Hashable, List, Tuple
+
+from discord import Member, Message
+
+from lajter.rule import RuleType, event_texts
+
+
+# Remembers a fingerprint of the last seen state of members or messages, so
+# rules are only evaluated again when something they look at has changed.
+# Least recently seen keys are forgotten when the filter is full
+class ChangeFilter:
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._fingerprints: OrderedDict[Hashable, int] = OrderedDict()
+
+    def changed(self, key: Hashable, fingerprint: int) -> bool:
+        old_fingerprint = self._fingerprints.get(key)
+        self._fingerprints[key] = fingerprint
+        self._fingerprints.move_to_end(key)
+        if len(self._fingerprints) > self.max_size:
+            self._fingerprints.popitem(last=False)
+        return old_fingerprint != fingerprint
+
+    def forget(self, key: Hashable):
+        self._fingerprints.pop(key, None)
+
+
+# What rules can look at in a message, kept after the message is gone
+class RecentMessage:
+    __slots__ = ("channel_id", "message_id", "author_id", "content",
+                 "filenames")
+
+    def __init__(self, message: Message):
+        self.channel_id: int = message.channel.id
+        self.message_id: int = message.id
+        self.author_id: int = message.author.id
+        self.content: str = message.content
+        self.filenames: Tuple[str, ...] = tuple(
+            attachment.filename for attachment in message.attachments)
+
+    # Same texts as event_texts gives for the message
+    def texts(self, rule_type: RuleType) -> List[str]:
+        texts = [self.content]
+        if rule_type is RuleType.MESSAGE:
+            texts.extend(self.filenames)
+        return [text for text in texts if text]
+
+
+# The last messages of every channel, for trying rules out on real traffic.
+# Every channel keeps at most size messages, the oldest are dropped as new
+# ones arrive, and only the max_channels most recently active channels are
+# kept
+class RecentMessages:
+    def __init__(self, size: int, max_channels: int):
+        self.size = size
+        self.max_channels = max_channels
+        self._channels: OrderedDict[int, deque] = OrderedDict()
+
+    def add(self, message: Message):
+        channel_id = message.channel.id
+        buffer = self._channels.get(channel_id)
+        if buffer is None:
+            buffer = deque(maxlen=self.size)
+            self._channels[channel_id] = buffer
+            if len(self._channels) > self.max_channels:
+                self._channels.popitem(last=False)
+        else:
+            self._channels.move_to_end(channel_id)
+        buffer.append(RecentMessage(message))
+
+    def forget(self, channel_id: int):
+        self._channels.pop(channel_id, None)
+
+    def all(self) -> List[RecentMessage]:
+        return [message for buffer in self._channels.values()
+                for message in buffer]
+
+    def __len__(self) -> int:
+        return sum(len(buffer) for buffer in self._channels.values())
+
+
+# Fingerprints cover exactly the texts the rules of the type are matched
+# against, e.g. a status change doesn't change the activity fingerprint
+def activity_fingerprint(member: Member) -> int:
+    return hash(tuple(event_texts(RuleType.ACTIVITY, member=member)))
+
+
+def name_fingerprint(member: Member) -> int:
+    return hash(member.display_name)
+
+
+def message_fingerprint(message: Message) -> int:
+    return hash(tuple(event_texts(RuleType.MESSAGE, message=message)))
@@ -0,0 +1,101 @@
+from bisect import bisect_left, insort
+from collections import OrderedDict
+from typing import Dict, List, Set, Tuple, Iterable
+
+from discord import Guild
+
+
+# Users sorted by points, highest first. Entries are stored as
+# (-points, user id), so ties are ordered by id and the position of a user
+# is found with a binary search. Moving a user is still O(n), the entries
+# after them are shifted in the list, but that is a single memmove which
+# stays cheap for the members of one guild. Users who are not members of
+# the guild are hidden, they keep their points but are not listed or ranked
+class Leaderboard:
+    def __init__(self, users: Iterable[Tuple[int, int]] = ()):
+        self._points: Dict[int, int] = dict(users)
+        self._hidden: Set[int] = set()
+        self._entries: List[Tuple[int, int]] = sorted(
+            (-points, user_id) for user_id, points in self._points.items())
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def update(self, user_id: int, points: int):
+        old_points = self._points.get(user_id)
+        if old_points == points:
+            return
+        self._points[user_id] = points
+        if user_id in self._hidden:
+            return
+        if old_points is not None:
+            del self._entries[bisect_left(self._entries,
+                                          (-old_points, user_id))]
+        insort(self._entries, (-points, user_id))
+
+    def remove(self, user_id: int):
+        self.hide(user_id)
+        self._hidden.discard(user_id)
+        self._points.pop(user_id, None)
+
+    def hide(self, user_id: int):
+        if user_id in self._hidden:
+            return
+        self._hidden.add(user_id)
+        points = self._points.get(user_id)
+        if points is not None:
+            del self._entries[bisect_left(self._entries, (-points, user_id))]
+
+    def show(self, user_id: int):
+        if user_id not in self._hidden:
+            return
+        self._hidden.discard(user_id)
+        points = self._points.get(user_id)
+        if points is not None:
+            insort(self._entries, (-points, user_id))
+
+    # Hides everyone but the users, e.g. the members of the guild
+    def show_only(self, user_ids: Set[int]):
+        self._hidden = set(self._points) - user_ids
+        self._entries = sorted(
+            (-points, user_id) for user_id, points in self._points.items()
+            if user_id not in self._hidden)
+
+    # Position of the user counting from 1, or None if they are not listed
+    def rank(self, user_id: int) -> int | None:
+        points = self._points.get(user_id)
+        if points is None or user_id in self._hidden:
+            return None
+        return bisect_left(self._entries, (-points, user_id)) + 1
+
+    # (rank, user id, points) of the users on the page, counting from 0
+    def page(self, page: int, per_page: int) -> List[Tuple[int, int, int]]:
+        start = page * per_page
+        return [(start + i + 1, user_id, -points) for i, (points, user_id)
+                in enumerate(self._entries[start:start + per_page])]
+
+
+# Display names of members by id, least recently used ones are dropped
+# when the cache is full
+class NameCache:
+    def __init__(self, max_size: int = 1024):
+        self.max_size = max_size
+        self._names: OrderedDict[int, str] = OrderedDict()
+
+    def get(self, guild: Guild, user_id: int) -> str | None:
+        name = self._names.get(user_id)
+        if name is not None:
+            self._names.move_to_end(user_id)
+            return name
+
+        member = guild.get_member(user_id)
+        if member is None:
+            return None
+
+        self._names[user_id] = member.display_name
+        if len(self._names) > self.max_size:
+            self._names.popitem(last=False)
+        return member.display_name
+
+    def invalidate(self, user_id: int):
+        self._names.pop(user_id, None)
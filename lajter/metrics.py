@@ -0,0 +1,171 @@
+import functools
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Dict, List, Tuple
+
+# Process-wide counters and latency histograms. Updating them is a dict
+# lookup and an addition, so they are always on. They are read by !stats
+# and by the Prometheus endpoint of the metrics cog
+
+# Upper bounds of the histogram buckets in seconds, the last bucket is +Inf
+BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+DESCRIPTIONS = {
+    "lajter_events_total": "Gateway events received by type",
+    "lajter_listener_seconds": "Time spent in event listeners",
+    "lajter_rules_evaluated_total": "Rules evaluated by rule type",
+    "lajter_rules_broken_total": "Rules broken by rule type",
+    "lajter_rule_broken_total": "Times each rule was broken",
+    "lajter_rule_checks_total": "Calls of Rule.check by rule type",
+    "lajter_regex_overruns_total":
+        "Times the regexes of each rule ran out of time",
+    "lajter_regex_worker_restarts_total":
+        "Regex workers killed after running out of time",
+    "lajter_rules_quarantined_total": "Rules disabled for slow regexes",
+    "lajter_backfill_messages_total": "Messages scanned by history scans",
+    "lajter_backfill_matches_total":
+        "Messages found breaking a rule by history scans",
+    "lajter_spam_messages_total": "Messages recognised as spam by kind",
+    "lajter_action_seconds": "Time spent executing actions by action type",
+    "lajter_action_failures_total": "Actions that failed by action type",
+    "lajter_user_saves_total": "Users marked for saving",
+    "lajter_storage_writes_total": "Writes to the storage by table",
+    "lajter_storage_entries_written_total":
+        "Entries written or removed by table",
+    "lajter_rest_requests_total": "REST requests by route",
+    "lajter_rest_request_seconds": "Time spent in REST requests by route",
+}
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Histogram:
+    def __init__(self):
+        self.buckets: List[int] = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds: float):
+        self.buckets[bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    # Estimated from the buckets, as precise as they are
+    def quantile(self, q: float) -> float:
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS + (float("inf"),), self.buckets):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+
+_counters: Dict[str, Dict[Labels, float]] = {}
+_histograms: Dict[str, Dict[Labels, Histogram]] = {}
+
+
+def _labels(labels: dict) -> Labels:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def inc(name: str, value: float = 1, **labels):
+    series = _counters.setdefault(name, {})
+    key = _labels(labels)
+    series[key] = series.get(key, 0) + value
+
+
+def observe(name: str, seconds: float, **labels):
+    series = _histograms.setdefault(name, {})
+    key = _labels(labels)
+    histogram = series.get(key)
+    if histogram is None:
+        histogram = series[key] = Histogram()
+    histogram.observe(seconds)
+
+
+@contextmanager
+def timer(name: str, **labels):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+# Counts and times a REST request of the bot, routes are named after the
+# call that makes them, e.g. member.edit
+@contextmanager
+def rest(route: str):
+    inc("lajter_rest_requests_total", route=route)
+    with timer("lajter_rest_request_seconds", route=route):
+        yield
+
+
+# Measures the time spent in a listener, placed under Cog.listener
+def timed_listener(listener):
+    name = listener.__qualname__
+
+    @functools.wraps(listener)
+    async def wrapper(*args, **kwargs):
+        with timer("lajter_listener_seconds", listener=name):
+            return await listener(*args, **kwargs)
+    return wrapper
+
+
+def counters(name: str) -> Dict[Labels, float]:
+    return dict(_counters.get(name, {}))
+
+
+def histograms(name: str) -> Dict[Labels, Histogram]:
+    return dict(_histograms.get(name, {}))
+
+
+def reset():
+    _counters.clear()
+    _histograms.clear()
+
+
+def _escape(value: str) -> str:
+    return (value.replace("\\", "\\\\").replace('"', '\\"')
+            .replace("\n", "\\n"))
+
+
+def _format_labels(labels: Labels, extra: Labels = ()) -> str:
+    labels = labels + extra
+    if not labels:
+        return ""
+    values = ",".join(f'{key}="{_escape(value)}"' for key, value in labels)
+    return f'{{{values}}}'
+
+
+def _format_bound(bound: float) -> str:
+    return "+Inf" if bound == float("inf") else repr(bound)
+
+
+# All metrics in the Prometheus text exposition format
+def render_prometheus() -> str:
+    lines = []
+    for name, series in sorted(_counters.items()):
+        lines.append(f'# HELP {name} {DESCRIPTIONS.get(name, name)}')
+        lines.append(f'# TYPE {name} counter')
+        for labels, value in sorted(series.items()):
+            lines.append(f'{name}{_format_labels(labels)} {value}')
+
+    for name, series in sorted(_histograms.items()):
+        lines.append(f'# HELP {name} {DESCRIPTIONS.get(name, name)}')
+        lines.append(f'# TYPE {name} histogram')
+        for labels, histogram in sorted(series.items()):
+            cumulative = 0
+            for bound, count in zip(BUCKETS + (float("inf"),),
+                                    histogram.buckets):
+                cumulative += count
+                le = (("le", _format_bound(bound)),)
+                lines.append(f'{name}_bucket'
+                             f'{_format_labels(labels, le)} {cumulative}')
+            lines.append(f'{name}_sum{_format_labels(labels)} '
+                         f'{histogram.sum}')
+            lines.append(f'{name}_count{_format_labels(labels)} '
+                         f'{histogram.count}')
+    return "\n".join(lines) + "\n"
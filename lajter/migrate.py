@@ -0,0 +1,40 @@
+import argparse
+import logging
+import os
+
+from dotenv import load_dotenv
+
+import lajter.settings
+from lajter.storage import TABLES, TinyDBStorage, SQLiteStorage
+
+logger = logging.getLogger('MIGRATE')
+logger.setLevel(logging.DEBUG)
+
+
+def migrate(database: str, directory: str = "."):
+    for table, indexes in TABLES.items():
+        path = os.path.join(directory, f'{table}.json')
+        if not os.path.exists(path):
+            logger.warning(f'{path} does not exist, skipping')
+            continue
+
+        entries = TinyDBStorage(path).all()
+        SQLiteStorage(database, table, indexes).upsert_many(entries)
+        logger.info(f'Migrated {len(entries)} entries from {path} '
+                    f'to {database}')
+
+
+if __name__ == "__main__":
+    logging.basicConfig()
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(
+        description="Copy rules, actions, users and polls from the JSON files "
+                    "to an SQLite database")
+    parser.add_argument("--database",
+                        default=lajter.settings.get().database)
+    parser.add_argument("--directory", default=".",
+                        help="directory containing the JSON files")
+    args = parser.parse_args()
+
+    migrate(args.database, args.directory)
@@ -0,0 +1,145 @@
+from datetime import datetime
+from enum import Enum
+from typing import Dict, List
+
+import lajter.storage
+from lajter.scheduler import DeadlineScheduler
+
+# Open polls, loaded from the database once. Every poll has its deadline in
+# the scheduler, the polls cog finishes them when the deadlines pass, also
+# the ones that were still open when the bot was stopped
+_polls: Dict[int, 'Poll'] | None = None
+_by_message: Dict[int, int] = {}
+scheduler = DeadlineScheduler()
+
+# Votes are cast with these reactions
+VOTES = {"👍": 1, "👎": -1}
+
+
+def _load() -> Dict[int, 'Poll']:
+    global _polls
+    if _polls is None:
+        _polls = {}
+        for entry in Poll.db.all():
+            poll = from_entry(entry)
+            _polls[poll.id] = poll
+            _by_message[poll.message_id] = poll.id
+    return _polls
+
+
+def get_by_id(poll_id: int) -> 'Poll | None':
+    return _load().get(poll_id)
+
+
+def get_by_message(message_id: int) -> 'Poll | None':
+    poll_id = _by_message.get(message_id)
+    if poll_id is None:
+        return None
+    return get_by_id(poll_id)
+
+
+def get_all() -> List['Poll']:
+    return sorted(_load().values(), key=lambda poll: poll.deadline)
+
+
+def remove(poll_id: int):
+    poll = _load().pop(poll_id, None)
+    if poll:
+        _by_message.pop(poll.message_id, None)
+    scheduler.cancel(poll_id)
+    Poll.db.remove(poll_id)
+
+
+def from_entry(entry) -> 'Poll':
+    return Poll(
+        entry['kind'],
+        entry['channel'],
+        entry['message'],
+        datetime.fromisoformat(entry['deadline']),
+        entry['id'],
+        entry.get('origin'),
+        entry.get('author'),
+        entry.get('target'),
+        entry.get('action'),
+        entry.get('rule')
+    )
+
+
+class PollKind(Enum):
+    # Vote against a member, the follow-up action is executed on them
+    ACTION = "action"
+    # Vote started by !voterule, the rule is added if it passes
+    RULE = "rule"
+
+
+class Poll:
+    db = lajter.storage.open_storage("polls")
+
+    def __init__(self, kind: PollKind | str, channel_id: int, message_id: int,
+                 deadline: datetime, poll_id=None, origin_id: int = None,
+                 author_id: int = None, target_id: int = None,
+                 action_id: int = None, rule: dict = None):
+        self.id = poll_id
+
+        if type(kind) is str:
+            self.kind: PollKind = PollKind(kind)
+        else:
+            self.kind = kind
+
+        # The poll message and the channel of the event that started it
+        self.channel_id = channel_id
+        self.message_id = message_id
+        self.origin_id = origin_id
+        self.deadline = deadline
+        self.author_id = author_id
+        self.target_id = target_id
+        self.action_id = action_id
+        self.rule = rule
+        # Votes by user id, counted live from reactions and not stored
+        self.votes: Dict[int, int] = {}
+
+    # Every user has a single vote, the last voting reaction they added.
+    # Removing that reaction takes the vote back
+    def add_vote(self, user_id: int, emoji: str):
+        if emoji in VOTES:
+            self.votes[user_id] = VOTES[emoji]
+
+    def remove_vote(self, user_id: int, emoji: str):
+        if emoji in VOTES and self.votes.get(user_id) == VOTES[emoji]:
+            del self.votes[user_id]
+
+    def result(self) -> int:
+        return sum(self.votes.values())
+
+    def passed(self) -> bool:
+        return self.result() > 0
+
+    # A poll is settled early once more than half of everyone who can vote
+    # is for it, or at least half is against it
+    def decided(self, voters: int) -> bool:
+        votes_for = sum(1 for vote in self.votes.values() if vote > 0)
+        votes_against = len(self.votes) - votes_for
+        return votes_for * 2 > voters or votes_against * 2 >= voters
+
+    def save(self):
+        polls = _load()
+        entry = {
+            'id': self.id,
+            'kind': self.kind.value,
+            'channel': self.channel_id,
+            'message': self.message_id,
+            'deadline': self.deadline.isoformat(),
+            'origin': self.origin_id,
+            'author': self.author_id,
+            'target': self.target_id,
+            'action': self.action_id,
+            'rule': self.rule
+        }
+        if self.id is None:
+            self.id = Poll.db.insert(entry)
+        else:
+            Poll.db.upsert(entry)
+
+        polls[self.id] = self
+        _by_message[self.message_id] = self.id
+        scheduler.schedule(self.id, self.deadline)
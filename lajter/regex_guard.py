@@ -0,0 +1,389 @@
+import asyncio
+import logging
+import multiprocessing
+import re
+import signal
+from typing import Dict, Hashable, Iterable, List, Set, Tuple
+
+try:
+    from re import _parser as sre_parse
+except ImportError:
+    import sre_parse
+
+import lajter.metrics as metrics
+import lajter.settings
+
+logger = logging.getLogger('REGEX')
+logger.setLevel(logging.DEBUG)
+
+# Rule regexes are written by admins and, through !voterule, by players.
+# Python can't interrupt a running regex, so with a time budget set they are
+# run in a worker process that is killed when a match takes too long, and
+# a bad regex costs the event loop nothing but the wait for the budget
+
+# Time given to the worker to build the matchers of a rule set
+LOAD_TIMEOUT = 10
+# Events matched in one question by match_each, they share one budget
+BATCH_SIZE = 100
+
+# A killed worker has to be replaced by a copy of this process
+_CONTEXT = (multiprocessing.get_context("fork")
+            if "fork" in multiprocessing.get_all_start_methods() else None)
+
+
+# Reason why a regex may backtrack catastrophically, or None. Catches the
+# usual shapes, a repeat of something that can match the same text in many
+# ways: a nested repeat like (a+)+ or (\w+\s?)*, whose inner repeat can
+# match what comes after it in the outer one, or a repeated alternation
+# with overlapping branches like (a|ab)*. Repeats like (\d{1,3}\.){3} or
+# ([a-z]+\.)+ split a text only one way and are let through
+def redos_risk(regex: str) -> str | None:
+    try:
+        parsed = sre_parse.parse(regex)
+    except (re.error, RecursionError, OverflowError):
+        # Invalid regexes are reported when the rule is compiled
+        return None
+    return _risk(parsed, False, set())
+
+
+# Characters a match of the regex can start with, lowercased, or None if
+# they are not known or it can match an empty text
+def first_chars(regex: str) -> Set[str] | None:
+    try:
+        return _first_chars(sre_parse.parse(regex))
+    except (re.error, RecursionError, OverflowError):
+        return None
+
+
+# Characters of the categories that can be told apart, the others are
+# treated as if they could match anything
+_CATEGORIES = {
+    sre_parse.CATEGORY_DIGIT: set("0123456789"),
+    sre_parse.CATEGORY_SPACE: set(" \t\n\r\f\v"),
+}
+
+
+def _union(a: Set[str] | None, b: Set[str] | None) -> Set[str] | None:
+    if a is None or b is None:
+        return None
+    return a | b
+
+
+def _overlap(a: Set[str] | None, b: Set[str] | None) -> bool:
+    return a is None or b is None or bool(a & b)
+
+
+# Whether the variable repeats of the subpattern can match the text that
+# follows them in a different way. Repeated tells if the subpattern is in
+# a repeat of a variable count, follow are the characters that can come
+# after it in that repeat, its next round included
+def _risk(parsed, repeated: bool, follow: Set[str] | None) -> str | None:
+    items = list(parsed)
+    for i, (op, av) in enumerate(items):
+        after, empty = _first(items[i + 1:])
+        if empty:
+            after = _union(after, follow)
+
+        if op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT,
+                  sre_parse.POSSESSIVE_REPEAT):
+            min_count, max_count, subpattern = av
+            first = _first(subpattern)[0]
+            # A possessive repeat never gives back what it matched, a repeat
+            # of a fixed count can't split a text in different ways
+            variable = (max_count != min_count
+                        and op is not sre_parse.POSSESSIVE_REPEAT)
+            if repeated and variable and _overlap(first, after):
+                return "zagnieżdżone powtórzenie"
+
+            if max_count > 1:
+                inner_follow = first if variable and not repeated \
+                    else _union(first, after)
+            else:
+                inner_follow = after
+            reason = _risk(subpattern, repeated or (variable
+                                                   and max_count > 1),
+                           inner_follow)
+            if reason:
+                return reason
+        elif op is sre_parse.SUBPATTERN:
+            reason = _risk(av[-1], repeated, after)
+            if reason:
+                return reason
+        elif op is sre_parse.ATOMIC_GROUP:
+            # An atomic group still backtracks inside until it matches
+            reason = _risk(av, repeated, after)
+            if reason:
+                return reason
+        elif op in (sre_parse.ASSERT, sre_parse.ASSERT_NOT):
+            # A lookaround is matched on its own, at every position
+            reason = _risk(av[1], False, set())
+            if reason:
+                return reason
+        elif op is sre_parse.BRANCH:
+            branches = av[1]
+            if repeated and _overlapping(branches):
+                return "powtarzana alternatywa o wspólnych początkach"
+            for branch in branches:
+                reason = _risk(branch, repeated, after)
+                if reason:
+                    return reason
+    return None
+
+
+def _overlapping(branches) -> bool:
+    seen: Set[str] = set()
+    for branch in branches:
+        first = _first_chars(branch)
+        if first is None or first & seen:
+            return True
+        seen |= first
+    return False
+
+
+# Characters a match of the subpattern can start with, None if it's not
+# known or the subpattern can match an empty text
+def _first_chars(parsed) -> Set[str] | None:
+    chars, empty = _first(parsed)
+    return None if empty else chars
+
+
+# Characters a match of the subpattern can start with, None if they are not
+# known, and whether it can match an empty text
+def _first(parsed) -> Tuple[Set[str] | None, bool]:
+    chars: Set[str] | None = set()
+    for op, av in parsed:
+        item, empty = _first_item(op, av)
+        chars = _union(chars, item)
+        if not empty:
+            return chars, False
+    return chars, True
+
+
+def _first_item(op, av) -> Tuple[Set[str] | None, bool]:
+    if op in (sre_parse.AT, sre_parse.ASSERT, sre_parse.ASSERT_NOT):
+        return set(), True
+    if op is sre_parse.LITERAL:
+        return {chr(av).lower()}, False
+    if op is sre_parse.IN:
+        chars = set()
+        for item_op, item_av in av:
+            if item_op is sre_parse.LITERAL:
+                chars.add(chr(item_av).lower())
+            elif item_op is sre_parse.RANGE and \
+                    item_av[1] - item_av[0] < 256:
+                chars.update(chr(code).lower() for code
+                             in range(item_av[0], item_av[1] + 1))
+            elif item_op is sre_parse.CATEGORY and item_av in _CATEGORIES:
+                chars |= _CATEGORIES[item_av]
+            else:
+                return None, False
+        return chars, False
+    if op is sre_parse.SUBPATTERN:
+        return _first(av[-1])
+    if op is sre_parse.ATOMIC_GROUP:
+        return _first(av)
+    if op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT,
+              sre_parse.POSSESSIVE_REPEAT):
+        chars, empty = _first(av[2])
+        return chars, empty or av[0] == 0
+    if op is sre_parse.BRANCH:
+        chars = set()
+        any_empty = False
+        for branch in av[1]:
+            first, empty = _first(branch)
+            chars = _union(chars, first)
+            any_empty = any_empty or empty
+        return chars, any_empty
+    if op is sre_parse.GROUPREF:
+        return None, True
+    return None, False
+
+
+# What the worker needs of a rule to build a Matcher
+class _WorkerRule:
+    def __init__(self, rule_id: int, patterns: List[re.Pattern],
+                 literals: List[str | None]):
+        self.id = rule_id
+        self.patterns = patterns
+        self.literals = literals
+
+
+def _serve(conn, parent_conn):
+    # Signals are handled by the bot, not by its copy
+    signal.set_wakeup_fd(-1)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    parent_conn.close()
+
+    from lajter.rule import Matcher
+
+    matchers = {}
+    while True:
+        try:
+            request = conn.recv()
+        except (EOFError, OSError):
+            return
+
+        match request:
+            case ("load", key, rules):
+                matchers[key] = Matcher(tuple(
+                    _WorkerRule(*rule) for rule in rules))
+                conn.send(None)
+            case ("match", key, texts):
+                conn.send(matchers[key].match(texts))
+            case ("each", key, events):
+                conn.send([matchers[key].match(texts) for texts in events])
+            case ("search", pattern, texts):
+                conn.send(any(pattern.search(text) for text in texts))
+
+
+# One worker process, asked one question at a time. A question not answered
+# within the budget gets the worker killed, the next one starts a new worker
+class RegexGuard:
+    def __init__(self, budget: float):
+        self.budget = budget
+        self._process: multiprocessing.Process | None = None
+        self._conn = None
+        # Version of the rules each matcher of the worker was built from
+        self._loaded: Dict[Hashable, object] = {}
+        self._lock = asyncio.Lock()
+
+    def _start(self):
+        self._conn, child_conn = _CONTEXT.Pipe()
+        self._process = _CONTEXT.Process(
+            target=_serve, args=(child_conn, self._conn),
+            name="regex-guard", daemon=True)
+        self._process.start()
+        child_conn.close()
+        logger.debug(f'Started the regex worker {self._process.pid}')
+
+    def stop(self):
+        if self._process is not None:
+            self._process.kill()
+            self._process.join()
+            self._conn.close()
+        self._process = None
+        self._conn = None
+        self._loaded.clear()
+
+    async def _request(self, request, timeout: float):
+        if self._process is None or not self._process.is_alive():
+            self.stop()
+            self._start()
+
+        loop = asyncio.get_running_loop()
+        ready = loop.create_future()
+        fd = self._conn.fileno()
+        loop.add_reader(fd, lambda: ready.done() or ready.set_result(None))
+        try:
+            try:
+                self._conn.send(request)
+                await asyncio.wait_for(ready, timeout)
+            finally:
+                loop.remove_reader(fd)
+        except TimeoutError:
+            # A running regex can't be stopped, only its process
+            self.stop()
+            metrics.inc("lajter_regex_worker_restarts_total")
+            raise
+        except BaseException:
+            # The answer would be read as the answer to the next question
+            self.stop()
+            raise
+        return self._conn.recv()
+
+    # The worker keeps a matcher for each key and rebuilds it when the
+    # version, e.g. the tuple of rules, changes
+    async def _load(self, key: Hashable, version: object, rules: List):
+        if self._loaded.get(key) is not version:
+            await self._request(
+                ("load", key, [(rule.id, rule.patterns, rule.literals)
+                               for rule in rules]),
+                LOAD_TIMEOUT)
+            self._loaded[key] = version
+
+    # Ids of the rules that match any of the texts, and of the rules whose
+    # regexes ran out of time
+    async def match(
+            self,
+            key: Hashable,
+            version: object,
+            rules: Iterable,
+            texts: List[str]
+    ) -> Tuple[Set[int], Set[int]]:
+        rules = list(rules)
+        async with self._lock:
+            try:
+                await self._load(key, version, rules)
+                return (await self._request(("match", key, texts),
+                                            self.budget), set())
+            except TimeoutError:
+                pass
+
+            # The regexes are run one by one to find the slow ones, the
+            # others still decide whether their rules were broken
+            logger.warning(f'Matching {key} ran out of time, '
+                           f'checking its regexes one by one')
+            matched = set()
+            overran = set()
+            for rule in rules:
+                for pattern in rule.patterns:
+                    try:
+                        if await self._request(("search", pattern, texts),
+                                               self.budget):
+                            matched.add(rule.id)
+                            break
+                    except TimeoutError:
+                        overran.add(rule.id)
+                        break
+            return matched, overran
+
+    # Like match for many events, with the events sent in batches. Other
+    # events are matched between the batches
+    async def match_each(
+            self,
+            key: Hashable,
+            version: object,
+            rules: Iterable,
+            events: List[List[str]]
+    ) -> Tuple[List[Set[int]], Set[int]]:
+        rules = list(rules)
+        results = []
+        overran = set()
+        for start in range(0, len(events), BATCH_SIZE):
+            batch = events[start:start + BATCH_SIZE]
+            async with self._lock:
+                try:
+                    await self._load(key, version, rules)
+                    results.extend(await self._request(("each", key, batch),
+                                                       self.budget))
+                    continue
+                except TimeoutError:
+                    pass
+
+            # Only a batch that ran out of time is matched event by event
+            for texts in batch:
+                matched, slow = await self.match(key, version, rules, texts)
+                results.append(matched)
+                overran |= slow
+        return results, overran
+
+
+_guard: RegexGuard | None = None
+
+
+# The guard set up with the current budget, None if regexes are run in
+# this process
+def get() -> RegexGuard | None:
+    global _guard
+    budget = lajter.settings.get().regex_budget_ms
+    if budget <= 0 or _CONTEXT is None:
+        if _guard is not None:
+            _guard.stop()
+            _guard = None
+        return None
+
+    if _guard is None:
+        _guard = RegexGuard(budget / 1000)
+    _guard.budget = budget / 1000
+    return _guard
@@ -1,26 +1,240 @@
 import datetime
 import re
+from bisect import bisect_left, bisect_right
 import logging
+from collections import deque
 from enum import Enum
-from typing import List
+from typing import List, Dict, Tuple, Set, Iterable
+
+try:
+    from re import _parser as sre_parse
+except ImportError:
+    import sre_parse
 
 from discord import Member, Spotify, Reaction, TextChannel, Message, Emoji
 from discord.ext import commands
-from tinydb import TinyDB, where
 import lajter.action
+import lajter.metrics as metrics
+import lajter.regex_guard as regex_guard
+import lajter.spam
 from lajter.action import Action
+import lajter.storage
 import lajter.user
 
 logger = logging.getLogger('RULE')
 logger.setLevel(logging.DEBUG)
 
+# Process-wide registry of rules, loaded from the database once and kept
+# in sync by Rule.save and remove
+_rules: Dict[int, 'Rule'] | None = None
+_by_type: Dict['RuleType', Tuple['Rule', ...]] = {}
+_matchers: Dict['RuleType', 'Matcher'] = {}
+_points_index: 'PointsIndex | None' = None
+
+# Times in a row a rule's regexes may run out of time before the rule is
+# quarantined, i.e. no longer checked until its regexes are edited
+QUARANTINE_OVERRUNS = 3
+_overruns: Dict[int, int] = {}
+# Quarantined rules not yet reported to the default channel
+_unreported: List['Rule'] = []
+
+
+def _load() -> Dict[int, 'Rule']:
+    global _rules
+    if _rules is None:
+        _rules = {}
+        for entry in Rule.db.all():
+            rule = from_entry(entry)
+            _rules[rule.id] = rule
+            for regex, reason in screen(rule.rule_type, rule.regexes):
+                logger.warning(f'Rule {rule.id} has a regex that may '
+                               f'backtrack catastrophically {regex!r}')
+        _reindex()
+    return _rules
+
+
+def _reindex():
+    buckets = {rule_type: [] for rule_type in RuleType}
+    for rule_id in sorted(_rules):
+        rule = _rules[rule_id]
+        buckets[rule.rule_type].append(rule)
+    for rule_type, rules in buckets.items():
+        rules = tuple(rules)
+        if _by_type.get(rule_type) != rules:
+            _invalidate(rule_type)
+        _by_type[rule_type] = rules
+
+
+def _invalidate(rule_type: 'RuleType'):
+    global _points_index
+    _matchers.pop(rule_type, None)
+    if rule_type in POINTS_RULE_TYPES:
+        _points_index = None
+
+
 def get_by_id(rule_id):
-    entries = Rule.db.search(where('id') == rule_id)
-    if len(entries) > 0:
-        return from_entry(entries[0])
+    return _load().get(rule_id)
+
+
+def get_by_type(rule_type: 'RuleType') -> Tuple['Rule', ...]:
+    _load()
+    return _by_type[rule_type]
+
+
+# Rules of the type that are not quarantined
+def get_active(rule_type: 'RuleType') -> Tuple['Rule', ...]:
+    return tuple(rule for rule in get_by_type(rule_type)
+                 if not rule.quarantined)
+
+
+def get_matcher(rule_type: 'RuleType') -> 'Matcher':
+    matcher = _matchers.get(rule_type)
+    if matcher is None:
+        matcher = Matcher(get_active(rule_type))
+        _matchers[rule_type] = matcher
+    return matcher
+
+
+def get_points_index() -> 'PointsIndex':
+    global _points_index
+    if _points_index is None:
+        _points_index = PointsIndex(
+            get_by_type(RuleType.POINTS_LESS_THAN),
+            get_by_type(RuleType.POINTS_GREATER_THAN)
+        )
+    return _points_index
+
+
+# Time of inactivity after which the first LAST_ACTIVITY rule is broken
+def get_inactivity_threshold() -> datetime.timedelta | None:
+    thresholds = []
+    for rule in get_by_type(RuleType.LAST_ACTIVITY):
+        try:
+            thresholds.append(int(rule.regexes[0]))
+        except (IndexError, ValueError):
+            pass
+    if thresholds:
+        return datetime.timedelta(minutes=min(thresholds))
     return None
 
 
+async def match(
+        rule_type: 'RuleType',
+        member: Member = None,
+        message: Message = None
+) -> List['Rule']:
+    texts = event_texts(rule_type, member, message)
+    if not texts:
+        return []
+
+    guard = regex_guard.get()
+    if guard is None:
+        matched = get_matcher(rule_type).match(texts)
+    else:
+        active = get_active(rule_type)
+        matched, overran = await guard.match(
+            rule_type, get_by_type(rule_type), active, texts)
+        _overran(active, overran)
+    return [rule for rule in get_by_type(rule_type) if rule.id in matched]
+
+
+# Regexes of the rule that are matched against event texts, for the other
+# rule types the regexes are arguments
+def text_regexes(rule_type: 'RuleType', regexes: List[str]) -> List[str]:
+    match rule_type:
+        case RuleType.MESSAGE | RuleType.ACTIVITY | RuleType.NAME:
+            return regexes
+        case RuleType.ROLE:
+            return regexes[1:]
+    return []
+
+
+# Regexes that may backtrack catastrophically, with the reason
+def screen(
+        rule_type: 'RuleType',
+        regexes: List[str]
+) -> List[Tuple[str, str]]:
+    risks = []
+    for regex in text_regexes(rule_type, regexes):
+        reason = regex_guard.redos_risk(regex)
+        if reason:
+            risks.append((regex, reason))
+    return risks
+
+
+# Counts the overruns of the rules that were run, a rule whose regexes
+# finished in time starts counting from zero again
+def _overran(rules: Iterable['Rule'], overran: Set[int]):
+    if _overruns:
+        for rule in rules:
+            if rule.id not in overran:
+                _overruns.pop(rule.id, None)
+
+    for rule_id in overran:
+        metrics.inc("lajter_regex_overruns_total", rule=rule_id)
+        _overruns[rule_id] = _overruns.get(rule_id, 0) + 1
+        rule = get_by_id(rule_id)
+        if rule is None or rule.quarantined:
+            continue
+        logger.warning(f'Regexes of rule {rule_id} ran out of time '
+                       f'{_overruns[rule_id]} times')
+        if _overruns[rule_id] >= QUARANTINE_OVERRUNS:
+            quarantine(rule)
+
+
+def quarantine(rule: 'Rule'):
+    rule.quarantined = True
+    rule.save()
+    _overruns.pop(rule.id, None)
+    _unreported.append(rule)
+    metrics.inc("lajter_rules_quarantined_total")
+    logger.warning(f'Quarantined rule {rule.id}')
+
+
+# Rules quarantined since the last call
+def take_quarantined() -> List['Rule']:
+    rules = list(_unreported)
+    _unreported.clear()
+    return rules
+
+
+def event_texts(
+        rule_type: 'RuleType',
+        member: Member = None,
+        message: Message = None
+) -> List[str]:
+    texts = []
+    match rule_type:
+        case RuleType.MESSAGE | RuleType.ROLE:
+            if message:
+                texts.append(message.content)
+                if rule_type is RuleType.MESSAGE:
+                    texts.extend(attachment.filename
+                                 for attachment in message.attachments)
+        case RuleType.ACTIVITY:
+            if member:
+                for activity in member.activities:
+                    if type(activity) is Spotify:
+                        texts.extend((activity.title, activity.artist))
+                    else:
+                        texts.append(activity.name)
+        case RuleType.NAME:
+            if member:
+                texts.append(member.display_name)
+    return [text for text in texts if text]
+
+
+def get_all() -> List['Rule']:
+    return sorted(_load().values(), key=lambda rule: rule.id)
+
+
+def remove(rule_id: int):
+    rules = _load()
+    Rule.db.remove(rule_id)
+    if rules.pop(rule_id, None):
+        _reindex()
+
+
 def from_entry(entry):
     try:
         return Rule(
@@ -28,7 +242,8 @@ def from_entry(entry):
             entry['id'],
             entry['regexes'],
             entry['actions'],
-            entry['public']
+            entry['public'],
+            entry.get('quarantined', False)
         )
     except KeyError:
         return Rule(
@@ -49,12 +264,20 @@ class RuleType(Enum):
     POINTS_GREATER_THAN = "more points"
     ROLE = "role"
     LAST_ACTIVITY = "last activity"
+    SPAM = "spam"
+
+
+# Rule types matched against event texts with a Matcher
+TEXT_RULE_TYPES = (RuleType.MESSAGE, RuleType.ACTIVITY, RuleType.NAME)
+
+# Rule types looked up by the user's balance in the PointsIndex
+POINTS_RULE_TYPES = (RuleType.POINTS_LESS_THAN, RuleType.POINTS_GREATER_THAN)
 
 
 class Rule:
-    db = TinyDB("rules.json")
+    db = lajter.storage.open_storage("rules")
 
-    def __init__(self, rule_type: RuleType | str, rule_id=None, regexes=None, actions=None, public=False):
+    def __init__(self, rule_type: RuleType | str, rule_id=None, regexes=None, actions=None, public=False, quarantined=False):
         self.id: int = rule_id
 
         if type(rule_type) is str:
@@ -79,30 +302,88 @@ class Rule:
         else:
             self.public = public
 
+        # Set when the regexes kept running out of time, cleared by editing
+        # them
+        self.quarantined: bool = quarantined
+
+        self.patterns: List[re.Pattern] = []
+        self.literals: List[str | None] = []
+        self.compile()
+
+    def compile(self):
+        self.patterns = []
+        self.literals = []
+        for regex in text_regexes(self.rule_type, self.regexes):
+            try:
+                pattern = re.compile(regex)
+            except re.error as e:
+                logger.error(f'Rule {self.id} has an invalid regex '
+                             f'{regex!r}: {e}')
+                continue
+            self.patterns.append(pattern)
+            self.literals.append(required_literal(pattern))
+
+    def matches(self, texts: List[str]) -> bool:
+        for text in texts:
+            for pattern, literal in zip(self.patterns, self.literals):
+                if literal and literal not in literal_haystack(pattern, text):
+                    continue
+                if pattern.search(text):
+                    return True
+        return False
+
+    # Like matches, in the regex worker when the guard is on
+    async def search(self, texts: List[str]) -> bool:
+        guard = regex_guard.get()
+        if guard is None:
+            return self.matches(texts)
+        if not texts or not self.patterns:
+            return False
+        matched, overran = await guard.match(
+            ('rule', self.id), self.patterns, (self,), texts)
+        _overran((self,), overran)
+        return self.id in matched
+
+    # Like search, for the texts of many events at once
+    async def search_each(self, events: List[List[str]]) -> List[bool]:
+        guard = regex_guard.get()
+        if guard is None:
+            return [self.matches(texts) for texts in events]
+        if not self.patterns:
+            return [False] * len(events)
+        results, overran = await guard.match_each(
+            ('rule', self.id), self.patterns, (self,), events)
+        _overran((self,), overran)
+        return [self.id in matched for matched in results]
+
     def save(self):
+        _load()
+        entry = {
+            'id': self.id,
+            'type': self.rule_type.value,
+            'regexes': self.regexes,
+            'actions': self.actions,
+            'public': self.public,
+            'quarantined': self.quarantined
+        }
         if self.id is None:
-            self.id = Rule.db.insert({
-                'id': 'null',
-                'type': self.rule_type.value,
-                'regexes': self.regexes,
-                'actions': self.actions,
-                'public': self.public
-            })
-
-            Rule.db.update({'id': self.id}, doc_ids=[self.id])
+            self.id = Rule.db.insert(entry)
         else:
-            Rule.db.upsert({
-                'id': self.id,
-                'type': self.rule_type.value,
-                'regexes': self.regexes,
-                'actions': self.actions,
-                'public': self.public
-            }, where('id') == self.id)
+            Rule.db.upsert(entry)
+
+        self.compile()
+        _rules[self.id] = self
+        # The instance may have been edited in place, so every bucket
+        # is rebuilt instead of just the one matching its current type
+        _invalidate(self.rule_type)
+        _reindex()
 
     def to_string(self, print_id=True) -> str:
         rules = ""
         if print_id:
             rules += f'**{self.id}**: '
+        if self.quarantined:
+            rules += "(wstrzymana) "
 
         match self.rule_type:
             case RuleType.MESSAGE:
@@ -115,7 +396,7 @@ class Rule:
                 rules += f'Jeśli nazwa użytkownika zawiera regex: {self.regexes}, wykonaj akcje: '
             case RuleType.POINTS_LESS_THAN:
                 rules += f'Jeśli użytkownik ma mniej niż {self.regexes[0]} punktów, wykonaj akcje: '
-            case RuleType.POINTS_LESS_THAN:
+            case RuleType.POINTS_GREATER_THAN:
                 rules += f'Jeśli użytkownik ma więcej niż {self.regexes[0]} punktów, wykonaj akcje: '
             case RuleType.ROLE:
                 rules += f'Jeśli użytkownik ma rolę {self.regexes[0]}'
@@ -125,6 +406,11 @@ class Rule:
             case RuleType.LAST_ACTIVITY:
                 rules += (f'Jeśli ostatnia wiadomość użytkownika była ponad '
                           f'{self.regexes[0]} minut temu, wykonaj akcje: ')
+            case RuleType.SPAM:
+                if self.regexes:
+                    rules += f'Jeśli użytkownik spamuje ({self.regexes}), wykonaj akcje: '
+                else:
+                    rules += "Jeśli użytkownik spamuje, wykonaj akcje: "
 
         for action_id in self.actions:
             action: Action = lajter.action.get_by_id(action_id)
@@ -142,35 +428,19 @@ class Rule:
             message: Message = None,
             reaction: Reaction = None
     ) -> bool:
+        metrics.inc("lajter_rule_checks_total", type=self.rule_type.value)
+        if self.quarantined:
+            return False
         match self.rule_type:
-            case RuleType.MESSAGE:
-                for regex in self.regexes:
-                    if re.search(regex, message.content):
-                        return True
-                for attachment in message.attachments:
-                    for regex in self.regexes:
-                        if re.search(regex, attachment.filename):
-                            return True
-            case RuleType.ACTIVITY:
-                for regex in self.regexes:
-                    for activity in member.activities:
-                        if type(activity) is Spotify:
-                            if (re.search(regex, activity.title)
-                                    or re.search(regex, activity.artist)):
-                                return True
-                        else:
-                            if re.search(regex, activity.name):
-                                return True
+            case RuleType.MESSAGE | RuleType.ACTIVITY | RuleType.NAME:
+                return await self.search(
+                    event_texts(self.rule_type, member, message))
             case RuleType.REACTION:
                 for regex in self.regexes:
                     if type(reaction.emoji) == str and reaction.emoji == regex:
                         return True
                     if type(reaction.emoji) == Emoji and str(reaction.emoji.id) in regex:
                         return True
-            case RuleType.NAME:
-                for regex in self.regexes:
-                    if re.search(regex, member.display_name):
-                        return True
             case RuleType.POINTS_LESS_THAN:
                 if self.regexes:
                     if db_user and db_user.points < int(self.regexes[0]):
@@ -186,16 +456,24 @@ class Rule:
                     for role in member.roles:
                         if role.id == target_role.id:
                             if len(self.regexes) > 1:
-                                for regex in self.regexes[1:]:
-                                    if re.search(regex, message.content):
-                                        return True
+                                return await self.search(
+                                    event_texts(self.rule_type, member,
+                                                message))
                             else:
                                 return True
             case RuleType.LAST_ACTIVITY:
                 if self.regexes:
                     last_activity = db_user.last_activity
                     time_difference = datetime.datetime.now() - last_activity
-                    if time_difference.seconds > int(self.regexes[0]) * 60:
+                    if time_difference.total_seconds() > int(self.regexes[0]) * 60:
+                        return True
+            case RuleType.SPAM:
+                # Arguments limit the rule to kinds of spam, duplicate or
+                # flood
+                if message:
+                    kind = lajter.spam.check(message)
+                    if kind and (not self.regexes
+                                 or kind.value in self.regexes):
                         return True
 
         return False
@@ -208,6 +486,296 @@ class Rule:
             channel: TextChannel = None,
             message: Message = None
     ):
+        await lajter.action.execute_all(
+            self.get_actions(), bot, member, db_user, channel, message)
+
+    def get_actions(self) -> List[Action]:
+        actions = []
         for action_id in self.actions:
             action = lajter.action.get_by_id(action_id)
-            await action.execute(bot, member, db_user, channel, message)
+            if action is None:
+                logger.warning(f'Rule {self.id} refers to missing '
+                               f'action {action_id}')
+                continue
+            actions.append(action)
+        return actions
+
+
+# Points rules sorted by their thresholds, so the rules that apply to a
+# balance, or whose boundary a change of balance crossed, are found with a
+# binary search instead of checking every rule
+class PointsIndex:
+    def __init__(self, less_rules: Tuple[Rule, ...],
+                 greater_rules: Tuple[Rule, ...]):
+        self.less_thresholds, self.less_rules = self._sort(less_rules)
+        self.greater_thresholds, self.greater_rules = \
+            self._sort(greater_rules)
+
+    @staticmethod
+    def _sort(rules: Tuple[Rule, ...]) -> Tuple[List[int], List[Rule]]:
+        entries = []
+        for rule in rules:
+            if not rule.regexes:
+                continue
+            try:
+                entries.append((int(rule.regexes[0]), rule.id, rule))
+            except ValueError:
+                logger.error(f'Rule {rule.id} has an invalid number of '
+                             f'points {rule.regexes[0]!r}')
+        entries.sort()
+        return ([threshold for threshold, _, _ in entries],
+                [rule for _, _, rule in entries])
+
+    # Rules whose condition was false for the old balance and is true for
+    # the new one
+    def crossed(self, old_points: int, new_points: int) -> List[Rule]:
+        rules = self.less_rules[
+            bisect_right(self.less_thresholds, new_points):
+            bisect_right(self.less_thresholds, old_points)]
+        rules += self.greater_rules[
+            bisect_left(self.greater_thresholds, old_points):
+            bisect_left(self.greater_thresholds, new_points)]
+        return sorted(rules, key=lambda rule: rule.id)
+
+
+def required_literal(pattern: re.Pattern) -> str | None:
+    # Returns the longest piece of text that every match of the pattern has
+    # to contain, or None if there is no such text or it can't be found.
+    # For a case-insensitive pattern the text is folded with fold_case and
+    # has to be looked for in the folded text
+    try:
+        literals = _required_literals(sre_parse.parse(pattern.pattern))
+    except (re.error, RecursionError):
+        return None
+    if pattern.flags & re.IGNORECASE:
+        literals = [literal for literal in map(fold_case, literals) if literal]
+    if not literals:
+        return None
+    return max(literals, key=len)
+
+
+# Text that matches case-insensitively folds to the same string. Casefolding
+# alone keeps the dotless and dotted i apart, unlike the regex engine
+_TURKISH_I = str.maketrans({'ı': 'i', '\u0307': None})
+
+
+def fold_case(text: str) -> str:
+    return text.casefold().translate(_TURKISH_I)
+
+
+# The text a literal of the pattern is looked for in
+def literal_haystack(pattern: re.Pattern, text: str) -> str:
+    return fold_case(text) if pattern.flags & re.IGNORECASE else text
+
+
+def _required_literals(parsed) -> List[str]:
+    literals = []
+    run = ""
+    for op, av in parsed:
+        if op is sre_parse.LITERAL:
+            run += chr(av)
+            continue
+
+        if run:
+            literals.append(run)
+            run = ""
+
+        if op is sre_parse.SUBPATTERN:
+            group, add_flags, del_flags, subpattern = av
+            if not add_flags & re.IGNORECASE:
+                literals.extend(_required_literals(subpattern))
+        elif op is sre_parse.ATOMIC_GROUP:
+            literals.extend(_required_literals(av))
+        elif op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT,
+                    sre_parse.POSSESSIVE_REPEAT):
+            min_count, max_count, subpattern = av
+            if min_count > 0:
+                literals.extend(_required_literals(subpattern))
+
+    if run:
+        literals.append(run)
+    return literals
+
+
+# Aho-Corasick automaton finding which of many literals occur in a text
+# in a single pass over it, no matter how many literals there are
+class LiteralAutomaton:
+    def __init__(self, literals: Iterable[str]):
+        self.goto: List[Dict[str, int]] = [{}]
+        self.fail: List[int] = [0]
+        self.output: List[Tuple[str, ...]] = [()]
+
+        for literal in literals:
+            state = 0
+            for char in literal:
+                next_state = self.goto[state].get(char)
+                if next_state is None:
+                    next_state = len(self.goto)
+                    self.goto[state][char] = next_state
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append(())
+                state = next_state
+            if literal not in self.output[state]:
+                self.output[state] += (literal,)
+
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fail = self.fail[state]
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                fail = self.goto[fail].get(char, 0)
+                self.fail[next_state] = fail
+                self.output[next_state] += self.output[fail]
+
+    def search(self, text: str) -> Set[str]:
+        found = set()
+        goto = self.goto
+        fail = self.fail
+        output = self.output
+        state = 0
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if output[state]:
+                found.update(output[state])
+        return found
+
+
+# Matches a whole set of rules against the texts of an event in three steps:
+#  - regexes with a required literal are only run on texts where the
+#    literal automaton found that literal. Case-insensitive regexes have
+#    their own automaton, run on the text folded with fold_case,
+#  - the other regexes that can be safely merged are joined into one
+#    alternation, so a text that breaks none of them costs a single scan.
+#    Flags like (?i) at the start apply only to their own regex there,
+#  - every match of that scan names its rule, and only the regexes that
+#    could be hidden by the match of another one are checked on their own,
+#    to find every rule that was broken and not just the first one.
+class Matcher:
+    # Backreferences and conditionals would point at the wrong groups
+    # once the regex is wrapped in the combined pattern
+    _unmergeable = re.compile(r'\\[1-9]|\(\?P=|\(\?\(')
+    # Flags of the whole regex, they can't be in the middle of the combined
+    # pattern and are turned into flags of a group
+    _global_flags = re.compile(r'\(\?([aimsux]+)\)')
+
+    def __init__(self, rules: Tuple[Rule, ...]):
+        self.prefiltered: Dict[str, List[Tuple[int, re.Pattern]]] = {}
+        self.folded: Dict[str, List[Tuple[int, re.Pattern]]] = {}
+        self.merged: List[Tuple[int, re.Pattern]] = []
+        self.separate: List[Tuple[int, re.Pattern]] = []
+        self.group_rules: Dict[str, int] = {}
+        # Merged regexes by the characters their matches can start with,
+        # and those whose matches can start with anything
+        self.merged_by_char: Dict[str, List[int]] = {}
+        self.merged_anywhere: List[int] = []
+        self.automaton: LiteralAutomaton | None = None
+        self.folded_automaton: LiteralAutomaton | None = None
+        self.combined: re.Pattern | None = None
+
+        alternatives = []
+        for rule in rules:
+            for pattern, literal in zip(rule.patterns, rule.literals):
+                source = None if literal else self._alternative(pattern)
+                if literal:
+                    literals = (self.folded if pattern.flags & re.IGNORECASE
+                                else self.prefiltered)
+                    literals.setdefault(literal, []).append(
+                        (rule.id, pattern))
+                elif source is not None:
+                    group = f'_{len(alternatives)}'
+                    alternatives.append(f'(?P<{group}>{source})')
+                    self.group_rules[group] = rule.id
+                    self._index_first_chars(len(self.merged), pattern)
+                    self.merged.append((rule.id, pattern))
+                else:
+                    self.separate.append((rule.id, pattern))
+
+        if self.prefiltered:
+            self.automaton = LiteralAutomaton(self.prefiltered)
+        if self.folded:
+            self.folded_automaton = LiteralAutomaton(self.folded)
+
+        if alternatives:
+            try:
+                self.combined = re.compile("|".join(alternatives))
+            except (re.error, AssertionError, OverflowError,
+                    RecursionError):
+                logger.warning("Failed to combine rule regexes, "
+                               "checking them separately")
+                self.separate = self.merged + self.separate
+                self.merged = []
+                self.group_rules = {}
+                self.merged_by_char = {}
+                self.merged_anywhere = []
+
+    # The regex as it is put in the combined pattern, None if it can't be
+    def _alternative(self, pattern: re.Pattern) -> str | None:
+        if pattern.groupindex or self._unmergeable.search(pattern.pattern):
+            return None
+
+        source = pattern.pattern
+        flags = ""
+        found = self._global_flags.match(source)
+        while found:
+            flags += found.group(1)
+            source = source[found.end():]
+            found = self._global_flags.match(source)
+        source = f'(?{flags}:{source})' if flags else f'(?:{source})'
+
+        try:
+            re.compile(source)
+        except re.error:
+            return None
+        return source
+
+    # Characters are folded with fold_case, so that a case-insensitive
+    # regex is found by any case of its first character
+    def _index_first_chars(self, index: int, pattern: re.Pattern):
+        first = regex_guard.first_chars(pattern.pattern)
+        if first is None or not all(map(fold_case, first)):
+            self.merged_anywhere.append(index)
+            return
+        for char in set(fold_case("".join(first))):
+            self.merged_by_char.setdefault(char, []).append(index)
+
+    def match(self, texts: List[str]) -> Set[int]:
+        matched = set()
+        for text in texts:
+            if self.automaton:
+                for literal in self.automaton.search(text):
+                    for rule_id, pattern in self.prefiltered[literal]:
+                        if rule_id not in matched and pattern.search(text):
+                            matched.add(rule_id)
+            if self.folded_automaton:
+                for literal in self.folded_automaton.search(fold_case(text)):
+                    for rule_id, pattern in self.folded[literal]:
+                        if rule_id not in matched and pattern.search(text):
+                            matched.add(rule_id)
+            if self.combined:
+                # The group that matched names the rule. Matches found by
+                # one pass don't overlap, so a regex whose match starts
+                # inside the match of another one is hidden by it. Only the
+                # regexes that can start with a character of a match are
+                # searched again on their own
+                hidden = set()
+                for found in self.combined.finditer(text):
+                    matched.add(self.group_rules[found.lastgroup])
+                    start, end = found.span()
+                    span = fold_case(text[start:max(end, start + 1)])
+                    for char in set(span):
+                        hidden.update(self.merged_by_char.get(char, ()))
+                    hidden.update(self.merged_anywhere)
+                for index in hidden:
+                    rule_id, pattern = self.merged[index]
+                    if rule_id not in matched and pattern.search(text):
+                        matched.add(rule_id)
+            for rule_id, pattern in self.separate:
+                if rule_id not in matched and pattern.search(text):
+                    matched.add(rule_id)
+        return matched
@@ -0,0 +1,69 @@
+import asyncio
+import heapq
+import itertools
+from datetime import datetime
+from typing import Dict, Hashable, List, Tuple
+
+
+# Min-heap of deadlines, each key has at most one deadline. Rescheduling or
+# cancelling a key leaves its old entry in the heap, it is skipped once it
+# reaches the top
+class DeadlineScheduler:
+    def __init__(self):
+        self._heap: List[Tuple[datetime, int, Hashable]] = []
+        self._deadlines: Dict[Hashable, datetime] = {}
+        self._counter = itertools.count()
+        self._changed = asyncio.Event()
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._deadlines
+
+    def __len__(self) -> int:
+        return len(self._deadlines)
+
+    def schedule(self, key: Hashable, deadline: datetime):
+        next_deadline = self.next_deadline()
+        self._deadlines[key] = deadline
+        heapq.heappush(self._heap, (deadline, next(self._counter), key))
+        if next_deadline is None or deadline < next_deadline:
+            self._changed.set()
+
+    def cancel(self, key: Hashable):
+        self._deadlines.pop(key, None)
+
+    def clear(self):
+        self._heap.clear()
+        self._deadlines.clear()
+        self._changed.set()
+
+    def _is_current(self, entry: Tuple[datetime, int, Hashable]) -> bool:
+        deadline, _, key = entry
+        return self._deadlines.get(key) == deadline
+
+    def next_deadline(self) -> datetime | None:
+        while self._heap and not self._is_current(self._heap[0]):
+            heapq.heappop(self._heap)
+        if self._heap:
+            return self._heap[0][0]
+        return None
+
+    def pop_due(self, now: datetime) -> List[Hashable]:
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            entry = heapq.heappop(self._heap)
+            if self._is_current(entry):
+                del self._deadlines[entry[2]]
+                due.append(entry[2])
+        return due
+
+    # Sleeps until the next deadline passes or an earlier one is scheduled
+    async def wait(self):
+        self._changed.clear()
+        next_deadline = self.next_deadline()
+        timeout = None
+        if next_deadline is not None:
+            timeout = max(0.0, (next_deadline - datetime.now()).total_seconds())
+        try:
+            await asyncio.wait_for(self._changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
@@ -0,0 +1,89 @@
+import logging
+import os
+from dataclasses import dataclass
+from typing import Callable, List
+
+logger = logging.getLogger('SETTINGS')
+logger.setLevel(logging.DEBUG)
+
+
+def _int_env(name: str, default: int | None = None) -> int | None:
+    value = os.getenv(name)
+    if not value:
+        return default
+    return int(value)
+
+
+# Configuration read from the environment once, instead of on every event
+@dataclass(frozen=True)
+class Settings:
+    default_guild: int | None
+    default_channel: int | None
+    ban_role: int | None
+    flush_interval: int
+    poll_quorum: int
+    # Messages whose rule actions a scan of the history may execute
+    backfill_cap: int
+    # Mode of the history scan started for rules added by !voterule,
+    # empty if they only apply to new messages
+    voterule_backfill: str
+    # Time a rule regex may take on one event, 0 runs regexes unguarded.
+    # Off by default: the worker is forked from the running bot, whose
+    # threads may hold locks the copy never gets back
+    regex_budget_ms: int
+    # Port of the local Prometheus endpoint, 0 disables it
+    metrics_port: int
+    # Only read when the tables are opened, changing them needs a restart
+    storage: str
+    database: str
+
+    @classmethod
+    def from_env(cls) -> 'Settings':
+        return cls(
+            default_guild=_int_env("DEFAULT_GUILD"),
+            default_channel=_int_env("DEFAULT_CHANNEL"),
+            ban_role=_int_env("BAN_ROLE"),
+            flush_interval=_int_env("FLUSH_INTERVAL", 30),
+            poll_quorum=_int_env("POLL_QUORUM", 0),
+            backfill_cap=_int_env("BACKFILL_CAP", 20),
+            voterule_backfill=os.getenv("VOTERULE_BACKFILL", ""),
+            regex_budget_ms=_int_env("REGEX_BUDGET_MS", 0),
+            metrics_port=_int_env("METRICS_PORT", 0),
+            storage=os.getenv("STORAGE", "json"),
+            database=os.getenv("DATABASE", "bot.db")
+        )
+
+
+_settings: Settings | None = None
+_listeners: List[Callable[[Settings], None]] = []
+
+
+# Loaded on first use, so .env is read by then
+def get() -> Settings:
+    global _settings
+    if _settings is None:
+        _settings = Settings.from_env()
+    return _settings
+
+
+def on_reload(listener: Callable[[Settings], None]):
+    _listeners.append(listener)
+
+
+def remove_listener(listener: Callable[[Settings], None]):
+    if listener in _listeners:
+        _listeners.remove(listener)
+
+
+# Called on SIGHUP, the old settings are kept if the new ones are invalid
+def reload():
+    global _settings
+    try:
+        _settings = Settings.from_env()
+    except ValueError:
+        logger.error("Invalid settings, keeping the previous ones")
+        return
+
+    logger.info("Reloaded settings")
+    for listener in _listeners:
+        listener(_settings)
@@ -0,0 +1,130 @@
+import time
+from array import array
+from collections import OrderedDict
+from enum import Enum
+
+from discord import Message
+
+import lajter.metrics as metrics
+
+# Messages sent over and over, or too many messages in a short time, farm
+# points and keep the rules busy. They are recognised before any of that,
+# from a few numbers kept per user in arrays of a fixed size
+
+# A message is a duplicate if the user sent the same text this many times,
+# counting it, among their last DUPLICATE_HISTORY messages from the last
+# DUPLICATE_WINDOW seconds
+DUPLICATE_LIMIT = 3
+DUPLICATE_HISTORY = 8
+DUPLICATE_WINDOW = 120.0
+# A message is a flood if the user sent this many messages, counting it,
+# in the last FLOOD_WINDOW seconds
+FLOOD_LIMIT = 6
+FLOOD_WINDOW = 5.0
+# Users whose last messages are remembered, the least recently active are
+# forgotten first
+MAX_USERS = 5000
+# Messages whose verdict is remembered, every listener of a message gets
+# the same one
+VERDICTS_SIZE = 256
+
+
+class SpamKind(Enum):
+    DUPLICATE = "duplicate"
+    FLOOD = "flood"
+
+
+class _UserHistory:
+    __slots__ = ("hashes", "hash_times", "next_hash", "times", "next_time")
+
+    def __init__(self):
+        # Rings of the hashes of the last texts with the times they were
+        # sent, and of the times of the last messages
+        self.hashes = array('q', bytes(8 * DUPLICATE_HISTORY))
+        self.hash_times = array('d', [float("-inf")] * DUPLICATE_HISTORY)
+        self.next_hash = 0
+        self.times = array('d', [float("-inf")] * (FLOOD_LIMIT - 1))
+        self.next_time = 0
+
+    def duplicates(self, text_hash: int, now: float) -> int:
+        count = 0
+        for stored, sent in zip(self.hashes, self.hash_times):
+            if stored == text_hash and now - sent < DUPLICATE_WINDOW:
+                count += 1
+        return count
+
+    def add_hash(self, text_hash: int, now: float):
+        self.hashes[self.next_hash] = text_hash
+        self.hash_times[self.next_hash] = now
+        self.next_hash = (self.next_hash + 1) % DUPLICATE_HISTORY
+
+    # The oldest of the last FLOOD_LIMIT - 1 messages is replaced, if it's
+    # still in the window this is the FLOOD_LIMIT-th message in it
+    def add_time(self, now: float) -> bool:
+        flood = now - self.times[self.next_time] < FLOOD_WINDOW
+        self.times[self.next_time] = now
+        self.next_time = (self.next_time + 1) % len(self.times)
+        return flood
+
+
+class SpamDetector:
+    def __init__(self, max_users: int = MAX_USERS):
+        self.max_users = max_users
+        self._users: OrderedDict[int, _UserHistory] = OrderedDict()
+        self._verdicts: OrderedDict[int, SpamKind | None] = OrderedDict()
+
+    def _history(self, user_id: int) -> _UserHistory:
+        history = self._users.get(user_id)
+        if history is None:
+            history = _UserHistory()
+            self._users[user_id] = history
+            if len(self._users) > self.max_users:
+                self._users.popitem(last=False)
+        else:
+            self._users.move_to_end(user_id)
+        return history
+
+    def check(self, message: Message) -> SpamKind | None:
+        if message.id in self._verdicts:
+            return self._verdicts[message.id]
+
+        verdict = self.classify(message.author.id, message.content)
+        self._verdicts[message.id] = verdict
+        if len(self._verdicts) > VERDICTS_SIZE:
+            self._verdicts.popitem(last=False)
+        if verdict is not None:
+            metrics.inc("lajter_spam_messages_total", kind=verdict.value)
+        return verdict
+
+    def classify(self, user_id: int, content: str,
+                 now: float = None) -> SpamKind | None:
+        if now is None:
+            now = time.monotonic()
+        history = self._history(user_id)
+        flood = history.add_time(now)
+
+        # Messages with only attachments are not compared
+        text = " ".join(content.lower().split())
+        duplicate = False
+        if text:
+            text_hash = hash(text)
+            duplicate = (history.duplicates(text_hash, now)
+                         >= DUPLICATE_LIMIT - 1)
+            history.add_hash(text_hash, now)
+
+        if duplicate:
+            return SpamKind.DUPLICATE
+        if flood:
+            return SpamKind.FLOOD
+        return None
+
+    def forget(self, user_id: int):
+        self._users.pop(user_id, None)
+
+
+detector = SpamDetector()
+
+
+# Whether the message is spam, the same answer for every listener
+def check(message: Message) -> SpamKind | None:
+    return detector.check(message)
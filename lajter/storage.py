@@ -0,0 +1,213 @@
+import json
+import logging
+import os
+import sqlite3
+from abc import ABC, abstractmethod
+from typing import List, Dict, Iterable, Tuple
+
+from tinydb import TinyDB, where
+from tinydb.middlewares import CachingMiddleware
+from tinydb.storages import JSONStorage
+from tinydb.table import Document
+
+import lajter.metrics as metrics
+import lajter.settings
+
+logger = logging.getLogger('STORAGE')
+logger.setLevel(logging.DEBUG)
+
+
+# Tables of Rule, Action, User, Poll and Backfill and their indexed fields,
+# which are the fields they are searched by
+TABLES: Dict[str, Tuple[str, ...]] = {
+    "rules": ("type",),
+    "actions": ("type",),
+    "users": (),
+    "polls": ("kind",),
+    "backfills": ("rule",),
+}
+
+
+def open_storage(name: str) -> 'Storage':
+    settings = lajter.settings.get()
+    if settings.storage == "sqlite":
+        return SQLiteStorage(settings.database, name, TABLES[name])
+    return TinyDBStorage(f'{name}.json')
+
+
+# Every entry is a dict with a unique 'id' field. Entries inserted with an
+# id of None get a new one assigned by the storage
+class Storage(ABC):
+    name: str
+
+    @abstractmethod
+    def all(self) -> List[dict]:
+        ...
+
+    @abstractmethod
+    def get(self, entry_id: int) -> dict | None:
+        ...
+
+    @abstractmethod
+    def search(self, field: str, value) -> List[dict]:
+        ...
+
+    @abstractmethod
+    def insert(self, entry: dict) -> int:
+        ...
+
+    @abstractmethod
+    def upsert_many(self, entries: Iterable[dict]):
+        ...
+
+    @abstractmethod
+    def remove_many(self, entry_ids: Iterable[int]):
+        ...
+
+    def upsert(self, entry: dict):
+        self.upsert_many([entry])
+
+    def remove(self, entry_id: int):
+        self.remove_many([entry_id])
+
+    def _count_write(self, entries: int):
+        metrics.inc("lajter_storage_writes_total", table=self.name)
+        metrics.inc("lajter_storage_entries_written_total", entries,
+                    table=self.name)
+
+
+class TinyDBStorage(Storage):
+    def __init__(self, path: str):
+        # Writes are cached in memory and flushed once per operation, so a
+        # batch of changes costs one rewrite of the file
+        self.db = TinyDB(path, storage=CachingMiddleware(JSONStorage))
+        self.name = os.path.splitext(os.path.basename(path))[0]
+        self._doc_ids: Dict[int, int] | None = None
+
+    def _ids(self) -> Dict[int, int]:
+        if self._doc_ids is None:
+            self._doc_ids = {doc['id']: doc.doc_id for doc in self.db.all()}
+        return self._doc_ids
+
+    def all(self) -> List[dict]:
+        return [dict(doc) for doc in self.db.all() if doc['id'] != 'null']
+
+    def get(self, entry_id: int) -> dict | None:
+        doc_id = self._ids().get(entry_id)
+        if doc_id is None:
+            return None
+        return dict(self.db.get(doc_id=doc_id))
+
+    def search(self, field: str, value) -> List[dict]:
+        return [dict(doc) for doc in self.db.search(where(field) == value)]
+
+    def insert(self, entry: dict) -> int:
+        ids = self._ids()
+        entry_id = entry.get('id')
+        doc_id = self.db.insert({**entry, 'id': entry_id or 'null'})
+        if entry_id is None:
+            entry_id = doc_id
+            self.db.update({'id': entry_id}, doc_ids=[doc_id])
+        ids[entry_id] = doc_id
+        self.db.storage.flush()
+        self._count_write(1)
+        return entry_id
+
+    def upsert_many(self, entries: Iterable[dict]):
+        entries = list(entries)
+        ids = self._ids()
+        for entry in entries:
+            doc_id = ids.get(entry['id'])
+            if doc_id is None:
+                ids[entry['id']] = self.db.insert(entry)
+            else:
+                self.db.upsert(Document(entry, doc_id=doc_id))
+        self.db.storage.flush()
+        self._count_write(len(entries))
+
+    def remove_many(self, entry_ids: Iterable[int]):
+        ids = self._ids()
+        doc_ids = [ids.pop(entry_id) for entry_id in entry_ids
+                   if entry_id in ids]
+        if doc_ids:
+            self.db.remove(doc_ids=doc_ids)
+            self.db.storage.flush()
+            self._count_write(len(doc_ids))
+
+
+class SQLiteStorage(Storage):
+    # Tables stored in the same file share one connection
+    _connections: Dict[str, sqlite3.Connection] = {}
+
+    def __init__(self, path: str, table: str, indexes: Tuple[str, ...] = ()):
+        if path not in SQLiteStorage._connections:
+            SQLiteStorage._connections[path] = sqlite3.connect(path)
+        self.connection = SQLiteStorage._connections[path]
+        self.table = table
+        self.name = table
+        self.indexes = indexes
+
+        columns = "".join(f', "{column}"' for column in indexes)
+        with self.connection:
+            self.connection.execute(
+                f'CREATE TABLE IF NOT EXISTS "{table}" '
+                f'(id INTEGER PRIMARY KEY, data TEXT NOT NULL{columns})')
+            for column in indexes:
+                self.connection.execute(
+                    f'CREATE INDEX IF NOT EXISTS "{table}_{column}" '
+                    f'ON "{table}" ("{column}")')
+
+        placeholders = ", ".join("?" for _ in range(len(indexes) + 2))
+        updates = "".join(f', "{column}" = excluded."{column}"'
+                          for column in indexes)
+        self._upsert = (f'INSERT INTO "{table}" (id, data{columns}) '
+                        f'VALUES ({placeholders}) ON CONFLICT(id) '
+                        f'DO UPDATE SET data = excluded.data{updates}')
+
+    def _row(self, entry: dict) -> tuple:
+        return (entry['id'], json.dumps(entry),
+                *(entry.get(column) for column in self.indexes))
+
+    def all(self) -> List[dict]:
+        rows = self.connection.execute(
+            f'SELECT data FROM "{self.table}" ORDER BY id')
+        return [json.loads(data) for data, in rows]
+
+    def get(self, entry_id: int) -> dict | None:
+        row = self.connection.execute(
+            f'SELECT data FROM "{self.table}" WHERE id = ?',
+            (entry_id,)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def search(self, field: str, value) -> List[dict]:
+        if field == 'id' or field in self.indexes:
+            rows = self.connection.execute(
+                f'SELECT data FROM "{self.table}" WHERE "{field}" = ? '
+                f'ORDER BY id', (value,))
+            return [json.loads(data) for data, in rows]
+        return [entry for entry in self.all() if entry.get(field) == value]
+
+    def insert(self, entry: dict) -> int:
+        with self.connection:
+            if entry.get('id') is None:
+                cursor = self.connection.execute(
+                    f'INSERT INTO "{self.table}" (data) VALUES (?)', ("",))
+                entry = {**entry, 'id': cursor.lastrowid}
+            self.connection.execute(self._upsert, self._row(entry))
+        self._count_write(1)
+        return entry['id']
+
+    def upsert_many(self, entries: Iterable[dict]):
+        rows = [self._row(entry) for entry in entries]
+        with self.connection:
+            self.connection.executemany(self._upsert, rows)
+        self._count_write(len(rows))
+
+    def remove_many(self, entry_ids: Iterable[int]):
+        rows = [(entry_id,) for entry_id in entry_ids]
+        with self.connection:
+            self.connection.executemany(
+                f'DELETE FROM "{self.table}" WHERE id = ?', rows)
+        self._count_write(len(rows))
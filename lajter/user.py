@@ -1,11 +1,129 @@
+import asyncio
+from contextlib import asynccontextmanager, AsyncExitStack
 from datetime import datetime
-from tinydb import TinyDB, where
+from typing import Dict, List, Set, Iterable, Tuple
+from weakref import WeakValueDictionary
+
+import lajter.metrics as metrics
+import lajter.storage
+from lajter.leaderboard import Leaderboard
+
+# Identity map of users, loaded from the database once. Saving a user only
+# marks it as dirty, dirty users are written to the database in one batch
+# by flush
+_users: Dict[int, 'User'] | None = None
+_dirty: Set[int] = set()
+# Kept up to date with every change of points of the users above
+_leaderboard: Leaderboard | None = None
+# Users whose points changed since the points rules were last checked for
+# them, whatever changed them
+_changed: Dict[int, 'User'] = {}
+# A lock lives only while a unit of work holds it or waits for it, the
+# locks of idle users are dropped
+_locks: WeakValueDictionary[int, asyncio.Lock] = WeakValueDictionary()
+
+
+def _load() -> Dict[int, 'User']:
+    global _users, _leaderboard
+    if _users is None:
+        _users = {}
+        for entry in User.db.all():
+            user = from_entry(entry)
+            _users[user.id] = user
+        _leaderboard = Leaderboard(
+            (user.id, user.points) for user in _users.values())
+    return _users
+
+
+def get_leaderboard() -> Leaderboard:
+    _load()
+    return _leaderboard
+
 
 def get_by_id(user_id):
-    entries = User.db.search(where('id') == user_id)
-    if len(entries) > 0:
-        return from_entry(entries[0])
-    return None
+    return _load().get(user_id)
+
+
+def get_all() -> List['User']:
+    return list(_load().values())
+
+
+def get_lock(user_id: int) -> asyncio.Lock:
+    lock = _locks.get(user_id)
+    if lock is None:
+        lock = asyncio.Lock()
+        _locks[user_id] = lock
+    return lock
+
+
+# Gives exclusive access to the users for the duration of the block and
+# saves them once at its end. Locks are always taken in the order of ids,
+# so units of work sharing some of their users can't deadlock
+@asynccontextmanager
+async def unit_of_work(*user_ids: int, create=False):
+    async with AsyncExitStack() as stack:
+        for user_id in sorted(set(user_ids)):
+            await stack.enter_async_context(get_lock(user_id))
+
+        users = []
+        for user_id in user_ids:
+            user = get_by_id(user_id)
+            if user is None and create:
+                user = User(user_id)
+                user.save()
+            users.append(user)
+
+        yield users
+
+        # Users removed in the meantime, e.g. by a ban, are not saved back
+        for user in users:
+            if user and get_by_id(user.id) is user:
+                user.save()
+
+
+def remove(user_id: int):
+    remove_many([user_id])
+
+
+def remove_many(user_ids: Iterable[int]):
+    users = _load()
+    removed = []
+    for user_id in user_ids:
+        _dirty.discard(user_id)
+        _changed.pop(user_id, None)
+        _leaderboard.remove(user_id)
+        if users.pop(user_id, None):
+            removed.append(user_id)
+
+    if removed:
+        User.db.remove_many(removed)
+
+
+# Users whose points changed since they were last taken
+def take_changed() -> List['User']:
+    users = list(_changed.values())
+    _changed.clear()
+    return users
+
+
+def flush():
+    if not _dirty:
+        return
+
+    entries = []
+    for user_id in _dirty:
+        user = _users[user_id]
+        entries.append({
+            "id": user.id,
+            "points": user.points,
+            "last_activity": user.last_activity.isoformat()
+        })
+
+    # Users stay dirty until they are written, a failed write is retried
+    # by the next flush
+    User.db.upsert_many(entries)
+    _dirty.clear()
+
 
 def from_entry(entry):
     return User(
@@ -15,19 +133,43 @@ def from_entry(entry):
     )
 
 class User:
-    db = TinyDB("users.json")
+    db = lajter.storage.open_storage("users")
+
+    def __init__(self, user_id: int, points: int = 100, last_activity: datetime = None):
+        if last_activity is None:
+            last_activity = datetime.now()
 
-    def __init__(self, user_id: int, points: int = 100, last_activity: datetime = datetime.now()):
         self.id = user_id
-        self.points = points
+        self._points = points
+        self._points_before: int | None = None
         self.last_activity = last_activity
 
+    @property
+    def points(self) -> int:
+        return self._points
+
+    # The balance from before the first change is remembered, so points
+    # rules can be checked against the whole change at once
+    @points.setter
+    def points(self, points: int):
+        if self._points_before is None:
+            self._points_before = self._points
+            _changed[self.id] = self
+        self._points = points
+        if _users and _users.get(self.id) is self:
+            _leaderboard.update(self.id, points)
+
+    def take_points_change(self) -> Tuple[int, int] | None:
+        points_before = self._points_before
+        self._points_before = None
+        if _changed.get(self.id) is self:
+            del _changed[self.id]
+        if points_before is None or points_before == self._points:
+            return None
+        return points_before, self._points
+
     def save(self):
-        User.db.upsert(
-            {
-                "id": self.id,
-                "points": self.points,
-                "last_activity": self.last_activity.isoformat()
-            },
-            where('id') == self.id
-        )
\ No newline at end of file
+        metrics.inc("lajter_user_saves_total")
+        _load()[self.id] = self
+        _dirty.add(self.id)
+        _leaderboard.update(self.id, self.points)
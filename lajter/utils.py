@@ -1,21 +1,46 @@
-import os
 import random
 import re
+import time
+from collections import OrderedDict
+from typing import Dict, Hashable, Tuple
 
 import discord
-from discord import Guild, TextChannel, Role, Member, User
+from discord import Guild, TextChannel, Role, Member, Message, User
 from discord.ext.commands import check, Context
-from discord.utils import get
 from discord.ext import commands
 
+import lajter.metrics as metrics
+import lajter.settings
+
+# Immunity of members by id, together with the roles it was decided for.
+# A change of roles makes the entry stale, changes of the roles themselves
+# or of the guild owner clear the whole cache
+_immunity: Dict[int, Tuple[Tuple[int, ...], bool]] = {}
+
+
 def immune(member: Member) -> bool:
     if not member or type(member) is User:
         return True
 
-    if member.bot or is_banned(member):
+    if member.bot:
+        return True
+
+    # The raw role ids, member.roles would look up and sort the roles
+    roles = tuple(member._roles)
+    entry = _immunity.get(member.id)
+    if entry is not None and entry[0] == roles:
+        return entry[1]
+
+    result = _decide_immunity(member)
+    _immunity[member.id] = (roles, result)
+    return result
+
+
+def _decide_immunity(member: Member) -> bool:
+    if is_banned(member):
         return True
 
-    if member.guild.owner is member:
+    if member.guild.owner_id == member.id:
         return True
 
     for role in member.roles:
@@ -25,12 +50,83 @@ def immune(member: Member) -> bool:
     return False
 
 
+def forget_immunity(member_id: int):
+    _immunity.pop(member_id, None)
+
+
+def clear_immunity(*_):
+    _immunity.clear()
+
+
+lajter.settings.on_reload(clear_immunity)
+
+
+# Objects fetched over REST because they were missing from the gateway
+# cache. Entries expire after ttl seconds, least recently used ones are
+# dropped when the cache is full, and gateway events invalidate them
+class ResolverCache:
+    def __init__(self, max_size: int = 1024, ttl: float = 300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: OrderedDict[Hashable, tuple] = OrderedDict()
+
+    def get(self, key: Hashable):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        value, expires = entry
+        if expires < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def put(self, key: Hashable, value):
+        self._entries[key] = (value, time.monotonic() + self.ttl)
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, key: Hashable):
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+
+
+channel_cache = ResolverCache()
+member_cache = ResolverCache()
+
+
+async def resolve_channel(bot: commands.Bot, channel_id: int):
+    channel = bot.get_channel(channel_id) or channel_cache.get(channel_id)
+    if channel is None:
+        with metrics.rest("bot.fetch_channel"):
+            channel = await bot.fetch_channel(channel_id)
+        channel_cache.put(channel_id, channel)
+    return channel
+
+
+async def resolve_member(guild: Guild, member_id: int) -> Member:
+    key = (guild.id, member_id)
+    member = guild.get_member(member_id) or member_cache.get(key)
+    if member is None:
+        with metrics.rest("guild.fetch_member"):
+            member = await guild.fetch_member(member_id)
+        member_cache.put(key, member)
+    return member
+
+
 def role_from_mention(guild: Guild, mention: str) -> Role:
-    return get(guild.roles, id=int(mention[3:-1]))
+    return guild.get_role(int(mention[3:-1]))
+
+
+def channel_id_from_mention(mention: str) -> int:
+    return int(mention[2:-1])
 
 
 async def member_from_mention(guild: Guild,mention: str) -> Member:
-    return await guild.fetch_member(int(mention[2:-1]))
+    return await resolve_member(guild, int(mention[2:-1]))
 
 
 def rate_message(message: str) -> int:
@@ -60,30 +156,31 @@ def rate_message(message: str) -> int:
     return min(points, 50)
 
 async def get_default_guild(bot: commands.Bot) -> Guild | None:
-    guild_id = os.getenv("DEFAULT_GUILD")
+    guild_id = lajter.settings.get().default_guild
     if guild_id:
-        return bot.get_guild(int(guild_id))
+        return bot.get_guild(guild_id)
     return None
 
+def in_default_guild(message: Message) -> bool:
+    return (message.guild is not None
+            and message.guild.id == lajter.settings.get().default_guild)
+
 async def get_default_channel(bot: commands.Bot) -> TextChannel | None:
-    channel_id = os.getenv("DEFAULT_CHANNEL")
+    channel_id = lajter.settings.get().default_channel
     if channel_id:
-        return await bot.fetch_channel(int(channel_id))
+        return await resolve_channel(bot, channel_id)
     return None
 
 async def get_ban_role(bot: commands.Bot) -> Role | None:
-    role_id = os.getenv("BAN_ROLE")
+    role_id = lajter.settings.get().ban_role
     if role_id:
         guild: Guild = await get_default_guild(bot)
-        return guild.get_role(int(role_id))
+        return guild.get_role(role_id)
     return None
 
 def is_banned(member: Member) -> bool:
-    role_id = os.getenv("BAN_ROLE")
-    for role in member.roles:
-        if role.id == int(role_id):
-            return True
-    return False
+    role_id = lajter.settings.get().ban_role
+    return role_id is not None and member.get_role(role_id) is not None
 
 def not_banned():
     async def predicate(ctx: Context):
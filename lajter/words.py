@@ -0,0 +1,112 @@
+import logging
+import mmap
+import os
+import random
+from array import array
+
+logger = logging.getLogger('WORDS')
+logger.setLevel(logging.DEBUG)
+
+
+# Word list memory mapped from a file with one word per line. The offsets of
+# the lines are kept in a compact array, and cached next to the file, so a
+# uniformly random word is drawn without reading the file
+class WordList:
+    def __init__(self, path: str):
+        self.path = path
+        self.index_path = f'{path}.idx'
+        self._mtime: int | None = None
+        self._file = None
+        self._map: mmap.mmap | None = None
+        self._offsets = array('I')
+
+    def __len__(self) -> int:
+        return len(self._offsets)
+
+    # Reloads the word list if the file changed since it was loaded
+    def refresh(self):
+        stat = os.stat(self.path)
+        if stat.st_mtime_ns == self._mtime:
+            return
+
+        self.close()
+        self._file = open(self.path, "rb")
+        if stat.st_size > 0:
+            self._map = mmap.mmap(self._file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+
+        self._offsets = self._load_index(stat)
+        if self._offsets is None:
+            self._offsets = self._build_index()
+            self._save_index(stat)
+        self._mtime = stat.st_mtime_ns
+        logger.info(f'Loaded {len(self._offsets)} words from {self.path}')
+
+    def close(self):
+        if self._map:
+            self._map.close()
+            self._map = None
+        if self._file:
+            self._file.close()
+            self._file = None
+        self._mtime = None
+
+    def _build_index(self) -> array:
+        offsets = array('I' if os.path.getsize(self.path) < 2 ** 32 else 'Q')
+        if self._map is None:
+            return offsets
+
+        position = 0
+        size = len(self._map)
+        while position < size:
+            end = self._map.find(b'\n', position)
+            if end == -1:
+                end = size
+            if self._map[position:end].strip():
+                offsets.append(position)
+            position = end + 1
+        return offsets
+
+    # The cached index starts with the size and modification time of the
+    # file it was built from, followed by the type code and the offsets
+    def _load_index(self, stat: os.stat_result) -> array | None:
+        try:
+            with open(self.index_path, "rb") as f:
+                header = array('Q')
+                header.fromfile(f, 3)
+                if list(header) != [stat.st_size, stat.st_mtime_ns,
+                                    os.path.getsize(self.index_path)]:
+                    return None
+                offsets = array(f.read(1).decode())
+                offsets.frombytes(f.read())
+                return offsets
+        except (OSError, EOFError, ValueError, UnicodeDecodeError):
+            return None
+
+    def _save_index(self, stat: os.stat_result):
+        size = 3 * 8 + 1 + len(self._offsets) * self._offsets.itemsize
+        try:
+            with open(self.index_path, "wb") as f:
+                array('Q', [stat.st_size, stat.st_mtime_ns, size]).tofile(f)
+                f.write(self._offsets.typecode.encode())
+                self._offsets.tofile(f)
+        except OSError:
+            logger.warning(f'Failed to save the word index to '
+                           f'{self.index_path}')
+
+    def random_word(self) -> str | None:
+        self.refresh()
+        if not self._offsets:
+            return None
+
+        # Lines that are not valid UTF-8 are skipped by drawing again
+        for _ in range(10):
+            start = random.choice(self._offsets)
+            end = self._map.find(b'\n', start)
+            if end == -1:
+                end = len(self._map)
+            try:
+                return self._map[start:end].decode().strip()
+            except UnicodeDecodeError:
+                continue
+        return None
@@ -0,0 +1,12 @@
+import os
+import sys
+import tempfile
+
+# The tables are opened when lajter is imported, so the tests get an empty
+# directory before that
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+_directory = tempfile.TemporaryDirectory()
+os.chdir(_directory.name)
+os.environ["STORAGE"] = "json"
+os.environ["REGEX_BUDGET_MS"] = "0"
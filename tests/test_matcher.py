@@ -0,0 +1,45 @@
+from lajter.rule import Matcher, Rule, RuleType
+
+
+def make_matcher(*regexes: str) -> Matcher:
+    return Matcher(tuple(Rule(RuleType.MESSAGE, rule_id=rule_id,
+                              regexes=[regex])
+                         for rule_id, regex in enumerate(regexes, 1)))
+
+
+# Regexes with (?i) at the start have their literal looked for in the
+# folded text, and still match any case of it
+def test_case_insensitive_rules_are_prefiltered():
+    matcher = make_matcher("(?i)kurcze", "(?i)ISTNIEJE", "Kurcze")
+
+    assert not matcher.separate
+    assert not matcher.merged
+    assert matcher.folded.keys() == {"kurcze", "istnieje"}
+    assert matcher.prefiltered.keys() == {"Kurcze"}
+
+    assert matcher.match(["KURCZE"]) == {1}
+    assert matcher.match(["no Kurcze"]) == {1, 3}
+    assert matcher.match(["İstnieje"]) == {2}
+    assert matcher.match(["ıstnıeje"]) == {2}
+    assert matcher.match(["nic"]) == set()
+
+
+# Case-insensitive regexes without a literal are merged with their flags
+# kept to themselves
+def test_case_insensitive_rules_are_merged():
+    matcher = make_matcher(r"(?i)\d+[zł]", r"\d+[ZŁ]")
+
+    assert len(matcher.merged) == 2
+    assert not matcher.separate
+
+    assert matcher.match(["10zł"]) == {1}
+    assert matcher.match(["10Zł"]) == {1, 2}
+    assert matcher.match(["ZŁ"]) == set()
+
+
+def test_rule_matches_case_insensitive_literal():
+    rule = Rule(RuleType.MESSAGE, regexes=["(?i)kurcze"])
+
+    assert rule.literals == ["kurcze"]
+    assert rule.matches(["O KURCZE"])
+    assert not rule.matches(["kurde"])
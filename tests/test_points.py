@@ -0,0 +1,73 @@
+import asyncio
+import os
+
+import lajter.cogs.rules
+import lajter.dispatch
+import lajter.settings
+import lajter.user
+from benchmarks import fakes
+from lajter.action import Action, ActionType
+from lajter.rule import Rule, RuleType
+
+
+def setup_guild():
+    guild = fakes.FakeGuild()
+    channel = guild.add_channel()
+    os.environ["DEFAULT_GUILD"] = str(guild.id)
+    os.environ["DEFAULT_CHANNEL"] = str(channel.id)
+    lajter.settings.reload()
+    lajter.dispatch.dispatcher.delay = 0
+    return fakes.FakeBot(guild), guild, channel
+
+
+def add_rule(rule_type: RuleType, regexes, *actions: Action) -> Rule:
+    for action in actions:
+        action.save()
+    rule = Rule(rule_type, regexes=regexes,
+                actions=[action.id for action in actions])
+    rule.save()
+    return rule
+
+
+# Points taken by the action of a broken rule cross the threshold of a
+# points rule, which is then broken too
+def test_add_points_of_rule_crosses_points_rule():
+    bot, guild, channel = setup_guild()
+    member = guild.add_member("gracz")
+    lajter.user.User(member.id, points=100).save()
+
+    add_rule(RuleType.MESSAGE, ["przeklenstwo"],
+             Action(ActionType.ADD_POINTS, value=["-80"]))
+    add_rule(RuleType.POINTS_LESS_THAN, ["50"],
+             Action(ActionType.ADD_POINTS, value=["1000"]))
+
+    message = fakes.FakeMessage(channel, member, "to przeklenstwo")
+    asyncio.run(lajter.cogs.rules.handle_rules(
+        [RuleType.MESSAGE], bot=bot, member=member, channel=channel,
+        message=message))
+
+    assert lajter.user.get_by_id(member.id).points == 1020
+    assert lajter.user.take_changed() == []
+
+
+# Points added to another member by an action are checked for that member
+def test_add_points_of_other_target_crosses_points_rule():
+    bot, guild, channel = setup_guild()
+    member = guild.add_member("gracz")
+    target = guild.add_member("cel")
+    lajter.user.User(member.id, points=100).save()
+    lajter.user.User(target.id, points=100).save()
+
+    add_rule(RuleType.MESSAGE, ["podaruj"],
+             Action(ActionType.ADD_POINTS, value=["5000"],
+                    target=[target.mention]))
+    add_rule(RuleType.POINTS_GREATER_THAN, ["4000"],
+             Action(ActionType.ADD_POINTS, value=["-3000"]))
+
+    message = fakes.FakeMessage(channel, member, "podaruj mu")
+    asyncio.run(lajter.cogs.rules.handle_rules(
+        [RuleType.MESSAGE], bot=bot, member=member, channel=channel,
+        message=message))
+
+    assert lajter.user.get_by_id(member.id).points == 100
+    assert lajter.user.get_by_id(target.id).points == 2100
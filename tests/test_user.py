@@ -0,0 +1,35 @@
+import pytest
+
+import lajter.user
+
+
+class FailingStorage:
+    def __init__(self, storage):
+        self.storage = storage
+        self.fail = True
+
+    def upsert_many(self, entries):
+        if self.fail:
+            raise OSError("disk full")
+        self.storage.upsert_many(entries)
+
+    def __getattr__(self, name):
+        return getattr(self.storage, name)
+
+
+# Users are only marked as written once the write succeeded
+def test_failed_flush_is_retried():
+    lajter.user.User(123, points=50).save()
+
+    storage = lajter.user.User.db
+    lajter.user.User.db = FailingStorage(storage)
+    try:
+        with pytest.raises(OSError):
+            lajter.user.flush()
+        assert storage.get(123) is None
+
+        lajter.user.User.db.fail = False
+        lajter.user.flush()
+    finally:
+        lajter.user.User.db = storage
+    assert storage.get(123)['points'] == 50